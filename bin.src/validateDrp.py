@@ -65,8 +65,50 @@ if __name__ == "__main__":
                         help='Skip making plots of performance.')
     parser.add_argument('--level', type=str, default='design',
                         help='Level of SRD requirement to meet: "minimum", "design", "stretch"')
+    parser.add_argument('--loadThreads', type=int, default=1,
+                        help='Number of threads used to read and calibrate source catalogs.')
+    parser.add_argument('--cacheDir', type=str, default=None,
+                        help='Directory in which to cache calibrated source catalogs between runs.')
+    parser.add_argument('--matchDir', type=str, default=None,
+                        help='Directory in which to persist matched catalogs, '
+                             'which are reused if the inputs are unchanged.')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='Match only the visits that are not in the catalog persisted in '
+                             '--matchDir against it, instead of matching all visits again.')
+    parser.add_argument('--tileSize', type=float, default=None,
+                        help='Match sources tile by tile over sky tiles of this size (degrees), '
+                             'to bound the memory used by the matching on large datasets; '
+                             'requires --matcher afw.')
+    parser.add_argument('--matcher', type=str, default='afw', choices=['afw', 'fof'],
+                        help='Backend used to match sources across visits: afw MultiMatch, '
+                             'or a vectorized friends-of-friends matcher.')
+    parser.add_argument('--sidecar', default=False, action='store_true',
+                        help='Write the large arrays of the JSON output to a .npz file next to it.')
+    parser.add_argument('--jobs', '-j', dest='numJobs', type=int, default=1,
+                        help='Number of filters to process in parallel processes.')
+    parser.add_argument('--measureThreads', type=int, default=1,
+                        help='Number of threads used to compute independent measurements.')
+    parser.add_argument('--numRandomShuffles', type=int, default=50,
+                        help='Number of random shuffles of PA1, or the maximum number '
+                             'with --pa1Tolerance.')
+    parser.add_argument('--pa1Tolerance', type=float, default=None,
+                        help='Stop drawing random shuffles of PA1 once the standard error of PA1 '
+                             'is below this (mmag).')
+    parser.add_argument('--keepShuffles', dest='numKeptShuffles', type=int, default=1,
+                        help='Number of PA1 random shuffles whose per-star magnitude differences '
+                             'are kept in the output; 0 keeps all of them.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the random shuffles of PA1, for reproducible results.')
 
     args = parser.parse_args()
+    if args.incremental and not args.matchDir:
+        parser.error('--incremental requires --matchDir')
+    if args.tileSize and args.matcher != 'afw':
+        parser.error('--tileSize requires --matcher afw')
+    if args.numKeptShuffles < 0:
+        parser.error('--keepShuffles must be positive, or 0 to keep all the shuffles')
+    if args.numKeptShuffles == 0:
+        args.numKeptShuffles = None
 
     # Should clean up the duplication here between this and validate.run
     if args.repo[-5:] == '.json':
@@ -91,6 +133,20 @@ if __name__ == "__main__":
             if args.verbose:
                 print("VISITDATAIDS: ", kwargs['dataIds'])
 
+        kwargs['loadThreads'] = args.loadThreads
+        kwargs['cacheDir'] = args.cacheDir
+        kwargs['matchDir'] = args.matchDir
+        kwargs['tileSize'] = args.tileSize
+        kwargs['matcher'] = args.matcher
+        kwargs['incremental'] = args.incremental
+        kwargs['sidecar'] = args.sidecar
+        kwargs['seed'] = args.seed
+        kwargs['numKeptShuffles'] = args.numKeptShuffles
+        kwargs['numRandomShuffles'] = args.numRandomShuffles
+        kwargs['pa1Tolerance'] = args.pa1Tolerance
+        kwargs['numJobs'] = args.numJobs
+        kwargs['measureThreads'] = args.measureThreads
+
         if not os.path.exists(args.metricsFile):
             print('Could not find metric definitions: {0}'.format(args.metricsFile))
             sys.exit(1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Benchmark the peak memory use of loading and matching per-visit catalogs.
+
+Builds a synthetic dataset of many visits of the same field and reports the
+peak resident set size (RSS) of ingesting and matching it as
+`lsst.validate.drp.matchreduce.MatchedMultiVisitDataset` does ("lean"), and
+as it used to, with every ``src`` field copied and an extra copy of every
+source kept for the whole run ("srcVis").  Each mode runs in its own process so that the peak RSS of one
+does not hide that of the other.
+
+Example
+-------
+    python benchmarkMatchMemory.py --visits 100 --sources 5000
+"""
+
+from __future__ import print_function, division
+from builtins import range
+
+import argparse
+import resource
+import subprocess
+import sys
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.afw.table import Field, SourceCatalog, SourceTable
+
+from lsst.validate.drp.matchreduce import MatchedMultiVisitDataset
+
+
+def peakRssMegabytes():
+    """Peak resident set size of this process [MB]."""
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return maxRss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def makeSrcSchema(numExtraFields):
+    """Schema with the fields used by validate_drp, plus ``numExtraFields``
+    other measurements, as in a real ``src`` schema."""
+    schema = SourceTable.makeMinimalSchema()
+    for name in ('base_PsfFlux_flux', 'base_PsfFlux_fluxSigma',
+                 'base_ClassificationExtendedness_value'):
+        schema.addField(Field[float](name, name))
+    for name in MatchedMultiVisitDataset._flagNames:
+        schema.addField(Field['Flag'](name, name))
+    for i in range(numExtraFields):
+        schema.addField(Field[float]('extra_measurement_%d' % i, 'padding'))
+    return schema
+
+
+def makeSrcCatalog(schema, ra, dec, rng):
+    """Synthetic ``src`` catalog of one visit."""
+    catalog = SourceCatalog(schema)
+    catalog.reserve(len(ra))
+    for i in range(len(ra)):
+        catalog.addNew()
+    catalog['id'][:] = np.arange(1, len(ra) + 1)
+    catalog['coord_ra'][:] = ra + rng.normal(0, 1e-7, len(ra))
+    catalog['coord_dec'][:] = dec + rng.normal(0, 1e-7, len(ra))
+    flux = 10**rng.uniform(3, 6, len(ra))
+    catalog['base_PsfFlux_flux'][:] = flux
+    catalog['base_PsfFlux_fluxSigma'][:] = np.sqrt(flux)
+    catalog['base_ClassificationExtendedness_value'][:] = 0
+    return catalog
+
+
+def runMode(mode, numVisits, numSources, numExtraFields):
+    """Ingest and match the synthetic dataset, and print the peak RSS."""
+    rng = np.random.RandomState(12345)
+    ra = np.deg2rad(rng.uniform(149.5, 150.5, numSources))
+    dec = np.deg2rad(rng.uniform(1.5, 2.5, numSources))
+
+    schema = makeSrcSchema(numExtraFields)
+    if mode == 'srcVis':
+        # The former ingestion copied the whole src schema.
+        mapper, newSchema = MatchedMultiVisitDataset._makeSchemaMapper(
+            schema, list(schema.getNames()))
+    else:
+        mapper, newSchema = MatchedMultiVisitDataset._makeSchemaMapper(schema)
+    calib = afwImage.Calib()
+    calib.setFluxMag0(10**(0.4*27))
+    dataIds = [{'visit': visit, 'ccd': 0} for visit in range(numVisits)]
+
+    def catalogs():
+        for index in range(numVisits):
+            oldSrc = makeSrcCatalog(schema, ra, dec, rng)
+            yield index, MatchedMultiVisitDataset._calibrateCatalog(oldSrc, calib,
+                                                                    mapper, newSchema)
+
+    srcVis = SourceCatalog(newSchema)
+
+    def catalogsWithCopy():
+        # The former ingestion: every source also appended to srcVis.
+        for index, tmpCat in catalogs():
+            srcVis.extend(tmpCat, False)
+            yield index, tmpCat
+
+    names = MatchedMultiVisitDataset._reducedFieldNames + ['visit', 'ccd']
+    matches = MatchedMultiVisitDataset._matchCatalogs(
+        catalogsWithCopy() if mode == 'srcVis' else catalogs(),
+        dataIds, newSchema, 'ccd', afwGeom.Angle(1, afwGeom.arcseconds), names)
+    print('%s %d %.1f' % (mode, len(matches), peakRssMegabytes()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--visits', type=int, default=100,
+                        help='Number of visits.')
+    parser.add_argument('--sources', type=int, default=5000,
+                        help='Number of sources per visit.')
+    parser.add_argument('--extraFields', type=int, default=200,
+                        help='Number of additional measurement fields in the src schema.')
+    parser.add_argument('--mode', choices=['srcVis', 'lean'], default=None,
+                        help='Run only this mode, in this process.')
+    args = parser.parse_args()
+
+    if args.mode:
+        runMode(args.mode, args.visits, args.sources, args.extraFields)
+        return
+
+    print('%d visits of %d sources, %d extra src fields' %
+          (args.visits, args.sources, args.extraFields))
+    for mode in ('srcVis', 'lean'):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--mode', mode, '--visits', str(args.visits),
+             '--sources', str(args.sources), '--extraFields', str(args.extraFields)])
+        mode, numObjects, peakRss = output.decode().split()[-3:]
+        print('%-8s peak RSS %8s MB  (%s matched objects)' % (mode, peakRss, numObjects))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""On-disk caches of calibrated per-visit source columns and of matched
+multi-visit catalogs.
+"""
+
+from __future__ import print_function, absolute_import
+from builtins import object
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import lsst.daf.persistence as dafPersist
+
+from .groupedarrays import GroupedArrays
+
+
+__all__ = ['VisitCatalogCache', 'MatchedCatalogCache', 'inputFileStats']
+
+
+def inputFileStats(butler, dataId):
+    """Describe the files backing a data ID, to detect changes.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+        Butler of the repository.
+    dataId : `dict`
+        `butler` data ID.
+
+    Returns
+    -------
+    stats : `list` or `None`
+        ``(path, size, mtime)`` of the ``src`` and ``calexp`` files,
+        or `None` if they could not be located.
+    """
+    try:
+        files = [butler.get(dataset + '_filename', dataId, immediate=True)[0]
+                 for dataset in ('src', 'calexp')]
+        return [(os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime) for f in files]
+    except (dafPersist.NoResults, OSError, IndexError):
+        return None
+
+
+def _canonicalDataId(dataId):
+    return sorted((str(k), str(v)) for k, v in dataId.items())
+
+
+class VisitCatalogCache(object):
+    """Content-keyed cache of the calibrated source columns of each visit.
+
+    Each entry is a ``.npz`` file of per-source column arrays, named by a
+    hash of the repository path, the data ID, the size and modification
+    time of the ``src`` and ``calexp`` files, and the ``src`` schema.
+    Any change to these inputs results in a new key, so stale entries are
+    never read.
+
+    Parameters
+    ----------
+    cacheDir : `str`
+        Directory holding the cache entries.  Created if necessary.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def makeKey(self, butler, repo, dataId, schema, fields=None):
+        """Compute the cache key of a visit catalog.
+
+        Parameters
+        ----------
+        butler : `lsst.daf.persistence.Butler`
+            Butler of the repository.
+        repo : `str`
+            The repository.
+        dataId : `dict`
+            `butler` data ID of the catalog.
+        schema : `lsst.afw.table.Schema`
+            Schema of the ``src`` catalogs.
+        fields : `list` of `str`, optional
+            Names of the cached columns.
+
+        Returns
+        -------
+        key : `str` or `None`
+            Hex digest identifying the catalog contents, or `None` if the
+            files backing the data ID could not be located.
+        """
+        files = inputFileStats(butler, dataId)
+        if files is None:
+            return None
+
+        description = {
+            'repo': os.path.abspath(repo),
+            'dataId': _canonicalDataId(dataId),
+            'files': files,
+            'schema': sorted(schema.getNames()),
+        }
+        if fields is not None:
+            description['fields'] = sorted(fields)
+        text = json.dumps(description, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + '.npz')
+
+    def get(self, key):
+        """Read a cache entry.
+
+        Parameters
+        ----------
+        key : `str` or `None`
+            Key from `makeKey`.
+
+        Returns
+        -------
+        columns : `dict` of `numpy.ndarray` or `None`
+            The cached columns, or `None` on a cache miss.
+        """
+        if key is None or not os.path.exists(self._path(key)):
+            return None
+        with np.load(self._path(key)) as data:
+            return {name: data[name] for name in data.files}
+
+    def put(self, key, columns):
+        """Write a cache entry.
+
+        Parameters
+        ----------
+        key : `str` or `None`
+            Key from `makeKey`.  Nothing is written if `None`.
+        columns : `dict` of `numpy.ndarray`
+            Per-source column arrays.
+        """
+        if key is None:
+            return
+        # Write to a temporary file and rename so that concurrent readers
+        # never see a partial entry.
+        fd, tmpPath = tempfile.mkstemp(suffix='.npz', dir=self.cacheDir)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                np.savez(outfile, **columns)
+            os.rename(tmpPath, self._path(key))
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+class MatchedCatalogCache(object):
+    """Persisted result of matching the sources of many visits.
+
+    The matched sources are stored as the columns, group offsets and
+    object ids of a `~lsst.validate.drp.groupedarrays.GroupedArrays` in a
+    ``.npz`` file, together with a description of the inputs of the match
+    and, optionally, the state of per-object running statistics that are
+    updated when the match is extended.  The entry is only used if the
+    description is unchanged.
+
+    Parameters
+    ----------
+    filename : `str`
+        Path of the ``.npz`` file.
+    """
+
+    _columnPrefix = 'column_'
+    _statisticsPrefix = 'statistics_'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def makeDescription(butler, repo, dataIds, matchRadius, tileSize=None, fields=None,
+                        matcher=None):
+        """Describe the inputs of a match.
+
+        Parameters
+        ----------
+        butler : `lsst.daf.persistence.Butler`
+            Butler of the repository.
+        repo : `str`
+            The repository.
+        dataIds : `list` of `dict`
+            `butler` data IDs of the matched catalogs.
+        matchRadius : `lsst.afw.geom.Angle`
+            Radius used for matching.
+        tileSize : `lsst.afw.geom.Angle`, optional
+            Size of the tiles, if matched tile by tile.
+        fields : `list` of `str`, optional
+            Names of the per-source fields of the match.
+        matcher : `str`, optional
+            Name of the matcher, if not `lsst.afw.table.MultiMatch`.
+
+        Returns
+        -------
+        description : `dict`
+            JSON-serializable description of the inputs.
+        """
+        description = {
+            'repo': os.path.abspath(repo),
+            'matchRadiusArcsec': matchRadius.asArcseconds(),
+            'inputs': [[_canonicalDataId(dataId), inputFileStats(butler, dataId)]
+                       for dataId in dataIds],
+        }
+        if tileSize is not None:
+            description['tileSizeDegrees'] = tileSize.asDegrees()
+        if fields is not None:
+            description['fields'] = sorted(fields)
+        if matcher is not None:
+            description['matcher'] = matcher
+        return description
+
+    def readDescription(self):
+        """Read the description of the persisted match.
+
+        Returns
+        -------
+        description : `dict` or `None`
+            The description, or `None` if nothing has been persisted.
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with np.load(self.filename) as data:
+            return json.loads(str(data['description']))
+
+    def read(self, description=None):
+        """Read the persisted match.
+
+        Parameters
+        ----------
+        description : `dict`, optional
+            Expected description of the inputs, from `makeDescription`.
+            If given, nothing is returned unless it equals the persisted
+            description.
+
+        Returns
+        -------
+        matches : `lsst.validate.drp.groupedarrays.GroupedArrays` or `None`
+            The matched sources grouped by object, or `None`.
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with np.load(self.filename) as data:
+            if description is not None:
+                # Round-trip through JSON so that tuples compare as lists.
+                expected = json.loads(json.dumps(description))
+                if json.loads(str(data['description'])) != expected:
+                    return None
+            columns = {name[len(self._columnPrefix):]: data[name] for name in data.files
+                       if name.startswith(self._columnPrefix)}
+            return GroupedArrays(data['offsets'], ids=data['ids'], **columns)
+
+    def readForUpdate(self, description):
+        """Read a persisted match of a subset of the inputs of
+        ``description``, to be extended with the others.
+
+        Parameters
+        ----------
+        description : `dict`
+            Description of the inputs, from `makeDescription`.
+
+        Returns
+        -------
+        matches : `lsst.validate.drp.groupedarrays.GroupedArrays` or `None`
+            The persisted matched sources grouped by object, or `None` if
+            the persisted match differs other than by lacking some inputs,
+            or was matched tile by tile (which only keeps good matches).
+        newInputs : `list` of `int` or `None`
+            Indices in ``description['inputs']`` of the inputs that are not
+            in the persisted match.
+        """
+        previous = self.readDescription()
+        if previous is None or 'tileSizeDegrees' in previous:
+            return None, None
+
+        expected = json.loads(json.dumps(description))
+        previousInputs = previous.pop('inputs')
+        inputs = expected.pop('inputs')
+        if previous != expected:
+            return None, None
+        # The previous match cannot be reused if the files of one of its
+        # inputs changed, or if an input was removed.
+        if any(previousInput not in inputs for previousInput in previousInputs):
+            return None, None
+
+        newInputs = [i for i, newInput in enumerate(inputs) if newInput not in previousInputs]
+        return self.read(), newInputs
+
+    def readStatistics(self):
+        """Read the persisted per-object statistics of the match.
+
+        Returns
+        -------
+        state : `dict` of `numpy.ndarray` or `None`
+            The state of the statistics, as passed to `write`, or `None` if
+            none were persisted.
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with np.load(self.filename) as data:
+            state = {name[len(self._statisticsPrefix):]: data[name] for name in data.files
+                     if name.startswith(self._statisticsPrefix)}
+        return state or None
+
+    def write(self, matches, description, statistics=None):
+        """Persist a match.
+
+        Parameters
+        ----------
+        matches : `lsst.validate.drp.groupedarrays.GroupedArrays`
+            The matched sources grouped by object.
+        description : `dict`
+            Description of the inputs, from `makeDescription`.
+        statistics : `dict` of `numpy.ndarray`, optional
+            State of per-object statistics of ``matches``, e.g. from
+            `lsst.validate.drp.reducers.RunningMatchStatistics.getState`.
+        """
+        arrays = {self._columnPrefix + name: matches[name] for name in matches.names}
+        for name, values in (statistics or {}).items():
+            arrays[self._statisticsPrefix + name] = values
+        ids = matches.ids if matches.ids is not None else np.arange(len(matches))
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpPath = tempfile.mkstemp(suffix='.npz', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                np.savez(outfile, offsets=matches.offsets, ids=ids,
+                         description=json.dumps(description, sort_keys=True),
+                         **arrays)
+            os.rename(tmpPath, self.filename)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
@@ -5,6 +5,6 @@ Document.
 from .pa1 import PA1Measurement  # NOQA
 from .pa2 import PA2Measurement  # NOQA
 from .pf1 import PF1Measurement  # NOQA
-from .amx import AMxMeasurement  # NOQA
+from .amx import AMxMeasurement, calcAMxRmsDistances  # NOQA
 from .afx import AFxMeasurement  # NOQA
 from .adx import ADxMeasurement  # NOQA
@@ -20,11 +20,12 @@
 
 from __future__ import print_function, absolute_import
 
-import numpy as np
 import astropy.units as u
 
 from lsst.validate.base import MeasurementBase
 
+from ..quantiles import percentiles
+
 
 class ADxMeasurement(MeasurementBase):
     """Measurement of AFx (x=1,2,3): The maximum fraction of astrometric
@@ -130,7 +131,7 @@ class ADxMeasurement(MeasurementBase):
             # No more than AFx of values will deviate by more than the
             # AMx (50th) + AFx percentiles
             # To compute ADx, use measured AMx and spec for AFx.
-            afxAtPercentile = np.percentile(
+            afxAtPercentile = percentiles(
                 amx.rmsDistMas.to(u.marcsec),
                 100. - self.AFx) * u.marcsec
             self.quantity = afxAtPercentile - amx.quantity
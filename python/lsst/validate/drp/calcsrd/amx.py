@@ -25,7 +25,8 @@ import numpy as np
 import astropy.units as u
 
 from lsst.validate.base import MeasurementBase
-from ..util import averageRaDecFromCat, sphDist
+from ..util import (averageRaDecByGroup, averageRaDecFromCat,
+                    iterPairsInAnnuli, sphDist)
 
 
 class AMxMeasurement(MeasurementBase):
@@ -54,6 +55,10 @@ class AMxMeasurement(MeasurementBase):
         A `dict` of additional blobs (subclasses of BlobBase) that
         can provide additional context to the measurement, though aren't
         direct dependencies of the computation (e.g., ``matchedDataset``).
+    rmsDistances : `astropy.units.Quantity`, optional
+        RMS distances of the stellar pairs in this measurement's annulus,
+        if already computed together with those of other AMx measurements
+        by `calcAMxRmsDistances`.  Computed here if not provided.
 
     Attributes
     ----------
@@ -105,7 +110,8 @@ class AMxMeasurement(MeasurementBase):
     """
 
     def __init__(self, metric, matchedDataset, filter_name, width=2.,
-                 magRange=None, linkedBlobs=None, job=None, verbose=False):
+                 magRange=None, linkedBlobs=None, job=None, verbose=False,
+                 rmsDistances=None):
         MeasurementBase.__init__(self)
 
         self.metric = metric
@@ -117,24 +123,16 @@ class AMxMeasurement(MeasurementBase):
         # Measurement Parameters
         self.register_parameter('D', datum=self.metric.D)
 
-        if not isinstance(width, u.Quantity):
-            width = width * u.arcmin
         self.register_parameter('width',
-                                quantity=width,
+                                quantity=_asWidth(width),
                                 label='Width',
                                 description='Width of annulus')
-        if magRange is None:
-            magRange = np.array([17.0, 21.5]) * u.mag
-        else:
-            assert len(magRange) == 2
-            if not isinstance(magRange, u.Quantity):
-                magRange = np.array(magRange) * u.mag
         self.register_parameter('magRange',
-                                quantity=magRange,
+                                quantity=_asMagRange(magRange),
                                 description='Stellar magnitude selection '
                                             'range.')
 
-        annulus = self.D + (self.width/2)*np.array([-1, +1])
+        annulus = _annulus(self.D, self.width)
         self.register_parameter('annulus',
                                 quantity=annulus,
                                 label='annulus radii',
@@ -150,12 +148,13 @@ class AMxMeasurement(MeasurementBase):
             for name, blob in linkedBlobs.items():
                 setattr(self, name, blob)
 
-        matches = matchedDataset.safeMatches
-        rmsDistances = calcRmsDistances(
-            matches,
-            self.annulus,
-            magRange=self.magRange,
-            verbose=verbose)
+        if rmsDistances is None:
+            matches = matchedDataset.safeMatches
+            rmsDistances = calcRmsDistances(
+                matches,
+                self.annulus,
+                magRange=self.magRange,
+                verbose=verbose)
 
         if len(rmsDistances) == 0:
             # raise ValidateErrorNoStars(
@@ -175,13 +174,70 @@ class AMxMeasurement(MeasurementBase):
             job.register_measurement(self)
 
 
-def calcRmsDistances(groupView, annulus, magRange, verbose=False):
+def _asWidth(width):
+    if not isinstance(width, u.Quantity):
+        width = width * u.arcmin
+    return width
+
+
+def _asMagRange(magRange):
+    if magRange is None:
+        magRange = np.array([17.0, 21.5]) * u.mag
+    else:
+        assert len(magRange) == 2
+        if not isinstance(magRange, u.Quantity):
+            magRange = np.array(magRange) * u.mag
+    return magRange
+
+
+def _annulus(D, width):
+    return D + (width/2)*np.array([-1, +1])
+
+
+def calcAMxRmsDistances(metrics, matchedDataset, width=2., magRange=None,
+                        verbose=False):
+    """Calculate the RMS distances of stellar pairs for several AMx metrics
+    at once.
+
+    The pairs of all the annuli are found with a single pair search, so
+    that AM1, AM2 and AM3 share one pass over the matched stars; see
+    `calcRmsDistancesInAnnuli`.
+
+    Parameters
+    ----------
+    metrics : `list` of `lsst.validate.base.Metric`
+        AM1, AM2 and/or AM3 `~lsst.validate.base.Metric` instances.
+    matchedDataset : lsst.validate.drp.matchreduce.MatchedMultiVisitDataset
+    width : `float` or `astropy.units.Quantity`, optional
+        Width around fiducial distance to include. [arcmin]
+    magRange : 2-element `list`, `tuple`, or `numpy.ndarray`, optional
+        brighter, fainter limits of the magnitude range to include.
+        Default: ``[17.0, 21.5]`` mag.
+    verbose : bool, optional
+        Output additional information on the analysis steps.
+
+    Returns
+    -------
+    rmsDistances : `list` of `astropy.units.Quantity`
+        RMS distances for each metric, to be passed to `AMxMeasurement`
+        with the same ``width`` and ``magRange``.
+    """
+    width = _asWidth(width)
+    annuli = [_annulus(metric.D.quantity, width) for metric in metrics]
+    return calcRmsDistancesInAnnuli(matchedDataset.safeMatches, annuli,
+                                    magRange=_asMagRange(magRange),
+                                    verbose=verbose)
+
+
+def calcRmsDistances(groups, annulus, magRange, verbose=False):
     """Calculate the RMS distance of a set of matched objects over visits.
 
     Parameters
     ----------
-    groupView : lsst.afw.table.GroupView
-        GroupView object of matched observations from MultiMatch.
+    groups : lsst.validate.drp.groupedarrays.GroupedArrays
+        Matched observations grouped by object, e.g.
+        ``MatchedMultiVisitDataset.safeMatches``.  The mean positions in its
+        ``'meanRa'`` and ``'meanDec'`` group columns are used if present.
     annulus : length-2 `astropy.units.Quantity`
         Distance range (i.e., arcmin) in which to compare objects.
         E.g., `annulus=np.array([19, 21]) * u.arcmin` would consider all
@@ -196,62 +252,217 @@ def calcRmsDistances(groupView, annulus, magRange, verbose=False):
     rmsDistances : `astropy.units.Quantity`
         RMS angular separations of a set of matched objects over visits.
     """
+    return calcRmsDistancesInAnnuli(groups, [annulus], magRange, verbose=verbose)[0]
 
-    # First we make a list of the keys that we want the fields for
-    importantKeys = [groupView.schema.find(name).key for
-                     name in ['id', 'coord_ra', 'coord_dec',
-                              'object', 'visit', 'base_PsfFlux_mag']]
+
+def calcRmsDistancesInAnnuli(groups, annuli, magRange, verbose=False):
+    """Calculate the RMS distance of a set of matched objects over visits,
+    for the pairs of objects in each of several annuli.
+
+    Parameters
+    ----------
+    groups : lsst.validate.drp.groupedarrays.GroupedArrays
+        Matched observations grouped by object, e.g.
+        ``MatchedMultiVisitDataset.safeMatches``.  The mean positions in its
+        ``'meanRa'`` and ``'meanDec'`` group columns are used if present.
+    annuli : `list` of length-2 `astropy.units.Quantity`
+        Distance ranges (i.e., arcmin) in which to compare objects.
+    magRange : length-2 `astropy.units.Quantity`
+        Magnitude range from which to select objects.
+    verbose : bool, optional
+        Output additional information on the analysis steps.
+
+    Returns
+    -------
+    rmsDistances : `list` of `astropy.units.Quantity`
+        RMS angular separations of the pairs of objects in each annulus.
+
+    Notes
+    -----
+    The magnitude selection, the mean positions, the pair search (out to
+    the largest outer radius) and the RMS distance of each pair are
+    computed once, however many annuli are requested.  The pairs are
+    processed in blocks (see `~lsst.validate.drp.util.iterPairsInAnnuli`),
+    and each block is binned into the annuli it falls in.
+    """
 
     minMag, maxMag = magRange.to(u.mag).value
 
-    def magInRange(cat):
-        mag = cat.get('base_PsfFlux_mag')
-        w, = np.where(np.isfinite(mag))
-        medianMag = np.median(mag[w])
-        return minMag <= medianMag and medianMag < maxMag
-
-    groupViewInMagRange = groupView.where(magInRange)
-
-    # List of lists of id, importantValue
-    matchKeyOutput = [obj.get(key)
-                      for key in importantKeys
-                      for obj in groupViewInMagRange.groups]
-
-    jump = len(groupViewInMagRange)
-
-    ra = matchKeyOutput[1*jump:2*jump]
-    dec = matchKeyOutput[2*jump:3*jump]
-    visit = matchKeyOutput[4*jump:5*jump]
-
-    # Calculate the mean position of each object from its constituent visits
-    # `aggregate` calulates a quantity for each object in the groupView.
-    meanRa = groupViewInMagRange.aggregate(averageRaFromCat)
-    meanDec = groupViewInMagRange.aggregate(averageDecFromCat)
-
-    annulusRadians = arcminToRadians(annulus.to(u.arcmin).value)
-
-    rmsDistances = list()
-    for obj1, (ra1, dec1, visit1) in enumerate(zip(meanRa, meanDec, visit)):
-        dist = sphDist(ra1, dec1, meanRa[obj1+1:], meanDec[obj1+1:])
-        objectsInAnnulus, = np.where((annulusRadians[0] <= dist) &
-                                     (dist < annulusRadians[1]))
-        for obj2 in objectsInAnnulus:
-            distances = matchVisitComputeDistance(
-                visit[obj1], ra[obj1], dec[obj1],
-                visit[obj2], ra[obj2], dec[obj2])
-            if not distances:
-                if verbose:
-                    print("No matching visits found for objs: %d and %d" %
-                          (obj1, obj2))
-                continue
-
-            finiteEntries, = np.where(np.isfinite(distances))
-            if len(finiteEntries) > 0:
-                rmsDist = np.std(np.array(distances)[finiteEntries])
-                rmsDistances.append(rmsDist)
-
-    # return quantity
-    rmsDistances = np.array(rmsDistances) * u.radian
+    isFinite = np.isfinite(groups['base_PsfFlux_mag'])
+    medianMag = groups.subsetSources(isFinite).median('base_PsfFlux_mag')
+    with np.errstate(invalid='ignore'):
+        inMagRange = (minMag <= medianMag) & (medianMag < maxMag)
+
+    groupsInMagRange = groups.subset(inMagRange)
+
+    # Mean position of each object from its constituent visits, if not
+    # already provided by MatchedMultiVisitDataset.
+    if 'meanRa' in groupsInMagRange.groupColumns:
+        meanRa = groupsInMagRange.groupColumns['meanRa']
+        meanDec = groupsInMagRange.groupColumns['meanDec']
+    else:
+        meanRa, meanDec = averageRaDecByGroup(groupsInMagRange['coord_ra'],
+                                              groupsInMagRange['coord_dec'],
+                                              groupsInMagRange.offsets)
+
+    # Sort the sources by (object, visit) once for all blocks of pairs.
+    objectVisitIndex = makeObjectVisitIndex(groupsInMagRange)
+
+    annuliRadians = [arcminToRadians(annulus.to(u.arcmin).value) for annulus in annuli]
+
+    # A single pair search serves all the annuli.  The RMS distance of
+    # each pair is computed once, a block of pairs at a time, and assigned
+    # to the annuli the pair falls in.
+    rmsDistances = [[np.array([])] for annulus in annuli]
+    for obj1, obj2, inAnnulus in iterPairsInAnnuli(meanRa, meanDec, annuliRadians):
+        blockRms = matchVisitComputeRmsDistance(groupsInMagRange, obj1, obj2,
+                                                objectVisitIndex=objectVisitIndex)
+        noMatch = ~np.isfinite(blockRms)
+        if verbose:
+            for o1, o2 in zip(obj1[noMatch], obj2[noMatch]):
+                print("No matching visits found for objs: %d and %d" % (o1, o2))
+        for selected, annulusRms in zip(inAnnulus, rmsDistances):
+            annulusRms.append(blockRms[selected & ~noMatch])
+
+    # return quantities
+    return [np.concatenate(annulusRms) * u.radian for annulusRms in rmsDistances]
+
+
+def makeObjectVisitIndex(groups):
+    """Sort the sources of ``groups`` by object and visit, for looking up
+    the source of an object in a given visit.
+
+    Parameters
+    ----------
+    groups : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Per-visit ``'visit'`` of each object.
+
+    Returns
+    -------
+    nVisits : `int`
+        Number of distinct visits.
+    visitRank : `numpy.ndarray` of `int`
+        Rank of the visit of each source among the distinct visits.
+    order : `numpy.ndarray` of `int`
+        Indices of the sources sorted by ``(object, visit)``.
+    sortedKeys : `numpy.ndarray` of `int`
+        Sorted ``object*nVisits + visitRank`` key of each source.
+    """
+    visits, visitRank = np.unique(groups['visit'], return_inverse=True)
+    nVisits = max(len(visits), 1)
+    keys = groups.groupIndex * nVisits + visitRank
+    order = np.argsort(keys, kind='mergesort')
+    return nVisits, visitRank, order, keys[order]
+
+
+def matchVisitComputeDistances(groups, obj1, obj2, objectVisitIndex=None):
+    """Calculate the distance between the objects of each pair in each
+    visit in which both objects are seen.
+
+    This is the batched equivalent of `matchVisitComputeDistance` for
+    many pairs of objects at once.
+
+    Parameters
+    ----------
+    groups : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Per-visit ``'visit'``, ``'coord_ra'`` and ``'coord_dec'`` [radians]
+        of each object.
+    obj1, obj2 : `numpy.ndarray` of `int`
+        Indices into ``groups`` of the two objects of each pair.
+    objectVisitIndex : `tuple`, optional
+        Result of `makeObjectVisitIndex` for ``groups``; computed if not
+        given.  Pass it in when calling this repeatedly on the same groups.
+
+    Returns
+    -------
+    pairIndex : `numpy.ndarray` of `int`
+        Index into ``obj1``/``obj2`` of the pair each distance belongs to.
+    distances : `numpy.ndarray` of `float`
+        Spherical distances (in radians) for matching visits.
+
+    Notes
+    -----
+    Visits of ``obj1`` missing from ``obj2`` and visits in which either
+    position is not finite are skipped, as in `matchVisitComputeDistance`.
+    If ``obj2`` has more than one source in a visit, the first one is used.
+    """
+    obj1 = np.asarray(obj1, dtype=np.int64)
+    obj2 = np.asarray(obj2, dtype=np.int64)
+    ra, dec = groups['coord_ra'], groups['coord_dec']
+
+    # Every source is keyed by (object, visit) so that a single sorted
+    # array can be searched for the visits of all pairs at once.
+    if objectVisitIndex is None:
+        objectVisitIndex = makeObjectVisitIndex(groups)
+    nVisits, visitRank, order, sortedKeys = objectVisitIndex
+
+    # Expand each pair into one entry per source of obj1.
+    counts1 = groups.counts[obj1]
+    pairIndex = np.repeat(np.arange(len(obj1)), counts1)
+    firstOfPair = np.cumsum(counts1) - counts1
+    src1 = groups.offsets[obj1][pairIndex] + np.arange(len(pairIndex)) - firstOfPair[pairIndex]
+
+    # Look up the same visit in obj2.
+    wanted = obj2[pairIndex] * nVisits + visitRank[src1]
+    found = np.searchsorted(sortedKeys, wanted)
+    found = np.minimum(found, len(sortedKeys) - 1)
+    isMatch = sortedKeys[found] == wanted if len(sortedKeys) else np.zeros(0, dtype=bool)
+    src2 = order[found]
+
+    pairIndex, src1, src2 = pairIndex[isMatch], src1[isMatch], src2[isMatch]
+    isFinite1 = np.isfinite(ra[src1]) & np.isfinite(dec[src1])
+    isFinite2 = np.isfinite(ra[src2]) & np.isfinite(dec[src2])
+    isFinite = isFinite1 & isFinite2
+    pairIndex, src1, src2 = pairIndex[isFinite], src1[isFinite], src2[isFinite]
+
+    distances = sphDist(ra[src1], dec[src1], ra[src2], dec[src2])
+    return pairIndex, distances
+
+
+def matchVisitComputeRmsDistance(groups, obj1, obj2, chunkSize=100000, objectVisitIndex=None):
+    """Calculate the RMS over shared visits of the distance between the
+    objects of each pair.
+
+    Parameters
+    ----------
+    groups : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Per-visit ``'visit'``, ``'coord_ra'`` and ``'coord_dec'`` [radians]
+        of each object.
+    obj1, obj2 : `numpy.ndarray` of `int`
+        Indices into ``groups`` of the two objects of each pair.
+    chunkSize : `int`, optional
+        Number of pairs processed at a time, to bound memory use.
+    objectVisitIndex : `tuple`, optional
+        Result of `makeObjectVisitIndex` for ``groups``; computed once for
+        all chunks if not given.
+
+    Returns
+    -------
+    rmsDistances : `numpy.ndarray` of `float`
+        RMS (standard deviation) of the per-visit distances of each pair
+        [radians].  NaN for pairs without any shared visit with finite
+        positions.
+    """
+    nPairs = len(obj1)
+    rmsDistances = np.full(nPairs, np.nan)
+    if objectVisitIndex is None:
+        objectVisitIndex = makeObjectVisitIndex(groups)
+    for start in range(0, nPairs, chunkSize):
+        stop = min(start + chunkSize, nPairs)
+        pairIndex, distances = matchVisitComputeDistances(
+            groups, obj1[start:stop], obj2[start:stop], objectVisitIndex=objectVisitIndex)
+
+        n = np.bincount(pairIndex, minlength=stop - start)
+        hasMatch = n > 0
+        mean = np.bincount(pairIndex, weights=distances, minlength=stop - start)
+        mean[hasMatch] /= n[hasMatch]
+        # Two passes, as in np.std, to avoid cancellation for small scatter
+        # about a large separation.
+        sqDev = np.square(distances - mean[pairIndex])
+        var = np.bincount(pairIndex, weights=sqDev, minlength=stop - start)
+        var[hasMatch] /= n[hasMatch]
+        rmsDistances[start:stop][hasMatch] = np.sqrt(var[hasMatch])
+
     return rmsDistances
 
 
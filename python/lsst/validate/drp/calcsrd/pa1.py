@@ -22,14 +22,22 @@ from __future__ import print_function, absolute_import
 from builtins import range
 
 import math
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-import scipy.stats
 import astropy.units as u
 
 import lsst.pipe.base as pipeBase
 from lsst.validate.base import MeasurementBase
 
+from ..quantiles import interQuartileRange
+from ..util import imapBounded
+
+
+# Number of random realizations of PA1 drawn at once, and from one random
+# stream when seeded.
+_shuffleBatchSize = 10
+
 
 class PA1Measurement(MeasurementBase):
     """Measurement of the PA1 metric: photometric repeatability of
@@ -43,7 +51,24 @@ class PA1Measurement(MeasurementBase):
     filter_name : str
         filter_name (filter name) used in this measurement (e.g., `'r'`)
     numRandomShuffles : int
-        Number of times to draw random pairs from the different observations.
+        Number of times to draw random pairs from the different observations,
+        or the maximum number if ``tolerance`` is given.
+    seed : int, optional
+        Seed of the random shuffles, recorded as a parameter of the
+        measurement.  If `None`, a seed is drawn from `numpy.random`.
+    numKeptShuffles : int, optional
+        Number of random shuffles for which the magnitude differences and
+        mean magnitudes of all the stars are kept in `magDiff` and
+        `magMean`; `rms` and `iqr` are kept for all shuffles.  Default is
+        1, which is what PA2, PF1 and the PA1 plot use, so at least 1 must
+        be kept.  `None` keeps all the shuffles.
+    tolerance : `astropy.units.Quantity` or float, optional
+        If given, stop drawing random shuffles once the standard error of
+        the mean IQR, the PA1 value, is below this (in mmag if a float).
+        The number of shuffles used is recorded as the
+        ``numRandomShuffles`` parameter.
+    numThreads : int, optional
+        Number of threads drawing batches of random shuffles concurrently.
     verbose : bool, optional
         Output additional information on the analysis steps.
     job : :class:`lsst.validate.drp.base.Job`, optional
@@ -62,9 +87,13 @@ class PA1Measurement(MeasurementBase):
     iqr : ndarray
        Photometric repeatability IQR of stellar pairs for each random sample.
     magDiff : ndarray
-        Magnitude differences of stars between visits, for each random sample.
+        Magnitude differences of stars between visits, for each kept random
+        sample.
     magMean : ndarray
-        Mean magnitude of stars seen across visits, for each random sample.
+        Mean magnitude of stars seen across visits, for each kept random
+        sample.
+    keptShuffles : ndarray
+        Indices of the random samples kept in `magDiff` and `magMean`.
 
     See also
     --------
@@ -74,18 +103,39 @@ class PA1Measurement(MeasurementBase):
     """
 
     def __init__(self, metric, matchedDataset, filter_name,
-                 numRandomShuffles=50, verbose=False, job=None,
-                 linkedBlobs=None):
+                 numRandomShuffles=50, seed=None, numKeptShuffles=1, tolerance=None,
+                 numThreads=1, verbose=False, job=None, linkedBlobs=None):
         MeasurementBase.__init__(self)
         self.filter_name = filter_name
         self.metric = metric
 
         # register input parameters for serialization
         # note that matchedDataset is treated as a blob, separately
-        self.register_parameter('numRandomShuffles',
-                                numRandomShuffles,
-                                label='shuffles',
-                                description='Number of random shuffles')
+        if tolerance is not None and not hasattr(tolerance, 'unit'):
+            tolerance = tolerance * u.mmag
+        self.register_parameter('tolerance',
+                                tolerance,
+                                label='tolerance',
+                                description='Standard error of PA1 at which no more random '
+                                            'shuffles are drawn')
+        if seed is None:
+            seed = np.random.randint(2**31)
+        seed = int(seed)
+        self.register_parameter('seed',
+                                seed,
+                                label='seed',
+                                description='Seed of the random shuffles')
+        if numKeptShuffles is None:
+            numKeptShuffles = numRandomShuffles
+        numKeptShuffles = min(int(numKeptShuffles), numRandomShuffles)
+        if numKeptShuffles < 1:
+            raise ValueError('At least one random shuffle must be kept for PA2 and PF1, '
+                             'not numKeptShuffles=%d' % numKeptShuffles)
+        self.register_parameter('numKeptShuffles',
+                                numKeptShuffles,
+                                label='kept shuffles',
+                                description='Number of random shuffles whose magnitude '
+                                            'differences are kept')
 
         # register measurement extras
         self.register_extra(
@@ -104,6 +154,9 @@ class PA1Measurement(MeasurementBase):
             'magMean', label='mag',
             description='Mean magnitude of pairs of stellar sources matched '
                         'across visits, for each random sample.')
+        self.register_extra(
+            'keptShuffles', label='shuffles',
+            description='Indices of the random samples of magDiff and magMean')
 
         self.matchedDataset = matchedDataset
         # Add external blob so that links will be persisted with
@@ -114,32 +167,55 @@ class PA1Measurement(MeasurementBase):
 
         matches = matchedDataset.safeMatches
         magKey = matchedDataset.magKey
-        results = calcPa1(matches, magKey, numRandomShuffles=numRandomShuffles)
+        results = calcPa1(matches, magKey, numRandomShuffles=numRandomShuffles,
+                          seed=seed, numKeptShuffles=numKeptShuffles,
+                          tolerance=tolerance, numThreads=numThreads)
+        self.register_parameter('numRandomShuffles',
+                                len(results['iqr']),
+                                label='shuffles',
+                                description='Number of random shuffles')
+        if verbose and tolerance is not None:
+            print("PA1 used %d random shuffles for a standard error of %s" %
+                  (len(results['iqr']), results['PA1Err']))
         self.rms = results['rms']
         self.iqr = results['iqr']
         self.magDiff = results['magDiff']
         self.magMean = results['magMean']
+        self.keptShuffles = results['keptShuffles'] * u.Unit('')
         self.quantity = results['PA1']
 
         if job:
             job.register_measurement(self)
 
 
-def calcPa1(matches, magKey, numRandomShuffles=50):
+def calcPa1(matches, magKey, numRandomShuffles=50, seed=None, numKeptShuffles=None,
+            tolerance=None, numThreads=1):
     """Calculate the photometric repeatability of measurements across a set
     of randomly selected pairs of visits.
 
     Parameters
     ----------
-    matches : `lsst.afw.table.GroupView`
-        `~lsst.afw.table.GroupView` of stars matched between visits,
-        from MultiMatch, provided by
+    matches : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Stars matched between visits, grouped by object, provided by
         `lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
-    magKey : `lsst.afw.table` schema key
-        Magnitude column key in the ``groupView``.
-        E.g., ``magKey = allMatches.schema.find("base_PsfFlux_mag").key``
-        where ``allMatches`` is the result of
-        `lsst.afw.table.MultiMatch.finish()`.
+    magKey : `str`
+        Magnitude column name in ``matches``,
+        e.g. ``"base_PsfFlux_mag"``.
+    numRandomShuffles : `int`, optional
+        Number of random realizations of the measurement pairs, or the
+        maximum number if ``tolerance`` is given.
+    seed : `int`, optional
+        Seed of the random realizations (see `getRandomDiffsByGroup`).
+        If `None`, the global `numpy.random` state is used.
+    numKeptShuffles : `int`, optional
+        Number of realizations, the first ones, for which ``magDiff`` and
+        ``magMean`` are returned.  Default is all of them.
+    tolerance : `astropy.units.Quantity` or `float`, optional
+        Stop drawing realizations, a batch at a time, once the standard
+        error of ``PA1`` is below this (in mmag if a `float`).
+    numThreads : `int`, optional
+        Number of batches of realizations drawn concurrently.  With a
+        ``seed``, the result does not depend on it.
 
     Returns
     -------
@@ -155,9 +231,13 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
           range of photometric repeatability distribution.
           Shape: ``(nRandomSamples,)``.
         - ``magDiff``: `~astropy.unit.Quantity` array of magnitude differences
-          between pairs of stars. Shape: ``(nRandomSamples, nMatches)``.
+          between pairs of stars. Shape: ``(numKeptShuffles, nMatches)``.
         - ``magMean``: `~astropy.unit.Quantity` array of mean magnitudes of
-          each pair of stars. Shape: ``(nRandomSamples, nMatches)``.
+          each pair of stars. Shape: ``(numKeptShuffles, nMatches)``.
+        - ``keptShuffles``: array of the indices of the realizations of
+          ``magDiff`` and ``magMean``.  Shape: ``(numKeptShuffles,)``.
+        - ``PA1Err``: scalar `~astropy.unit.Quantity` of the standard error
+          of ``PA1`` over the realizations.
 
     Notes
     -----
@@ -165,7 +245,11 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
     realizations of the measurement pairs, to provide some estimate of the
     uncertainty on our RMS estimates due to the random shuffling.  This
     estimate could be stated and calculated from a more formally derived
-    motivation but in practice 50 should be sufficient.
+    motivation but in practice 50 should be sufficient.  The realizations
+    are drawn a batch at a time, so only the differences of the kept
+    realizations are held for all the stars.  With a ``tolerance``, the
+    batches are drawn until the standard error of the mean IQR is below it,
+    which, for large numbers of stars, may take fewer realizations.
 
     The LSST Science Requirements Document (LPM-17), or SRD, characterizes the
     photometric repeatability by putting a requirement on the median RMS of
@@ -199,55 +283,90 @@ def calcPa1(matches, magKey, numRandomShuffles=50):
     example of how to call ``calcPa1`` directly given a Butler output
     repository:
 
-    >>> import lsst.daf.persistence as dafPersist
-    >>> from lsst.afw.table import SourceCatalog, SchemaMapper, Field
-    >>> from lsst.afw.table import MultiMatch, SourceRecord, GroupView
+    >>> from lsst.validate.drp.matchreduce import MatchedMultiVisitDataset
     >>> from lsst.validate.drp.calcsrd.pa1 import calcPa1
     >>> repo = "CFHT/output"
-    >>> butler = dafPersist.Butler(repo)
-    >>> dataset = 'src'
-    >>> schema = butler.get(dataset + "_schema", immediate=True).schema
-    >>> mmatch = MultiMatch(newSchema,
-    >>>                     dataIdFormat={'visit': int, 'ccd': int},
-    >>>                     radius=matchRadius,
-    >>>                     RecordClass=SourceRecord)
-    >>> for vId in visitDataIds:
-    ...     cat = butler.get('src', vId)
-    ...     mmatch.add(catalog=cat, dataId=vId)
-    ...
-    >>> matchCat = mmatch.finish()
-    >>> allMatches = GroupView.build(matchCat)
-    >>> allMatches
-    >>> psfMagKey = allMatches.schema.find("base_PsfFlux_mag").key
-    >>> pa1 = calcPa1(allMatches, psfMagKey)
+    >>> matchedDataset = MatchedMultiVisitDataset(repo, visitDataIds)
+    >>> pa1 = calcPa1(matchedDataset.safeMatches, matchedDataset.magKey)
     """
-    pa1Samples = [calcPa1Sample(matches, magKey)
-                  for n in range(numRandomShuffles)]
-
-    rms = np.array([pa1.rms for pa1 in pa1Samples]) * u.mmag
-    iqr = np.array([pa1.iqr for pa1 in pa1Samples]) * u.mmag
-    magDiff = np.array([pa1.magDiffs for pa1 in pa1Samples]) * u.mmag
-    magMean = np.array([pa1.magMean for pa1 in pa1Samples]) * u.mag
+    if numKeptShuffles is None:
+        numKeptShuffles = numRandomShuffles
+    numKeptShuffles = min(numKeptShuffles, numRandomShuffles)
+    if tolerance is not None and hasattr(tolerance, 'unit'):
+        tolerance = tolerance.to(u.mmag).value
+
+    def drawBatch(first):
+        num = min(_shuffleBatchSize, numRandomShuffles - first)
+        magDiff = (1000/math.sqrt(2)) * getRandomDiffsByGroup(matches, magKey, num, seed=seed,
+                                                              firstShuffle=first)
+        rms, iqr = computeWidths(magDiff, axis=1)
+        return rms, iqr, magDiff[:max(0, numKeptShuffles - first)]
+
+    firstShuffles = range(0, numRandomShuffles, _shuffleBatchSize)
+    if numThreads > 1:
+        # Batches are only submitted as results are consumed, so that
+        # reaching the tolerance stops the drawing.
+        pool = ThreadPool(numThreads)
+        batches = imapBounded(pool, drawBatch, firstShuffles, numThreads)
+    else:
+        pool = None
+        batches = (drawBatch(first) for first in firstShuffles)
+
+    # The batches are checked for convergence in order, so that the
+    # realizations used do not depend on numThreads.
+    rms, iqr = [], []
+    keptDiffs = [np.empty((0, len(matches)))]
+    try:
+        for batchRms, batchIqr, batchDiffs in batches:
+            rms.extend(batchRms)
+            iqr.extend(batchIqr)
+            keptDiffs.append(batchDiffs)
+            if tolerance is not None and _standardError(iqr) < tolerance:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    magDiff = np.concatenate(keptDiffs)
+    magMean = np.tile(matches.mean(magKey), (len(magDiff), 1))
+
+    pa1Err = _standardError(iqr) * u.mmag
+    rms = np.array(rms) * u.mmag
+    iqr = np.array(iqr) * u.mmag
+    magDiff = magDiff * u.mmag
+    magMean = magMean * u.mag
     pa1 = np.mean(iqr)
     return {'rms': rms, 'iqr': iqr, 'magDiff': magDiff, 'magMean': magMean,
-            'PA1': pa1}
+            'keptShuffles': np.arange(len(magDiff)), 'PA1': pa1, 'PA1Err': pa1Err}
+
 
+def _standardError(values):
+    """Standard error of the mean of ``values`` (infinite for fewer than
+    two values)."""
+    if len(values) < 2:
+        return np.inf
+    return np.std(values, ddof=1) / math.sqrt(len(values))
 
-def calcPa1Sample(matches, magKey):
+
+def calcPa1Sample(matches, magKey, seed=None, shuffle=0):
     """Compute one realization of PA1 by randomly sampling pairs of
     visits.
 
     Parameters
     ----------
-    matches : `lsst.afw.table.GroupView`
-        `~lsst.afw.table.GroupView` of stars matched between visits,
-        from MultiMatch, provided by
+    matches : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Stars matched between visits, grouped by object, provided by
         `lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
-    magKey : `lsst.afw.table` schema key
-        Magnitude column key in the ``groupView``.
-        E.g., ``magKey = allMatches.schema.find("base_PsfFlux_mag").key``
-        where ``allMatches`` is the result of
-        `lsst.afw.table.MultiMatch.finish()`.
+    magKey : `str`
+        Magnitude column name in ``matches``,
+        e.g. ``"base_PsfFlux_mag"``.
+    seed : `int`, optional
+        Seed of the random realizations.  If `None`, the global
+        `numpy.random` state is used.
+    shuffle : `int`, optional
+        Index of the realization.  With a given ``seed``, this is the same
+        as realization ``shuffle`` of `calcPa1`.
 
     Returns
     -------
@@ -265,8 +384,7 @@ def calcPa1Sample(matches, magKey):
 
     See also
     --------
-    calcPa1 : A wrapper that repeatedly calls this function to build
-        the PA1 measurement.
+    calcPa1 : Computes all the realizations of the PA1 measurement at once.
 
     Examples
     --------
@@ -275,13 +393,117 @@ def calcPa1Sample(matches, magKey):
     example of how to call ``calcPa1Sample`` directly given a Butler output
     repository:
     """
-    magDiffs = matches.aggregate(getRandomDiffRmsInMmags, field=magKey)
-    magMean = matches.aggregate(np.mean, field=magKey)
+    magDiffs = (1000/math.sqrt(2)) * getRandomDiffsByGroup(matches, magKey, 1, seed=seed,
+                                                           firstShuffle=shuffle)[0]
+    magMean = matches.mean(magKey)
     rmsPA1, iqrPA1 = computeWidths(magDiffs)
     return pipeBase.Struct(rms=rmsPA1, iqr=iqrPA1,
                            magDiffs=magDiffs, magMean=magMean,)
 
 
+def getRandomDiffsByGroup(matches, magKey, numRandomShuffles, seed=None,
+                          firstShuffle=0):
+    """Get the differences between two randomly selected magnitudes of every
+    star, for many random realizations at once.
+
+    Parameters
+    ----------
+    matches : `lsst.validate.drp.groupedarrays.GroupedArrays`
+        Stars matched between visits, grouped by object.
+    magKey : `str`
+        Magnitude column name in ``matches``.
+    numRandomShuffles : `int`
+        Number of random realizations.
+    seed : `int`, optional
+        Seed of the random realizations.  If `None`, the global
+        `numpy.random` state is used.
+    firstShuffle : `int`, optional
+        Index of the first realization, when ``seed`` is given.
+
+    Returns
+    -------
+    magDiffs : `numpy.ndarray`
+        Array of shape ``(numRandomShuffles, len(matches))`` of the
+        difference between two distinct randomly selected magnitudes of each
+        star [mag].  NaN for stars with fewer than two magnitudes.
+
+    Notes
+    -----
+    This draws the same distribution of pairs as `getRandomDiff` applied to
+    each star, without a Python call per star: the first index is drawn
+    uniformly from the ``n`` magnitudes of a star and the second uniformly
+    from the ``n - 1`` others.
+
+    With a ``seed``, the realizations are drawn a batch of
+    ``_shuffleBatchSize`` at a time, each batch from its own random stream
+    (see `shuffleBatchRandomState`), so realizations
+    ``firstShuffle:firstShuffle+numRandomShuffles`` are identical whether
+    they are computed in one call or split across several calls or
+    processes.
+    """
+    mags = matches[magKey]
+    counts = matches.counts
+    starts = matches.offsets[:-1]
+
+    if seed is None:
+        first, second = _drawPairIndices(np.random, counts, numRandomShuffles)
+    else:
+        # Draw the whole batches holding the requested realizations.
+        firstBatch = firstShuffle // _shuffleBatchSize
+        endBatch = -(-(firstShuffle + numRandomShuffles) // _shuffleBatchSize)
+        shape = ((endBatch - firstBatch)*_shuffleBatchSize, len(counts))
+        first = np.empty(shape, dtype=np.int64)
+        second = np.empty(shape, dtype=np.int64)
+        for i, batch in enumerate(range(firstBatch, endBatch)):
+            rows = slice(i*_shuffleBatchSize, (i + 1)*_shuffleBatchSize)
+            first[rows], second[rows] = _drawPairIndices(shuffleBatchRandomState(seed, batch),
+                                                         counts, _shuffleBatchSize)
+        skip = firstShuffle - firstBatch*_shuffleBatchSize
+        first = first[skip:skip + numRandomShuffles]
+        second = second[skip:skip + numRandomShuffles]
+
+    hasPair = counts >= 2
+    magDiffs = np.full((numRandomShuffles, len(matches)), np.nan)
+    firstMags = mags[(starts + first)[:, hasPair]]
+    secondMags = mags[(starts + second)[:, hasPair]]
+    magDiffs[:, hasPair] = firstMags - secondMags
+    return magDiffs
+
+
+def shuffleBatchRandomState(seed, batch):
+    """Independent random stream of one batch of the PA1 shuffles.
+
+    Parameters
+    ----------
+    seed : `int`
+        Seed of all the realizations.
+    batch : `int`
+        Index of the batch, which holds realizations
+        ``batch*_shuffleBatchSize`` to ``(batch + 1)*_shuffleBatchSize - 1``.
+
+    Returns
+    -------
+    random : `numpy.random.RandomState`
+        Generator seeded with the pair ``(seed, batch)``, so that every
+        batch has its own stream, reproducible from ``seed`` alone.
+    """
+    return np.random.RandomState([seed, batch])
+
+
+def _drawPairIndices(random, counts, numRandomShuffles):
+    """Draw two distinct indices within each group of ``counts`` elements,
+    for ``numRandomShuffles`` realizations, from ``random``.
+    """
+    shape = (numRandomShuffles, len(counts))
+    # Scaling a uniform draw in [0, 1) can round up to the upper bound.
+    first = np.floor(random.random_sample(shape) * counts).astype(np.int64)
+    first = np.minimum(first, counts - 1)
+    second = np.floor(random.random_sample(shape) * (counts - 1)).astype(np.int64)
+    second = np.minimum(second, counts - 2)
+    second += (second >= first)
+    return first, second
+
+
 def getRandomDiffRmsInMmags(array):
     """Calculate the RMS difference in mmag between a random pairing of
     visits of a star.
@@ -362,19 +584,23 @@ def getRandomDiff(array):
     return copy[0] - copy[1]
 
 
-def computeWidths(array):
+def computeWidths(array, axis=None):
     """Compute the RMS and the scaled inter-quartile range of an array.
 
     Parameters
     ----------
     array : `list` or `numpy.ndarray`
         Array.
+    axis : `int`, optional
+        Axis along which to compute the widths, e.g. ``1`` for one value
+        per row of a ``(numRandomShuffles, nMatches)`` array.
+        By default the widths of the flattened array are computed.
 
     Returns
     -------
-    rms : `float`
+    rms : `float` or `numpy.ndarray`
         RMS
-    iqr : `float`
+    iqr : `float` or `numpy.ndarray`
         Scaled inter-quartile range (IQR, see *Notes*).
 
     Notes
@@ -387,6 +613,7 @@ def computeWidths(array):
     The IQR is scaled by the IQR/RMS ratio for a Gaussian such that it
     if the array is Gaussian distributed, then the scaled IQR = RMS.
     """
-    rmsSigma = math.sqrt(np.mean(array**2))
-    iqrSigma = np.subtract.reduce(np.percentile(array, [75, 25])) / (scipy.stats.norm.ppf(0.75)*2)
+    array = np.asarray(array)
+    rmsSigma = np.sqrt(np.mean(array**2, axis=axis))
+    iqrSigma = interQuartileRange(array, axis=axis, scaled=True)
     return rmsSigma, iqrSigma
@@ -24,6 +24,8 @@ import numpy as np
 
 from lsst.validate.base import MeasurementBase
 
+from ..quantiles import percentiles
+
 
 class PA2Measurement(MeasurementBase):
     """Measurement of PA2: millimag from median RMS (see PA1) of which
@@ -83,7 +85,7 @@ class PA2Measurement(MeasurementBase):
         magDiffs = pa1.magDiff[0, :]
 
         pf1Percentile = 100. - self.pf1
-        self.quantity = np.percentile(np.abs(magDiffs), pf1Percentile) * magDiffs.unit
+        self.quantity = percentiles(np.abs(magDiffs), pf1Percentile) * magDiffs.unit
 
         if job:
             job.register_measurement(self)
@@ -0,0 +1,375 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Packed, group-sorted column arrays for matched multi-visit sources."""
+
+from __future__ import print_function, absolute_import
+from builtins import object
+from past.builtins import basestring
+
+import numpy as np
+
+
+__all__ = ['GroupedArrays']
+
+
+class GroupedArrays(object):
+    """Flat per-source column arrays sorted by group, with CSR-style
+    group offsets.
+
+    The sources of group ``i`` are the elements
+    ``offsets[i]:offsets[i+1]`` of every column.
+
+    Parameters
+    ----------
+    offsets : `numpy.ndarray` of `int`
+        Group boundaries, of length ``nGroups + 1``, starting at 0.
+    ids : `numpy.ndarray`, optional
+        Identifier (e.g. matched object id) of each group.
+    groupColumns : `dict` of `numpy.ndarray`, optional
+        Per-group values (e.g. mean positions), each of length ``nGroups``.
+        They are carried along by `subset` and `subsetSources`.
+    **columns : `numpy.ndarray`
+        Per-source columns, each of length ``offsets[-1]``.
+    """
+
+    def __init__(self, offsets, ids=None, groupColumns=None, **columns):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = None if ids is None else np.asarray(ids)
+        self.groupColumns = {}
+        if groupColumns is not None:
+            for name, values in groupColumns.items():
+                self.setGroupColumn(name, values)
+        nSources = self.offsets[-1]
+        self._columns = {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            assert len(values) == nSources, \
+                "Column {0} has length {1}, expected {2}".format(name, len(values), nSources)
+            self._columns[name] = values
+        self._groupIndex = None
+
+    @classmethod
+    def fromGroupIds(cls, groupIds, **columns):
+        """Build from unsorted per-source columns and a group id per source.
+
+        Groups are ordered by increasing group id; within a group the
+        input order of the sources is preserved.
+
+        Parameters
+        ----------
+        groupIds : `numpy.ndarray` of `int`
+            Group (e.g. matched object) id of each source.
+        **columns : `numpy.ndarray`
+            Per-source columns, same length as ``groupIds``.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            The packed arrays, with the sorted unique group ids as ``ids``.
+        """
+        groupIds = np.asarray(groupIds)
+        order = np.argsort(groupIds, kind='mergesort')
+        sortedIds = groupIds[order]
+        ids, starts = np.unique(sortedIds, return_index=True)
+        offsets = np.append(starts, len(sortedIds))
+        return cls(offsets, ids=ids,
+                   **{name: np.asarray(values)[order] for name, values in columns.items()})
+
+    @classmethod
+    def fromGroupView(cls, groupView, names):
+        """Pack selected fields of a `lsst.afw.table.GroupView`.
+
+        Parameters
+        ----------
+        groupView : `lsst.afw.table.GroupView`
+            Matched sources grouped by object.
+        names : `list` of `str`
+            Schema field names to extract.  They are used as column names.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            The packed arrays, in the group order of ``groupView``.
+        """
+        keys = [groupView.schema.find(name).key for name in names]
+        counts = [len(group) for group in groupView.groups]
+        offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        columns = {}
+        for name, key in zip(names, keys):
+            values = [group.get(key) for group in groupView.groups]
+            columns[name] = np.concatenate(values) if values else np.array([])
+        return cls(offsets, **columns)
+
+    @classmethod
+    def fromCatalog(cls, catalog, names, groupField='object'):
+        """Pack selected fields of a matched catalog, grouped by object.
+
+        Parameters
+        ----------
+        catalog : `lsst.afw.table.BaseCatalog`
+            Matched catalog, e.g. from `lsst.afw.table.MultiMatch.finish`.
+        names : `list` of `str`
+            Schema field names to extract.  They are used as column names.
+        groupField : `str`, optional
+            Name of the field holding the group (object) id.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            The packed arrays, ordered by object id as in
+            `lsst.afw.table.GroupView`.
+        """
+        if not catalog.isContiguous():
+            catalog = catalog.copy(deep=True)
+        return cls.fromGroupIds(catalog[groupField],
+                                **{name: catalog[name] for name in names})
+
+    @classmethod
+    def concatenate(cls, groupsList):
+        """Concatenate the groups of several `GroupedArrays`.
+
+        Parameters
+        ----------
+        groupsList : `list` of `GroupedArrays`
+            Arrays with the same columns.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            All the groups, in order.  ``ids`` are concatenated if every
+            input has them, and so are the group columns common to every
+            input.
+        """
+        assert len(groupsList) > 0, "Nothing to concatenate"
+        names = groupsList[0].names
+        offsets = [[0]]
+        start = 0
+        for groups in groupsList:
+            assert sorted(groups.names) == sorted(names), "Inconsistent columns"
+            offsets.append(groups.offsets[1:] + start)
+            start += groups.offsets[-1]
+        if all(groups.ids is not None for groups in groupsList):
+            ids = np.concatenate([groups.ids for groups in groupsList])
+        else:
+            ids = None
+        groupColumnNames = set.intersection(*[set(groups.groupColumns) for groups in groupsList])
+        groupColumns = {name: np.concatenate([groups.groupColumns[name] for groups in groupsList])
+                        for name in groupColumnNames}
+        return cls(np.concatenate(offsets), ids=ids, groupColumns=groupColumns,
+                   **{name: np.concatenate([groups[name] for groups in groupsList])
+                      for name in names})
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    @property
+    def names(self):
+        """Names of the columns (`list` of `str`)."""
+        return list(self._columns.keys())
+
+    @property
+    def counts(self):
+        """Number of sources in each group (`numpy.ndarray`)."""
+        return np.diff(self.offsets)
+
+    @property
+    def groupIndex(self):
+        """Index of the group that each source belongs to
+        (`numpy.ndarray`)."""
+        if self._groupIndex is None:
+            self._groupIndex = np.repeat(np.arange(len(self)), self.counts)
+        return self._groupIndex
+
+    def group(self, i, name):
+        """Values of column ``name`` for the sources of group ``i``."""
+        return self._columns[name][self.offsets[i]:self.offsets[i+1]]
+
+    def setGroupColumn(self, name, values):
+        """Attach per-group values, e.g. a cached summary statistic.
+
+        Parameters
+        ----------
+        name : `str`
+            Name of the group column.
+        values : `numpy.ndarray`
+            One value per group.
+        """
+        values = np.asarray(values)
+        assert len(values) == len(self), \
+            "Group column {0} has length {1}, expected {2}".format(name, len(values), len(self))
+        self.groupColumns[name] = values
+
+    def subset(self, groupMask):
+        """Select whole groups.
+
+        Parameters
+        ----------
+        groupMask : `numpy.ndarray` of `bool`
+            Which groups to keep.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            The selected groups, in their original order.
+        """
+        groupMask = np.asarray(groupMask, dtype=bool)
+        sourceMask = np.repeat(groupMask, self.counts)
+        offsets = np.concatenate(([0], np.cumsum(self.counts[groupMask])))
+        ids = None if self.ids is None else self.ids[groupMask]
+        groupColumns = {name: values[groupMask] for name, values in self.groupColumns.items()}
+        return GroupedArrays(offsets, ids=ids, groupColumns=groupColumns,
+                             **{name: values[sourceMask] for name, values in self._columns.items()})
+
+    def subsetSources(self, sourceMask):
+        """Select individual sources, keeping every group (possibly empty).
+
+        Parameters
+        ----------
+        sourceMask : `numpy.ndarray` of `bool`
+            Which sources to keep.
+
+        Returns
+        -------
+        groups : `GroupedArrays`
+            Groups with only the selected sources.
+        """
+        sourceMask = np.asarray(sourceMask, dtype=bool)
+        counts = np.bincount(self.groupIndex, weights=sourceMask, minlength=len(self))
+        offsets = np.concatenate(([0], np.cumsum(counts.astype(np.int64))))
+        return GroupedArrays(offsets, ids=self.ids, groupColumns=self.groupColumns,
+                             **{name: values[sourceMask] for name, values in self._columns.items()})
+
+    def aggregate(self, function, field=None):
+        """Apply a function to each group, as `lsst.afw.table.GroupView`
+        does.
+
+        Parameters
+        ----------
+        function : callable
+            Called once per group.  If ``field`` is `None` it is passed an
+            object with a ``get(name)`` method returning the group's values
+            for column ``name``; otherwise it is passed the group's values
+            of column ``field``.
+        field : `str`, optional
+            Column name.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            Result of ``function`` for each group.
+
+        Notes
+        -----
+        This calls back into Python once per group.  Prefer the vectorized
+        reductions (`sum`, `mean`, `std`, `median`, ...) where possible.
+        """
+        if field is None:
+            return np.array([function(_GroupAccessor(self, i)) for i in range(len(self))])
+        return np.array([function(self.group(i, field)) for i in range(len(self))])
+
+    def _values(self, values):
+        if isinstance(values, basestring):
+            return self._columns[values]
+        return np.asarray(values)
+
+    def sum(self, values):
+        """Sum of ``values`` (a column name or per-source array) in each
+        group."""
+        values = self._values(values).astype(float)
+        return np.bincount(self.groupIndex, weights=values, minlength=len(self))
+
+    def any(self, values):
+        """Whether any of the boolean ``values`` is set in each group."""
+        return self.sum(self._values(values).astype(bool)) > 0
+
+    def all(self, values):
+        """Whether all of the boolean ``values`` are set in each group."""
+        return self.sum(self._values(values).astype(bool)) == self.counts
+
+    def mean(self, values):
+        """Mean of ``values`` in each group (NaN for empty groups)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values) / self.counts
+
+    def std(self, values):
+        """Standard deviation of ``values`` in each group, as `numpy.std`
+        (NaN for empty groups)."""
+        values = self._values(values).astype(float)
+        mean = self.mean(values)
+        # Two passes, as in np.std, to avoid cancellation.
+        sqDev = np.square(values - mean[self.groupIndex])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.sum(sqDev) / self.counts)
+
+    def median(self, values):
+        """Median of ``values`` in each group, as `numpy.median`.
+
+        Groups containing a NaN, and empty groups, have a NaN median.
+        """
+        values = self._values(values).astype(float)
+        order = np.lexsort((values, self.groupIndex))
+        sortedValues = values[order]
+
+        counts = self.counts
+        result = np.full(len(self), np.nan)
+        nonEmpty = counts > 0
+        starts = self.offsets[:-1][nonEmpty]
+        lo = starts + (counts[nonEmpty] - 1) // 2
+        hi = starts + counts[nonEmpty] // 2
+        result[nonEmpty] = (sortedValues[lo] + sortedValues[hi]) / 2
+        result[self.any(np.isnan(values))] = np.nan
+        return result
+
+    def max(self, values):
+        """Maximum of ``values`` in each group (NaN for empty groups)."""
+        return self._reduceNonEmpty(np.maximum, values)
+
+    def min(self, values):
+        """Minimum of ``values`` in each group (NaN for empty groups)."""
+        return self._reduceNonEmpty(np.minimum, values)
+
+    def _reduceNonEmpty(self, ufunc, values):
+        values = self._values(values).astype(float)
+        result = np.full(len(self), np.nan)
+        nonEmpty = self.counts > 0
+        if nonEmpty.any():
+            result[nonEmpty] = ufunc.reduceat(values, self.offsets[:-1][nonEmpty])
+        return result
+
+
+class _GroupAccessor(object):
+    """Catalog-like view of one group of a `GroupedArrays`, for callbacks
+    written against `lsst.afw.table` catalogs."""
+
+    def __init__(self, groups, index):
+        self._groups = groups
+        self._index = index
+
+    def __len__(self):
+        return self._groups.counts[self._index]
+
+    def get(self, name):
+        return self._groups.group(self._index, name)
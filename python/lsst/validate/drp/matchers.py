@@ -0,0 +1,125 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Vectorized matchers of sources across visits, alternatives to
+`lsst.afw.table.MultiMatch`.
+
+A matcher has a ``match(raList, decList)`` method that takes the source
+coordinates of each visit and returns the object id of each source.
+"""
+
+from __future__ import print_function, absolute_import
+from builtins import object
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from .util import raDecToUnitVector
+
+
+__all__ = ['FriendsOfFriendsMatcher', 'matcherRegistry']
+
+
+class FriendsOfFriendsMatcher(object):
+    """Group sources that are linked by chains of pairs closer than the
+    match radius.
+
+    Parameters
+    ----------
+    matchRadius : `lsst.afw.geom.Angle` or `float`
+        Linking length, as an angle or in radians.
+
+    Notes
+    -----
+    Pairs closer than ``matchRadius`` are found with a KD-tree on the unit
+    vectors of all the sources, and objects are the connected components
+    of the graph of those pairs.  Unlike `lsst.afw.table.MultiMatch`, which
+    matches each source to the first source of existing objects, linking
+    is transitive, so objects closer than ``matchRadius`` are merged.
+    """
+
+    name = 'fof'
+
+    def __init__(self, matchRadius):
+        if hasattr(matchRadius, 'asRadians'):
+            matchRadius = matchRadius.asRadians()
+        self.matchRadius = matchRadius
+
+    def match(self, raList, decList):
+        """Match sources across visits.
+
+        Parameters
+        ----------
+        raList, decList : `list` of `numpy.ndarray`
+            RA and Dec of the sources of each visit [radians].
+
+        Returns
+        -------
+        objectIdList : `list` of `numpy.ndarray`
+            Object id of each source of each visit.  Ids are consecutive
+            from 0, in order of the first source of each object.
+            Sources with non-finite coordinates are objects of their own.
+        """
+        sizes = [len(ra) for ra in raList]
+        if sum(sizes) == 0:
+            return [np.array([], dtype=np.int64) for size in sizes]
+        ra = np.concatenate(raList).astype(float)
+        dec = np.concatenate(decList).astype(float)
+        objectIds = self.matchArrays(ra, dec)
+        return np.split(objectIds, np.cumsum(sizes)[:-1])
+
+    def matchArrays(self, ra, dec):
+        """Match sources given as flat arrays.
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray`
+            Coordinates of the sources [radians].
+
+        Returns
+        -------
+        objectIds : `numpy.ndarray` of `int`
+            Object id of each source, see `match`.
+        """
+        numSources = len(ra)
+        finite, = np.where(np.isfinite(ra) & np.isfinite(dec))
+
+        tree = cKDTree(raDecToUnitVector(ra[finite], dec[finite]))
+        chord = 2*np.sin(min(self.matchRadius, np.pi)/2)
+        pairs = tree.query_pairs(chord, output_type='ndarray')
+
+        links = scipy.sparse.coo_matrix(
+            (np.ones(len(pairs), dtype=np.int8), (finite[pairs[:, 0]], finite[pairs[:, 1]])),
+            shape=(numSources, numSources))
+        numObjects, labels = connected_components(links, directed=False)
+
+        # Number the objects in order of their first source.
+        labelIds, firstSource = np.unique(labels, return_index=True)
+        rank = np.empty(numObjects, dtype=np.int64)
+        rank[labelIds[np.argsort(firstSource)]] = np.arange(numObjects)
+        return rank[labels]
+
+
+#: Matchers that `~lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`
+#: can select by name, besides ``'afw'`` (`lsst.afw.table.MultiMatch`).
+matcherRegistry = {
+    FriendsOfFriendsMatcher.name: FriendsOfFriendsMatcher,
+}
@@ -22,20 +22,34 @@ for measurement classes, plotting functions, and JSON persistence.
 """
 
 from __future__ import print_function, absolute_import
+from builtins import zip
+from past.builtins import basestring
+
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
 
 import numpy as np
+from scipy.spatial import cKDTree
 import astropy.units as u
 
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.image.utils as afwImageUtils
 import lsst.daf.persistence as dafPersist
-from lsst.afw.table import (SourceCatalog, SchemaMapper, Field,
-                            MultiMatch, SimpleRecord, GroupView)
+from lsst.afw.table import (SourceCatalog, SourceTable, SchemaMapper, Field,
+                            MultiMatch, SimpleRecord)
 from lsst.afw.fits import FitsError
 from lsst.validate.base import BlobBase
 
-from .util import getCcdKeyName, positionRmsFromCat
+from .cache import MatchedCatalogCache, VisitCatalogCache
+from .groupedarrays import GroupedArrays
+from .matchers import matcherRegistry
+from .reducers import RunningMatchStatistics
+from .tiling import SkyTiling
+from .util import (averageRaDecByGroup, getCcdKeyName, imapBounded, positionRmsByGroup,
+                   raDecToUnitVector)
 
 
 __all__ = ['MatchedMultiVisitDataset']
@@ -59,6 +73,56 @@ class MatchedMultiVisitDataset(BlobBase):
         Radius for matching. Default is 1 arcsecond.
     safeSnr : `float`, optional
         Minimum median SNR for a match to be considered "safe".
+    loadThreads : `int`, optional
+        Number of threads used to read and calibrate the per-visit
+        catalogs concurrently.  Catalogs are still matched in ``dataIds``
+        order, so the result does not depend on this setting.
+        Default is 1 (serial loading).
+    cacheDir : `str`, optional
+        Directory of a `~lsst.validate.drp.cache.VisitCatalogCache` of the
+        calibrated per-visit source columns.  If given, catalogs found in
+        the cache are not read from the repository.
+    matchFile : `str`, optional
+        Path of a `~lsst.validate.drp.cache.MatchedCatalogCache` file.
+        If it holds a match of the same ``repo``, ``dataIds``, input files
+        and ``matchRadius``, the matched sources are read from it instead of
+        being loaded and matched again; otherwise the new match is written
+        to it.  This allows metric parameters to be varied without
+        re-matching.
+    tileSize : `lsst.afw.geom.Angle`, optional
+        If given, match the sources tile by tile over a
+        `~lsst.validate.drp.tiling.SkyTiling` of this size, so that the
+        catalogs and match tables of only one tile are in memory at a time.
+        Sources are spilled to disk per tile (in ``cacheDir``, if given)
+        while the catalogs are read.  Each object is kept by the tile that
+        contains its mean position, and only good matches (see
+        `goodMatches`) are kept; their per-source arrays, which the
+        measurements need, are held for all tiles.  Only supported with
+        the ``'afw'`` matcher.
+    extraFields : `list` of `str`, optional
+        Names of ``src`` fields to carry into the matched arrays, in
+        addition to those used by the reduction.  Other ``src`` fields are
+        not read into the calibrated and matched catalogs.
+    matcher : `str` or matcher, optional
+        Backend used to match the sources across visits: ``'afw'``
+        (`lsst.afw.table.MultiMatch`, the default), the name of a matcher
+        in `~lsst.validate.drp.matchers.matcherRegistry` such as ``'fof'``,
+        or an object with a ``match(raList, decList)`` method like
+        `~lsst.validate.drp.matchers.FriendsOfFriendsMatcher`.  The
+        `lsst.afw.table` catalogs are only needed to read the sources with
+        the latter.
+    incremental : `bool`, optional
+        If ``matchFile`` holds a match of a subset of ``dataIds`` with
+        otherwise the same inputs, load only the sources of the other
+        ``dataIds`` and match them against the persisted objects, instead
+        of matching all the visits again.  Each new source is added to the
+        nearest object whose mean position is within ``matchRadius``, so
+        the objects may differ slightly from those of a full match.
+        The per-object statistics of the reduction are kept as
+        `~lsst.validate.drp.reducers.RunningMatchStatistics`, updated with
+        the new sources only; the median SNR and magnitude error of objects
+        with more than 20 sources are then approximate.  The extended match
+        and the statistics are written back to ``matchFile``.
     verbose : `bool`, optional
         Output additional information on the analysis steps.
 
@@ -79,7 +143,8 @@ class MatchedMultiVisitDataset(BlobBase):
     dist : `astropy.units.Quantity`
         RMS of sky coordinates of stars over multiple visits (milliarcseconds).
     goodMatches
-        all good matches, as an afw.table.GroupView;
+        all good matches, as a
+        `lsst.validate.drp.groupedarrays.GroupedArrays`;
         good matches contain only objects whose detections all have
 
         1. a PSF Flux measurement with S/N > 1
@@ -90,27 +155,57 @@ class MatchedMultiVisitDataset(BlobBase):
         *Not serialized.*
 
     safeMatches
-        safe matches, as an afw.table.GroupView. Safe matches
-        are good matches that are sufficiently bright and sufficiently
-        compact.
+        safe matches, as a `~lsst.validate.drp.groupedarrays.GroupedArrays`.
+        Safe matches are good matches that are sufficiently bright and
+        sufficiently compact.
+
+        The ``groupColumns`` of both ``goodMatches`` and ``safeMatches``
+        hold the mean position of each object, ``'meanRa'`` and
+        ``'meanDec'`` (radians).
 
         *Not serialized.*
     magKey
-        Key for `"base_PsfFlux_mag"` in the `goodMatches` and `safeMatches`
-        catalog tables.
+        Column name of the PSF magnitude, `"base_PsfFlux_mag"`, in the
+        `goodMatches` and `safeMatches` arrays.
 
         *Not serialized.*
     """
 
     name = 'MatchedMultiVisitDataset'
 
+    _flagNames = ["base_PixelFlags_flag_%s" % flag
+                  for flag in ("saturated", "cr", "bad", "edge")]
+    # Per-source fields used by the reduction.  Only these, plus any
+    # ``extraFields``, are read from the ``src`` catalogs.
+    _reducedFieldNames = ['id', 'coord_ra', 'coord_dec',
+                          'base_PsfFlux_flux', 'base_PsfFlux_fluxSigma',
+                          'base_PsfFlux_snr', 'base_PsfFlux_mag',
+                          'base_PsfFlux_magerr',
+                          'base_ClassificationExtendedness_value'] + _flagNames
+
     def __init__(self, repo, dataIds, matchRadius=None, safeSnr=50.,
-                 verbose=False):
+                 loadThreads=1, cacheDir=None, matchFile=None, tileSize=None,
+                 extraFields=None, matcher='afw', incremental=False, verbose=False):
         BlobBase.__init__(self)
 
         self.verbose = verbose
+        self._fieldNames = list(self._reducedFieldNames)
+        for name in extraFields or []:
+            if name not in self._fieldNames:
+                self._fieldNames.append(name)
         if not matchRadius:
             matchRadius = afwGeom.Angle(1, afwGeom.arcseconds)
+        if isinstance(matcher, basestring) and matcher != 'afw':
+            if matcher not in matcherRegistry:
+                raise ValueError("Unknown matcher %r; expected 'afw' or one of %s" %
+                                 (matcher, sorted(matcherRegistry)))
+            matcher = matcherRegistry[matcher](matchRadius)
+        if tileSize is not None and matcher != 'afw':
+            # The tile margin relies on all the sources of an object being
+            # within matchRadius of its first source, which only holds for
+            # MultiMatch: friends-of-friends chains are unbounded.
+            raise ValueError("tileSize is only supported with the 'afw' matcher")
+        self._matcher = matcher
 
         # Extract single filter
         self.register_datum(
@@ -142,15 +237,53 @@ class MatchedMultiVisitDataset(BlobBase):
             label='d',
             description='RMS of sky coordinates of stars over multiple visits')
 
-        # Match catalogs across visits
-        self._matchedCatalog = self._loadAndMatchCatalogs(
-            repo, dataIds, matchRadius)
-        self.magKey = self._matchedCatalog.schema.find("base_PsfFlux_mag").key
+        # Match catalogs across visits, or reuse a persisted match
+        self._matchedCatalog = None
+        statistics = None
+        if matchFile:
+            matchCache = MatchedCatalogCache(matchFile)
+            description = MatchedCatalogCache.makeDescription(
+                dafPersist.Butler(repo), repo, dataIds, matchRadius,
+                tileSize=tileSize, fields=self._fieldNames,
+                matcher=None if matcher == 'afw' else getattr(matcher, 'name',
+                                                              type(matcher).__name__))
+            self._matchedCatalog = matchCache.read(description)
+            if self._matchedCatalog is not None:
+                print("Read matched catalog from %s" % matchFile)
+                statistics = self._readStatistics(matchCache)
+            elif incremental:
+                previous, newInputs = matchCache.readForUpdate(description)
+                if previous is not None:
+                    print("Matching %d new data IDs against %s" % (len(newInputs), matchFile))
+                    statistics = self._readStatistics(matchCache)
+                    if statistics is None:
+                        statistics = RunningMatchStatistics.fromGroups(previous, self._flagNames)
+                    self._matchedCatalog, statistics = self._loadAndExtendMatch(
+                        previous, statistics, repo, [dataIds[i] for i in newInputs],
+                        matchRadius, loadThreads=loadThreads, cacheDir=cacheDir)
+                    matchCache.write(self._matchedCatalog, description,
+                                     statistics=statistics.getState())
+
+        if self._matchedCatalog is None:
+            self._matchedCatalog = self._loadAndMatchCatalogs(
+                repo, dataIds, matchRadius, loadThreads=loadThreads,
+                cacheDir=cacheDir, tileSize=tileSize)
+            if matchFile:
+                matchCache.write(self._matchedCatalog, description)
+        self.magKey = "base_PsfFlux_mag"
         # Reduce catalogs into summary statistics.
         # These are the serialiable attributes of this class.
-        self._reduceStars(self._matchedCatalog, safeSnr)
+        self._reduceStars(self._matchedCatalog, safeSnr, statistics=statistics)
+
+    def _readStatistics(self, matchCache):
+        """Read the running statistics persisted with a match, if any."""
+        state = matchCache.readStatistics()
+        if state is None:
+            return None
+        return RunningMatchStatistics.fromState(state, self._flagNames)
 
-    def _loadAndMatchCatalogs(self, repo, dataIds, matchRadius):
+    def _loadAndMatchCatalogs(self, repo, dataIds, matchRadius, loadThreads=1,
+                              cacheDir=None, tileSize=None):
         """Load data from specific visit. Match with reference.
 
         Parameters
@@ -164,11 +297,81 @@ class MatchedMultiVisitDataset(BlobBase):
             calibration.
         matchRadius :  afwGeom.Angle(), optional
             Radius for matching. Default is 1 arcsecond.
+        loadThreads : int, optional
+            Number of threads used to prefetch and calibrate the catalogs.
+        cacheDir : str, optional
+            Directory of the per-visit catalog cache.
+        tileSize : afwGeom.Angle, optional
+            Match tile by tile over tiles of this size.
 
         Returns
         -------
-        afw.table.GroupView
-            An object of matched catalog.
+        lsst.validate.drp.groupedarrays.GroupedArrays
+            The matched sources, grouped by object.
+        """
+        catalogs, newSchema = self._loadCatalogs(repo, dataIds, loadThreads=loadThreads,
+                                                 cacheDir=cacheDir)
+        ccdKeyName = getCcdKeyName(dataIds[0])
+        names = self._fieldNames + ['visit', ccdKeyName]
+
+        if tileSize is not None:
+            return self._matchCatalogsByTile(catalogs, dataIds, newSchema, ccdKeyName,
+                                             matchRadius, tileSize, names,
+                                             spillDir=cacheDir)
+
+        if self._matcher != 'afw':
+            return self._matchColumns(catalogs, dataIds, ccdKeyName, self._matcher, names)
+
+        return self._matchCatalogs(catalogs, dataIds, newSchema, ccdKeyName,
+                                   matchRadius, names)
+
+    def _loadAndExtendMatch(self, previous, statistics, repo, dataIds, matchRadius,
+                            loadThreads=1, cacheDir=None):
+        """Load the catalogs of new visits and add their sources to a
+        previous match.
+
+        Parameters
+        ----------
+        previous : lsst.validate.drp.groupedarrays.GroupedArrays
+            The previously matched sources, grouped by object.
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics
+            Statistics of the objects of ``previous``.
+        repo : string
+            The repository.
+        dataIds : list of dict
+            `butler` data IDs of the new catalogs.
+        matchRadius : afwGeom.Angle
+            Radius for matching.
+        loadThreads : int, optional
+            Number of threads used to prefetch and calibrate the catalogs.
+        cacheDir : str, optional
+            Directory of the per-visit catalog cache.
+
+        Returns
+        -------
+        matches : lsst.validate.drp.groupedarrays.GroupedArrays
+            The matched sources of the previous and new visits, grouped by
+            object.
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics
+            Statistics of the objects of ``matches``.
+        """
+        if not dataIds:
+            return previous, statistics
+        catalogs = self._loadCatalogs(repo, dataIds, loadThreads=loadThreads,
+                                      cacheDir=cacheDir)[0]
+        return self._extendMatch(previous, statistics, catalogs, dataIds,
+                                 getCcdKeyName(dataIds[0]), matchRadius)
+
+    def _loadCatalogs(self, repo, dataIds, loadThreads=1, cacheDir=None):
+        """Set up the loading of the calibrated catalogs of ``dataIds``.
+
+        Returns
+        -------
+        catalogs : iterator of (int, lsst.afw.table.SourceCatalog or dict)
+            The catalogs, from `_iterCatalogs`.  They are read as the
+            iterator is consumed.
+        newSchema : lsst.afw.table.Schema
+            Schema of the calibrated catalogs.
         """
         # Following
         # https://github.com/lsst/afw/blob/tickets/DM-3896/examples/repeatability.ipynb
@@ -183,131 +386,634 @@ class MatchedMultiVisitDataset(BlobBase):
         ccdKeyName = getCcdKeyName(dataIds[0])
 
         schema = butler.get(dataset + "_schema", immediate=True).schema
+        mapper, newSchema = self._makeSchemaMapper(schema, self._fieldNames)
+
+        cache = VisitCatalogCache(cacheDir) if cacheDir else None
+
+        def loadCatalog(vId):
+            if cache is None:
+                return self._loadCalibratedCatalog(butler, vId, mapper, newSchema)
+
+            key = cache.makeKey(butler, repo, vId, schema, fields=self._fieldNames)
+            columns = cache.get(key)
+            if columns is not None:
+                if self._matcher != 'afw':
+                    # Array matchers only need the columns.
+                    return columns
+                return self._catalogFromColumns(newSchema, columns)
+            tmpCat = self._loadCalibratedCatalog(butler, vId, mapper, newSchema)
+            if tmpCat is not None:
+                cache.put(key, {name: tmpCat[name] for name in self._fieldNames})
+            return tmpCat
+
+        catalogs = self._iterCatalogs(loadCatalog, dataIds, ccdKeyName, loadThreads)
+        return catalogs, newSchema
+
+    @classmethod
+    def _makeSchemaMapper(cls, schema, fieldNames=None):
+        """Make the mapper from the ``src`` schema to the schema of the
+        calibrated catalogs.
+
+        Parameters
+        ----------
+        schema : lsst.afw.table.Schema
+            Schema of the ``src`` catalogs.
+        fieldNames : list of str, optional
+            Fields to keep, in addition to the minimal source schema.
+            Fields that are computed from others (PSF SNR, magnitude and
+            magnitude uncertainty) are ignored.  Defaults to the fields used
+            by the reduction.
+
+        Returns
+        -------
+        mapper : lsst.afw.table.SchemaMapper
+            The mapper.
+        newSchema : lsst.afw.table.Schema
+            Its output schema: the minimal source schema, the ``fieldNames``
+            and additional PSF SNR, magnitude and magnitude uncertainty
+            fields.
+
+        Notes
+        -----
+        A ``src`` schema has hundreds of fields; copying only those that are
+        used keeps the calibrated and matched catalogs small.
+        """
+        if fieldNames is None:
+            fieldNames = cls._reducedFieldNames
+        derivedFieldNames = ('base_PsfFlux_snr', 'base_PsfFlux_mag', 'base_PsfFlux_magerr')
+
         mapper = SchemaMapper(schema)
-        mapper.addMinimalSchema(schema)
+        minimalSchema = SourceTable.makeMinimalSchema()
+        mapper.addMinimalSchema(minimalSchema)
+        minimalNames = set(minimalSchema.getNames())
+        for name in fieldNames:
+            if name not in minimalNames and name not in derivedFieldNames:
+                mapper.addMapping(schema.find(name).key)
         mapper.addOutputField(Field[float]('base_PsfFlux_snr',
                                            'PSF flux SNR'))
         mapper.addOutputField(Field[float]('base_PsfFlux_mag',
                                            'PSF magnitude'))
         mapper.addOutputField(Field[float]('base_PsfFlux_magerr',
                                            'PSF magnitude uncertainty'))
-        newSchema = mapper.getOutputSchema()
+        return mapper, mapper.getOutputSchema()
+
+    @staticmethod
+    def _matchCatalogs(catalogs, dataIds, newSchema, ccdKeyName, matchRadius,
+                       names):
+        """Match calibrated catalogs across visits.
+
+        Parameters
+        ----------
+        catalogs : iterable of (int, lsst.afw.table.SourceCatalog)
+            Index in ``dataIds`` and calibrated catalog, e.g. from
+            `_iterCatalogs`.  Catalogs are only referenced until they have
+            been added to the match.
+        dataIds : list of dict
+            `butler` data IDs of the catalogs.
+        newSchema : lsst.afw.table.Schema
+            Schema of the calibrated catalogs.
+        ccdKeyName : str
+            Name of the CCD key of the data IDs.
+        matchRadius : afwGeom.Angle
+            Radius for matching.
+        names : list of str
+            Fields of the matched catalog to keep.
 
+        Returns
+        -------
+        lsst.validate.drp.groupedarrays.GroupedArrays
+            The matched sources, grouped by object.
+        """
         # Create an object that matches multiple catalogs with same schema
         mmatch = MultiMatch(newSchema,
                             dataIdFormat={'visit': np.int32, ccdKeyName: np.int32},
                             radius=matchRadius,
                             RecordClass=SimpleRecord)
 
-        # create the new extented source catalog
-        srcVis = SourceCatalog(newSchema)
-
-        for vId in dataIds:
-            try:
-                calexpMetadata = butler.get("calexp_md", vId, immediate=True)
-            except (FitsError, dafPersist.NoResults) as e:
-                print(e)
-                print("Could not open calibrated image file for ", vId)
-                print("Skipping %s " % repr(vId))
-                continue
-            except TypeError as te:
-                # DECam images that haven't been properly reformatted
-                # can trigger a TypeError because of a residual FITS header
-                # LTV2 which is a float instead of the expected integer.
-                # This generates an error of the form:
-                #
-                # lsst::pex::exceptions::TypeError: 'LTV2 has mismatched type'
-                #
-                # See, e.g., DM-2957 for details.
-                print(te)
-                print("Calibration image header information malformed.")
-                print("Skipping %s " % repr(vId))
-                continue
-
-            calib = afwImage.Calib(calexpMetadata)
-
-            oldSrc = butler.get('src', vId, immediate=True)
-            print(len(oldSrc), "sources in ccd %s  visit %s" %
-                  (vId[ccdKeyName], vId["visit"]))
-
-            # create temporary catalog
-            tmpCat = SourceCatalog(SourceCatalog(newSchema).table)
-            tmpCat.extend(oldSrc, mapper=mapper)
-            tmpCat['base_PsfFlux_snr'][:] = tmpCat['base_PsfFlux_flux'] \
-                / tmpCat['base_PsfFlux_fluxSigma']
-            with afwImageUtils.CalibNoThrow():
-                _ = calib.getMagnitude(tmpCat['base_PsfFlux_flux'],
-                                       tmpCat['base_PsfFlux_fluxSigma'])
-                tmpCat['base_PsfFlux_mag'][:] = _[0]
-                tmpCat['base_PsfFlux_magerr'][:] = _[1]
-
-            srcVis.extend(tmpCat, False)
-            mmatch.add(catalog=tmpCat, dataId=vId)
+        # MultiMatch copies the records it is given, so each visit catalog
+        # can be released as soon as it has been added.
+        for index, tmpCat in catalogs:
+            mmatch.add(catalog=tmpCat, dataId=dataIds[index])
 
         # Complete the match, returning a catalog that includes
         # all matched sources with object IDs that can be used to group them.
         matchCat = mmatch.finish()
 
-        # Create a mapping object that allows the matches to be manipulated
-        # as a mapping of object ID to catalog of sources.
-        allMatches = GroupView.build(matchCat)
+        # Pack the columns used by the reduction into flat arrays
+        # sorted by object.
+        allMatches = GroupedArrays.fromCatalog(matchCat, names)
 
         return allMatches
 
-    def _reduceStars(self, allMatches, safeSnr=50.0):
-        """Calculate summary statistics for each star. These are persisted
-        as object attributes.
+    @staticmethod
+    def _matchColumns(catalogs, dataIds, ccdKeyName, matcher, names):
+        """Match calibrated catalogs across visits with an array matcher.
 
         Parameters
         ----------
-        allMatches : afw.table.GroupView
-            GroupView object with matches.
-        safeSnr : float, optional
-            Minimum median SNR for a match to be considered "safe".
+        catalogs : iterable of (int, lsst.afw.table.SourceCatalog or dict)
+            Index in ``dataIds`` and calibrated catalog or cached columns,
+            e.g. from `_iterCatalogs`.
+        dataIds : list of dict
+            `butler` data IDs of the catalogs.
+        ccdKeyName : str
+            Name of the CCD key of the data IDs.
+        matcher : object
+            Matcher with a ``match(raList, decList)`` method, e.g.
+            `~lsst.validate.drp.matchers.FriendsOfFriendsMatcher`.
+        names : list of str
+            Fields to keep, including ``'visit'`` and ``ccdKeyName``.
+
+        Returns
+        -------
+        lsst.validate.drp.groupedarrays.GroupedArrays
+            The matched sources, grouped by object.
+        """
+        visitColumns = []
+        for index, tmpCat in catalogs:
+            # Copy the columns so that the catalog can be released.
+            columns = {name: np.array(tmpCat[name]) for name in names
+                       if name not in ('visit', ccdKeyName)}
+            nSources = len(columns['id'])
+            for key in ('visit', ccdKeyName):
+                columns[key] = np.full(nSources, dataIds[index][key], dtype=np.int32)
+            visitColumns.append(columns)
+
+        if not visitColumns:
+            return GroupedArrays([0], **{name: np.array([]) for name in names})
+
+        objectIds = matcher.match([columns['coord_ra'] for columns in visitColumns],
+                                  [columns['coord_dec'] for columns in visitColumns])
+        return GroupedArrays.fromGroupIds(
+            np.concatenate(objectIds),
+            **{name: np.concatenate([columns[name] for columns in visitColumns])
+               for name in names})
+
+    @staticmethod
+    def _extendMatch(previous, statistics, catalogs, dataIds, ccdKeyName, matchRadius):
+        """Add the sources of new catalogs to a previous match.
+
+        Parameters
+        ----------
+        previous : lsst.validate.drp.groupedarrays.GroupedArrays
+            The previously matched sources, grouped by object.
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics
+            Statistics of the objects of ``previous``.  Updated in place with
+            the new sources.
+        catalogs : iterable of (int, lsst.afw.table.SourceCatalog or dict)
+            Index in ``dataIds`` and calibrated catalog or cached columns
+            of the new visits.
+        dataIds : list of dict
+            `butler` data IDs of the new catalogs.
+        ccdKeyName : str
+            Name of the CCD key of the data IDs.
+        matchRadius : afwGeom.Angle
+            Radius for matching.
+
+        Returns
+        -------
+        matches : lsst.validate.drp.groupedarrays.GroupedArrays
+            The matched sources, grouped by object.
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics
+            Statistics of the objects of ``matches``, in the same order.
+
+        Notes
+        -----
+        As in `lsst.afw.table.MultiMatch`, each source is matched to the
+        nearest object within ``matchRadius``, at most one source per
+        catalog is matched to an object, and unmatched sources start new
+        objects that the following catalogs are matched against.  Objects
+        are located at the mean position of the sources of the previous
+        match and of the catalogs before.
         """
+        names = previous.names
+        chord = 2*np.sin(matchRadius.asRadians()/2)
+
+        objectIds = (previous.ids if previous.ids is not None
+                     else np.arange(len(previous)))
+        nextId = objectIds.max() + 1 if len(objectIds) else 0
+        sourceIds = [np.repeat(objectIds, previous.counts)]
+        newColumns = []
+        for index, tmpCat in catalogs:
+            columns = {name: np.array(tmpCat[name]) for name in names
+                       if name not in ('visit', ccdKeyName)}
+            nSources = len(columns['id'])
+            for key in ('visit', ccdKeyName):
+                columns[key] = np.full(nSources, dataIds[index][key], dtype=np.int32)
+            ra, dec = columns['coord_ra'], columns['coord_dec']
+            objectRa, objectDec = statistics.positions.meanRaDec()
+
+            distance = np.full(nSources, np.inf)
+            nearest = np.zeros(nSources, dtype=int)
+            finite = np.isfinite(ra) & np.isfinite(dec)
+            usable = np.isfinite(objectRa) & np.isfinite(objectDec)
+            if usable.any() and finite.any():
+                usableIndex = np.flatnonzero(usable)
+                tree = cKDTree(raDecToUnitVector(objectRa[usable], objectDec[usable]))
+                distance[finite], found = tree.query(raDecToUnitVector(ra[finite], dec[finite]),
+                                                     distance_upper_bound=chord)
+                matched = np.isfinite(distance[finite])
+                nearest[np.flatnonzero(finite)[matched]] = usableIndex[found[matched]]
+
+            # Keep the closest source of this catalog for each object.
+            isMatched = np.isfinite(distance)
+            byDistance = np.flatnonzero(isMatched)[np.argsort(distance[isMatched],
+                                                              kind='mergesort')]
+            closest = byDistance[np.unique(nearest[byDistance], return_index=True)[1]]
+            isMatched[:] = False
+            isMatched[closest] = True
+
+            numNew = nSources - isMatched.sum()
+            objectIndex = np.empty(nSources, dtype=int)
+            objectIndex[isMatched] = nearest[isMatched]
+            objectIndex[~isMatched] = np.arange(len(objectIds), len(objectIds) + numNew)
+            statistics.extend(numNew)
+            statistics.update(objectIndex, columns)
+
+            objectIds = np.append(objectIds, np.arange(nextId, nextId + numNew))
+            nextId += numNew
+            sourceIds.append(objectIds[objectIndex])
+            newColumns.append(columns)
+
+        matches = GroupedArrays.fromGroupIds(
+            np.concatenate(sourceIds),
+            **{name: np.concatenate([previous[name]] + [columns[name] for columns in newColumns])
+               for name in names})
+        # The groups are ordered by id.
+        return matches, statistics.take(np.argsort(objectIds, kind='mergesort'))
+
+    @staticmethod
+    def _iterCatalogs(loadCatalog, dataIds, ccdKeyName, loadThreads=1):
+        """Load the calibrated catalog of each data ID, in order.
+
+        Yields
+        ------
+        index : int
+            Index of the data ID in ``dataIds``.
+        tmpCat : lsst.afw.table.SourceCatalog or dict of numpy.ndarray
+            Its calibrated catalog, or cached columns.  Data IDs that could
+            not be loaded are skipped.
+        """
+        # CalibNoThrow toggles a global flag; holding it around all of the
+        # loading keeps the per-thread enter/exit pairs from re-enabling
+        # exceptions while another thread is still calibrating.
+        with afwImageUtils.CalibNoThrow():
+            # Catalogs may be read concurrently, but they are returned in
+            # `dataIds` order so that the match is deterministic, and at
+            # most `loadThreads` are read ahead of the consumer.
+            if loadThreads > 1:
+                pool = ThreadPool(loadThreads)
+                catalogs = imapBounded(pool, loadCatalog, dataIds, loadThreads)
+            else:
+                pool = None
+                catalogs = (loadCatalog(vId) for vId in dataIds)
+
+            try:
+                for index, (vId, tmpCat) in enumerate(zip(dataIds, catalogs)):
+                    if tmpCat is None:
+                        continue
+                    print(len(tmpCat['id']), "sources in ccd %s  visit %s" %
+                          (vId[ccdKeyName], vId["visit"]))
+                    yield index, tmpCat
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+
+    def _matchCatalogsByTile(self, catalogs, dataIds, newSchema, ccdKeyName,
+                             matchRadius, tileSize, names, spillDir=None):
+        """Match catalogs tile by tile, keeping only good matches.
+
+        Parameters
+        ----------
+        catalogs : iterable of (int, lsst.afw.table.SourceCatalog)
+            Index in ``dataIds`` and calibrated catalog, from
+            `_iterCatalogs`.
+        dataIds : list of dict
+            `butler` data IDs of the catalogs.
+        newSchema : lsst.afw.table.Schema
+            Schema of the calibrated catalogs.
+        ccdKeyName : str
+            Name of the CCD key of the data IDs.
+        matchRadius : afwGeom.Angle
+            Radius for matching.
+        tileSize : afwGeom.Angle
+            Minimum size of the tiles.
+        names : list of str
+            Fields of the matched catalog to keep.
+        spillDir : str, optional
+            Directory in which to spill the sources of each tile while the
+            catalogs are read.  Defaults to the system temporary directory.
+
+        Returns
+        -------
+        lsst.validate.drp.groupedarrays.GroupedArrays
+            The good matched sources of all tiles, grouped by object.
+
+        Notes
+        -----
+        With `lsst.afw.table.MultiMatch`, the sources of a matched object
+        are all within ``matchRadius`` of its first source, hence within
+        twice ``matchRadius`` of its mean position.  With tiles overlapping
+        by that margin, every object is matched entirely within the tile
+        containing its mean position, which is the only tile that keeps it.
+        This does not hold for friends-of-friends matching, whose groups
+        can extend arbitrarily far.
+
+        Only the matching is bounded by the size of a tile: the good
+        matches of every tile are concatenated into the result.
+        """
+        tiling = SkyTiling(tileSize.asRadians(), margin=2*matchRadius.asRadians())
+        if spillDir and not os.path.isdir(spillDir):
+            os.makedirs(spillDir)
+        spill = tempfile.mkdtemp(prefix='matchTiles', dir=spillDir or None)
+
+        def spillPath(tile, index):
+            return os.path.join(spill, '%d_%d.npz' % (tile, index))
+
+        try:
+            # Spill the sources of each catalog to the tiles they overlap,
+            # so that only one catalog is held in memory at a time.
+            tileCatalogs = {}
+            for index, tmpCat in catalogs:
+                if isinstance(tmpCat, SourceCatalog) and not tmpCat.isContiguous():
+                    tmpCat = tmpCat.copy(deep=True)
+                columns = {name: tmpCat[name] for name in self._fieldNames}
+                tiles, sources = tiling.tilesWithMargin(columns['coord_ra'],
+                                                        columns['coord_dec'])
+                if len(tiles) == 0:
+                    continue
+                tileStarts = np.flatnonzero(np.concatenate(([True], tiles[1:] != tiles[:-1])))
+                tileEnds = np.append(tileStarts[1:], len(tiles))
+                for start, end in zip(tileStarts, tileEnds):
+                    tile = int(tiles[start])
+                    selected = sources[start:end]
+                    np.savez(spillPath(tile, index),
+                             **{name: values[selected] for name, values in columns.items()})
+                    tileCatalogs.setdefault(tile, []).append(index)
+                del tmpCat, columns
+
+            tileMatches = []
+            for tile in sorted(tileCatalogs):
+                tileColumns = ((index, self._readSpill(spillPath(tile, index)))
+                               for index in tileCatalogs[tile])
+                tileSourceCatalogs = ((index, self._catalogFromColumns(newSchema, columns))
+                                      for index, columns in tileColumns)
+                matches = self._matchCatalogs(tileSourceCatalogs, dataIds, newSchema,
+                                              ccdKeyName, matchRadius, names)
+
+                meanRa, meanDec = averageRaDecByGroup(matches['coord_ra'],
+                                                      matches['coord_dec'],
+                                                      matches.offsets)
+                isGood = self._selectGoodMatches(matches)[0]
+                isInTile = tiling.tileIndex(meanRa, meanDec) == tile
+                tileMatches.append(matches.subset(isGood & isInTile))
+                if self.verbose:
+                    print("Tile %d: %d good objects" % (tile, len(tileMatches[-1])))
+        finally:
+            shutil.rmtree(spill, ignore_errors=True)
+
+        if not tileMatches:
+            return GroupedArrays([0], **{name: np.array([]) for name in names})
+
+        allMatches = GroupedArrays.concatenate(tileMatches)
+        # Object ids are only unique within a tile.
+        allMatches.ids = np.arange(1, len(allMatches) + 1)
+        return allMatches
+
+    @staticmethod
+    def _readSpill(path):
+        """Read and remove the columns spilled to ``path``."""
+        with np.load(path) as data:
+            columns = {name: data[name] for name in data.files}
+        os.remove(path)
+        return columns
+
+    def _loadCalibratedCatalog(self, butler, vId, mapper, newSchema):
+        """Load the source catalog of one visit and compute calibrated
+        PSF magnitudes.
+
+        Parameters
+        ----------
+        butler : lsst.daf.persistence.Butler
+            Butler of the repository.
+        vId : dict
+            `butler` data ID of the catalog.
+        mapper : lsst.afw.table.SchemaMapper
+            Mapper from the `src` schema to ``newSchema``.
+        newSchema : lsst.afw.table.Schema
+            Schema with additional PSF SNR, magnitude and magnitude
+            uncertainty fields.
+
+        Returns
+        -------
+        lsst.afw.table.SourceCatalog or None
+            The extended catalog, or `None` if the calibrated image
+            metadata could not be read.
+        """
+        try:
+            calexpMetadata = butler.get("calexp_md", vId, immediate=True)
+        except (FitsError, dafPersist.NoResults) as e:
+            print(e)
+            print("Could not open calibrated image file for ", vId)
+            print("Skipping %s " % repr(vId))
+            return None
+        except TypeError as te:
+            # DECam images that haven't been properly reformatted
+            # can trigger a TypeError because of a residual FITS header
+            # LTV2 which is a float instead of the expected integer.
+            # This generates an error of the form:
+            #
+            # lsst::pex::exceptions::TypeError: 'LTV2 has mismatched type'
+            #
+            # See, e.g., DM-2957 for details.
+            print(te)
+            print("Calibration image header information malformed.")
+            print("Skipping %s " % repr(vId))
+            return None
+
+        calib = afwImage.Calib(calexpMetadata)
+
+        oldSrc = butler.get('src', vId, immediate=True)
+
+        return self._calibrateCatalog(oldSrc, calib, mapper, newSchema)
+
+    @staticmethod
+    def _calibrateCatalog(oldSrc, calib, mapper, newSchema):
+        """Copy a source catalog to the calibrated schema and compute PSF
+        SNR and calibrated magnitudes.
+
+        Parameters
+        ----------
+        oldSrc : lsst.afw.table.SourceCatalog
+            The ``src`` catalog.
+        calib : lsst.afw.image.Calib
+            Photometric calibration of the visit.
+        mapper : lsst.afw.table.SchemaMapper
+            Mapper from the ``src`` schema to ``newSchema``.
+        newSchema : lsst.afw.table.Schema
+            Schema with additional PSF SNR, magnitude and magnitude
+            uncertainty fields.
+
+        Returns
+        -------
+        lsst.afw.table.SourceCatalog
+            The extended catalog, contiguous in memory.
+        """
+        # Allocate the output records once, in a single block, and fill
+        # the derived columns in place.
+        tmpCat = SourceCatalog(SourceCatalog(newSchema).table)
+        tmpCat.reserve(len(oldSrc))
+        tmpCat.extend(oldSrc, mapper=mapper)
+
+        flux = tmpCat['base_PsfFlux_flux']
+        fluxSigma = tmpCat['base_PsfFlux_fluxSigma']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(flux, fluxSigma, out=tmpCat['base_PsfFlux_snr'])
+        with afwImageUtils.CalibNoThrow():
+            mag, magErr = calib.getMagnitude(flux, fluxSigma)
+        tmpCat['base_PsfFlux_mag'][:] = mag
+        tmpCat['base_PsfFlux_magerr'][:] = magErr
+
+        return tmpCat
+
+    @staticmethod
+    def _catalogFromColumns(newSchema, columns):
+        """Rebuild an extended source catalog from cached columns.
+
+        Parameters
+        ----------
+        newSchema : lsst.afw.table.Schema
+            Schema of the extended catalog.
+        columns : dict of numpy.ndarray
+            Per-source values of a subset of the fields of ``newSchema``.
+
+        Returns
+        -------
+        lsst.afw.table.SourceCatalog
+            Contiguous catalog in which only the fields in ``columns``
+            are set.
+        """
+        # Allocate all the records in a single block, then set whole
+        # columns; flag columns are packed into their bit fields by the
+        # column view.
+        tmpCat = SourceCatalog(newSchema)
+        tmpCat.resize(len(columns['id']))
+        for name, values in columns.items():
+            tmpCat[name] = values
+
+        return tmpCat
+
+    def _selectGoodMatches(self, allMatches, statistics=None):
+        """Select the objects with at least 2 sources, good flags, finite
+        magnitudes and sufficient SNR.
+
+        Parameters
+        ----------
+        allMatches : lsst.validate.drp.groupedarrays.GroupedArrays
+            Matched sources, grouped by object.
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics, optional
+            Statistics of the objects of ``allMatches``, used instead of
+            reducing the sources.
+
+        Returns
+        -------
+        isGood : numpy.ndarray of bool
+            Whether each object is a good match.
+        medianSnr : numpy.ndarray of float
+            Median PSF SNR of each object.
+        """
+        snrKey = "base_PsfFlux_snr"
+        magKey = "base_PsfFlux_mag"
+
         # Filter down to matches with at least 2 sources and good flags
-        flagKeys = [allMatches.schema.find("base_PixelFlags_flag_%s" % flag).key
-                    for flag in ("saturated", "cr", "bad", "edge")]
         nMatchesRequired = 2
-
-        psfSnrKey = allMatches.schema.find("base_PsfFlux_snr").key
-        psfMagKey = allMatches.schema.find("base_PsfFlux_mag").key
-        psfMagErrKey = allMatches.schema.find("base_PsfFlux_magerr").key
-        extendedKey = allMatches.schema.find("base_ClassificationExtendedness_value").key
-
-        def goodFilter(cat, goodSnr=3):
-            if len(cat) < nMatchesRequired:
-                return False
-            for flagKey in flagKeys:
-                if cat.get(flagKey).any():
-                    return False
-            if not np.isfinite(cat.get(psfMagKey)).all():
-                return False
-            psfSnr = np.median(cat.get(psfSnrKey))
+        goodSnr = 3
+
+        if statistics is None:
+            flagged = np.zeros(allMatches.offsets[-1], dtype=bool)
+            for flagName in self._flagNames:
+                flagged |= allMatches[flagName]
+            counts = allMatches.counts
+            isUnflagged = ~allMatches.any(flagged)
+            hasFiniteMags = allMatches.all(np.isfinite(allMatches[magKey]))
+            medianSnr = allMatches.median(snrKey)
+        else:
+            counts = statistics.count
+            isUnflagged = ~statistics.flagged
+            hasFiniteMags = statistics.allFiniteMag
+            medianSnr = statistics.snr.value
+
+        with np.errstate(invalid='ignore'):
             # Note that this also implicitly checks for psfSnr being non-nan.
-            return psfSnr >= goodSnr
+            hasSources = counts >= nMatchesRequired
+            isGood = hasSources & isUnflagged & hasFiniteMags & (medianSnr >= goodSnr)
+
+        return isGood, medianSnr
+
+    def _reduceStars(self, allMatches, safeSnr=50.0, statistics=None):
+        """Calculate summary statistics for each star. These are persisted
+        as object attributes.
 
-        goodMatches = allMatches.where(goodFilter)
+        Parameters
+        ----------
+        allMatches : lsst.validate.drp.groupedarrays.GroupedArrays
+            Matched sources, grouped by object.
+        safeSnr : float, optional
+            Minimum median SNR for a match to be considered "safe".
+        statistics : lsst.validate.drp.reducers.RunningMatchStatistics, optional
+            Running statistics of the objects of ``allMatches``, used instead
+            of reducing the sources.
+        """
+        magKey = "base_PsfFlux_mag"
+        magErrKey = "base_PsfFlux_magerr"
+        extendedKey = "base_ClassificationExtendedness_value"
+
+        isGood, medianSnr = self._selectGoodMatches(allMatches, statistics)
+
+        goodMatches = allMatches.subset(isGood)
+
+        # Mean positions are shared by the reduction and the astrometric
+        # measurements, so compute them once here.
+        if statistics is None:
+            meanRa, meanDec = averageRaDecByGroup(goodMatches['coord_ra'],
+                                                  goodMatches['coord_dec'],
+                                                  goodMatches.offsets)
+            maxExtended = goodMatches.max(extendedKey)
+            mag = goodMatches.mean(magKey)
+            magrms = goodMatches.std(magKey)
+            magerr = goodMatches.median(magErrKey)
+            dist = positionRmsByGroup(goodMatches['coord_ra'],
+                                      goodMatches['coord_dec'],
+                                      goodMatches.offsets,
+                                      ra_avg=meanRa,
+                                      dec_avg=meanDec)
+        else:
+            goodStatistics = statistics.take(isGood)
+            meanRa, meanDec = goodStatistics.positions.meanRaDec()
+            maxExtended = goodStatistics.maxExtendedness
+            mag = goodStatistics.mag.mean
+            magrms = goodStatistics.mag.std()
+            magerr = goodStatistics.magErr.value
+            dist = afwGeom.radToMas(goodStatistics.positions.rms)
+        goodMatches.setGroupColumn('meanRa', meanRa)
+        goodMatches.setGroupColumn('meanDec', meanDec)
 
         # Filter further to a limited range in S/N and extendedness
         # to select bright stars.
         safeMaxExtended = 1.0
 
-        def safeFilter(cat):
-            psfSnr = np.median(cat.get(psfSnrKey))
-            extended = np.max(cat.get(extendedKey))
-            return psfSnr >= safeSnr and extended < safeMaxExtended
-
-        safeMatches = goodMatches.where(safeFilter)
-
-        # Pass field=psfMagKey so np.mean just gets that as its input
-        self.snr = goodMatches.aggregate(np.median, field=psfSnrKey) * u.Unit('')
-        self.mag = goodMatches.aggregate(np.mean, field=psfMagKey) * u.mag
-        self.magrms = goodMatches.aggregate(np.std, field=psfMagKey) * u.mag
-        self.magerr = goodMatches.aggregate(np.median, field=psfMagErrKey) * u.mag
-        # positionRmsFromCat knows how to query a group
-        # so we give it the whole thing by going with the default `field=None`.
-        self.dist = goodMatches.aggregate(positionRmsFromCat) * u.milliarcsecond
+        with np.errstate(invalid='ignore'):
+            isPointLike = maxExtended < safeMaxExtended
+            isSafe = (medianSnr[isGood] >= safeSnr) & isPointLike
+
+        safeMatches = goodMatches.subset(isSafe)
+
+        self.snr = medianSnr[isGood] * u.Unit('')
+        self.mag = mag * u.mag
+        self.magrms = magrms * u.mag
+        self.magerr = magerr * u.mag
+        self.dist = dist * u.milliarcsecond
 
         # These attributes are not serialized
         self.goodMatches = goodMatches
@@ -0,0 +1,514 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""JSON persistence of jobs, with large arrays in a binary sidecar file.
+
+A job serialized with `writeJobJson` and ``sidecar=True`` is written as a
+JSON manifest, identical to the JSON of `lsst.validate.base.Job.write_json`
+except that each large numeric list (e.g. the per-object ``mag`` of
+`~lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`, or the
+``magDiff`` of PA1) is replaced by a reference to an array of a ``.npz``
+file next to it.  `readJson` reads either form, returning the arrays of
+the sidecar file as `numpy.ndarray`.
+
+`writeJsonStream` writes the same document one blob or measurement at a
+time, so that the JSON of the whole job is never held in memory.
+
+`LazyJob` reads a job without deserializing its blobs and measurement
+extras until they are used.  The JSON of the blobs written by
+`writeJsonStream` is not even parsed until then.
+"""
+
+from __future__ import print_function, absolute_import
+from builtins import object, range, zip
+from past.builtins import basestring
+
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from lsst.validate.base import Job
+
+
+__all__ = ['writeJobJson', 'writeJson', 'writeJsonStream', 'readJson', 'resolveSidecar',
+           'sidecarFilename', 'LazyJob']
+
+# Key of the manifest naming the sidecar file, key of the objects
+# replacing arrays, and key of the byte ranges of the blobs and
+# measurements written by `writeJsonStream`.
+_sidecarKey = 'sidecarFile'
+_arrayKey = 'sidecarArray'
+_indexKey = 'itemIndex'
+
+
+def sidecarFilename(filepath):
+    """Name of the ``.npz`` sidecar file of the JSON file ``filepath``."""
+    return os.path.splitext(filepath)[0] + '.npz'
+
+
+def writeJobJson(job, filepath, sidecar=False, minSize=100):
+    """Write a job to a JSON file.
+
+    Parameters
+    ----------
+    job : `lsst.validate.base.Job`
+        The job.
+    filepath : `str`
+        Name of the JSON file.
+    sidecar : `bool`, optional
+        Write the numeric arrays with at least ``minSize`` elements to a
+        ``.npz`` sidecar file, see `sidecarFilename`, instead of the JSON.
+        Otherwise, this is `lsst.validate.base.Job.write_json`.
+    minSize : `int`, optional
+        Minimum number of elements of the arrays to move to the sidecar.
+    """
+    if not sidecar:
+        job.write_json(filepath)
+        return
+    writeJson(job.json, filepath, minSize=minSize)
+
+
+def writeJson(jsonData, filepath, minSize=100):
+    """Write JSON data, with its large numeric arrays in a sidecar file.
+
+    Parameters
+    ----------
+    jsonData : `dict`
+        JSON-serializable data.  It is not modified.
+    filepath : `str`
+        Name of the JSON file.
+    minSize : `int`, optional
+        Minimum number of elements of the arrays to move to the sidecar.
+    """
+    arrays = {}
+    manifest = _extractArrays(jsonData, arrays, minSize)
+    npzPath = sidecarFilename(filepath)
+    if arrays:
+        manifest[_sidecarKey] = os.path.basename(npzPath)
+        np.savez(npzPath, **arrays)
+    elif os.path.exists(npzPath):
+        # Do not leave the sidecar of a previous run next to the new JSON.
+        os.remove(npzPath)
+
+    with open(filepath, 'w') as outfile:
+        json.dump(manifest, outfile, sort_keys=True, indent=2)
+
+
+def writeJsonStream(filepath, blobs, measurements, sidecar=False, minSize=100):
+    """Write the JSON of a job one blob and measurement at a time.
+
+    The document has the structure of `lsst.validate.base.Job.json`, and
+    is read by `readJson` and ``load_json_output``.  Only the JSON of one
+    blob or measurement is held in memory at a time, and it is written
+    without indentation.  The byte range of each blob and measurement, and
+    of the extras of each measurement, and the identifier of each blob are
+    recorded at the end of the document, so that `LazyJob` can parse them
+    one at a time.
+
+    Parameters
+    ----------
+    filepath : `str`
+        Name of the JSON file.
+    blobs : iterable of `lsst.validate.base.BlobBase`
+        The blobs of the job, including those linked to the measurements.
+    measurements : iterable of `lsst.validate.base.MeasurementBase`
+        The measurements of the job.
+    sidecar : `bool`, optional
+        Write the numeric arrays with at least ``minSize`` elements to a
+        ``.npz`` sidecar file, see `sidecarFilename`, one at a time.
+    minSize : `int`, optional
+        Minimum number of elements of the arrays to move to the sidecar.
+    """
+    npzPath = sidecarFilename(filepath)
+    arrays = _SidecarWriter(npzPath) if sidecar else None
+    try:
+        with open(filepath, 'w') as outfile:
+            # The JSON is ASCII, so the length of the text written is its
+            # size in bytes.
+            position = [0]
+
+            def write(text):
+                outfile.write(text)
+                position[0] += len(text)
+
+            def dumps(jsonData):
+                return json.dumps(jsonData, sort_keys=True, separators=(',', ':'))
+
+            itemIndex = {'blobIdentifiers': [], 'measurementExtras': []}
+            write('{')
+            for key, items in (('blobs', blobs), ('measurements', measurements)):
+                if key != 'blobs':
+                    write(',')
+                write('\n  %s: [' % json.dumps(key))
+                itemIndex[key] = []
+                for i, item in enumerate(items):
+                    itemJson = item.json
+                    if arrays is not None:
+                        itemJson = _extractArrays(itemJson, arrays, minSize)
+                    write(',\n    ' if i else '\n    ')
+                    start = position[0]
+                    if key == 'blobs':
+                        write(dumps(itemJson))
+                        itemIndex['blobIdentifiers'].append(itemJson.get('identifier'))
+                    else:
+                        # The extras come first, so that their span is known
+                        # and the rest of the measurement can be parsed
+                        # without them.
+                        write('{"extras":')
+                        extrasStart = position[0]
+                        write(dumps(itemJson.get('extras', {})))
+                        itemIndex['measurementExtras'].append([extrasStart, position[0]])
+                        rest = dumps({name: value for name, value in itemJson.items()
+                                      if name != 'extras'})
+                        write(rest[1:] if rest == '{}' else ',' + rest[1:])
+                    itemIndex[key].append([start, position[0]])
+                    del itemJson
+                write('\n  ]')
+
+            # The trailer is the last line of the document.
+            trailer = {_indexKey: itemIndex}
+            if arrays is not None and len(arrays) > 0:
+                trailer[_sidecarKey] = os.path.basename(npzPath)
+            write(',\n  %s\n}\n' % json.dumps(trailer, sort_keys=True)[1:-1])
+    finally:
+        if arrays is not None:
+            arrays.close()
+
+    if (arrays is None or len(arrays) == 0) and os.path.exists(npzPath):
+        # Do not leave an empty sidecar, or that of a previous run.
+        os.remove(npzPath)
+
+
+def _readTrailer(filepath):
+    """Read the trailer written by `writeJsonStream` at the end of
+    ``filepath``, or return `None` if there is none."""
+    with open(filepath, 'rb') as infile:
+        infile.seek(0, os.SEEK_END)
+        position = infile.tell()
+        tail = b''
+        # The trailer is the last line before the closing brace.
+        while position > 0 and tail.count(b'\n') < 3:
+            step = min(65536, position)
+            position -= step
+            infile.seek(position)
+            tail = infile.read(step) + tail
+    lines = tail.rstrip().rsplit(b'\n', 2)
+    if len(lines) < 2 or lines[-1].strip() != b'}':
+        return None
+    marker = ('  %s:' % json.dumps(_indexKey)).encode('ascii')
+    if not lines[-2].startswith(marker):
+        return None
+    return json.loads('{%s}' % lines[-2].decode('ascii'))
+
+
+def _readItems(filepath, spans, skipSpans=None):
+    """Parse the blobs, measurements or extras at the byte ``spans`` of
+    ``filepath``, as recorded by `writeJsonStream`.
+
+    The byte ranges ``skipSpans`` of each item, if given, are parsed as an
+    empty object instead.
+    """
+    items = []
+    with open(filepath, 'rb') as infile:
+        for i, (start, end) in enumerate(spans):
+            infile.seek(start)
+            text = infile.read(end - start)
+            if skipSpans is not None:
+                skipStart, skipEnd = skipSpans[i]
+                text = text[:skipStart - start] + b'{}' + text[skipEnd - start:]
+            items.append(json.loads(text.decode('ascii')))
+    return items
+
+
+class _SidecarWriter(object):
+    """Write arrays to a ``.npz`` file as they are added, as `numpy.savez`
+    would write them all at once."""
+
+    def __init__(self, npzPath):
+        self._zipFile = zipfile.ZipFile(npzPath, 'w', allowZip64=True)
+        self._numArrays = 0
+
+    def __len__(self):
+        return self._numArrays
+
+    def __setitem__(self, name, array):
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, np.asanyarray(array))
+        self._zipFile.writestr(name + '.npy', buffer.getvalue())
+        self._numArrays += 1
+
+    def close(self):
+        self._zipFile.close()
+
+
+def readJson(filepath, resolveArrays=True):
+    """Read JSON data written by `writeJson` or as plain JSON.
+
+    Parameters
+    ----------
+    filepath : `str`
+        Name of the JSON file.
+    resolveArrays : `bool`, optional
+        Read the arrays of the sidecar file, if any.  Otherwise, the data
+        is returned as written, to be passed to `resolveSidecar` later.
+
+    Returns
+    -------
+    jsonData : `dict`
+        The data, with the arrays of the sidecar file restored as
+        `numpy.ndarray` if ``resolveArrays``.
+    """
+    with open(filepath, 'r') as infile:
+        jsonData = json.load(infile)
+    jsonData.pop(_indexKey, None)
+
+    if resolveArrays:
+        jsonData = resolveSidecar(jsonData, filepath)
+    return jsonData
+
+
+def resolveSidecar(jsonData, filepath):
+    """Restore the arrays that JSON data read from ``filepath`` references
+    in its sidecar file.
+
+    Parameters
+    ----------
+    jsonData : `dict`
+        Data read with ``readJson(filepath, resolveArrays=False)``, or a
+        part of it that includes the name of the sidecar file.  It is not
+        modified.
+    filepath : `str`
+        Name of the JSON file.
+
+    Returns
+    -------
+    jsonData : `dict`
+        The data with the arrays restored as `numpy.ndarray`, which
+        `lsst.validate.base.Datum` and the blobs are built from without
+        converting them to lists.  Only the referenced arrays are read.
+    """
+    if not isinstance(jsonData, dict) or _sidecarKey not in jsonData:
+        return jsonData
+    jsonData = dict(jsonData)
+    npzPath = os.path.join(os.path.dirname(filepath), jsonData.pop(_sidecarKey))
+    with np.load(npzPath) as arrays:
+        return _restoreArrays(jsonData, arrays)
+
+
+def _extractArrays(node, arrays, minSize):
+    """Copy ``node``, moving its large numeric lists and arrays to
+    ``arrays``."""
+    if isinstance(node, np.ndarray):
+        if node.dtype.kind in 'biuf' and node.size >= minSize:
+            name = 'array_%d' % len(arrays)
+            arrays[name] = node
+            return {_arrayKey: name}
+        return node.tolist()
+    if isinstance(node, dict):
+        return {key: _extractArrays(value, arrays, minSize) for key, value in node.items()}
+    if isinstance(node, (list, tuple)):
+        if len(node) > 0 and not isinstance(node[0], (dict, basestring)):
+            array = _asNumericArray(node)
+            if array is not None and array.size >= minSize:
+                name = 'array_%d' % len(arrays)
+                arrays[name] = array
+                return {_arrayKey: name}
+        return [_extractArrays(value, arrays, minSize) for value in node]
+    return node
+
+
+def _asNumericArray(values):
+    """Convert a (nested) list to a numeric array, or return `None` if it
+    is ragged or not numeric."""
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        return None
+    if array.dtype.kind not in 'biuf':
+        return None
+    return array
+
+
+def _restoreArrays(node, arrays):
+    """Replace the array references in ``node`` by the arrays."""
+    if isinstance(node, dict):
+        if len(node) == 1 and _arrayKey in node:
+            return arrays[node[_arrayKey]]
+        return {key: _restoreArrays(value, arrays) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_restoreArrays(value, arrays) for value in node]
+    return node
+
+
+class LazyJob(object):
+    """Job read from JSON whose blobs and measurement extras are only
+    deserialized when they are first used.
+
+    The measurements, with their quantities, parameters, metrics and
+    specifications, are deserialized when the job is read, so that it can
+    be printed and graded against specifications without handling the
+    per-object arrays.  Accessing ``extras``, ``blobs`` or an extra of a
+    measurement deserializes that measurement with its extras and the blobs
+    it links to.  Any attribute of the job other than `measurements`,
+    `get_measurement` and `spec_levels` deserializes the complete job (see
+    `job`).  Arrays in a sidecar file are only read with the item that
+    holds them.
+
+    For a file written by `writeJsonStream`, only the JSON of the
+    measurements, without their extras, is parsed when the job is read;
+    the JSON of the extras of a measurement and of its blobs is parsed
+    when they are accessed.  Other files, e.g. those of
+    `lsst.validate.base.Job.write_json`, are parsed entirely when the job
+    is read, and only the construction of the blobs and extras is
+    deferred.
+
+    Parameters
+    ----------
+    filepath : `str`
+        Name of the JSON file, as written by `writeJsonStream`,
+        `lsst.validate.base.Job.write_json` or `writeJobJson`.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._job = None
+
+        trailer = _readTrailer(filepath)
+        if trailer is None:
+            jsonData = readJson(filepath, resolveArrays=False)
+            self._blobsJson = jsonData.pop('blobs')
+            self._measurementsJson = jsonData.pop('measurements')
+            self._extrasJson = [measurement.pop('extras', {})
+                                for measurement in self._measurementsJson]
+            self._itemIndex = None
+            self._header = jsonData
+        else:
+            self._itemIndex = trailer.pop(_indexKey)
+            self._blobsJson = [None]*len(self._itemIndex['blobs'])
+            self._extrasJson = [None]*len(self._itemIndex['measurements'])
+            self._measurementsJson = _readItems(filepath, self._itemIndex['measurements'],
+                                                skipSpans=self._itemIndex['measurementExtras'])
+            self._header = trailer
+
+        summary = dict(self._header, blobs=[])
+        summary['measurements'] = [dict(measurement, extras={}, blobs={})
+                                   for measurement in self._measurementsJson]
+        self._summary = Job.from_json(resolveSidecar(summary, filepath))
+        self._measurements = [_LazyMeasurement(self, index, measurement)
+                              for index, measurement in enumerate(self._summary.measurements)]
+
+    def _readExtras(self, index):
+        """JSON of the extras of measurement ``index``."""
+        if self._extrasJson[index] is None:
+            span = self._itemIndex['measurementExtras'][index]
+            self._extrasJson[index] = _readItems(self._filepath, [span])[0]
+        return self._extrasJson[index]
+
+    def _readBlobs(self, indices):
+        """JSON of the blobs at ``indices``."""
+        missing = [i for i in indices if self._blobsJson[i] is None]
+        if missing:
+            spans = [self._itemIndex['blobs'][i] for i in missing]
+            for i, blobJson in zip(missing, _readItems(self._filepath, spans)):
+                self._blobsJson[i] = blobJson
+        return [self._blobsJson[i] for i in indices]
+
+    def _blobIdentifiers(self):
+        if self._itemIndex is None:
+            return [blob.get('identifier') for blob in self._blobsJson]
+        return self._itemIndex['blobIdentifiers']
+
+    def _measurementJson(self, index):
+        return dict(self._measurementsJson[index], extras=self._readExtras(index))
+
+    def _loadMeasurement(self, index):
+        """Deserialize measurement ``index`` with its extras and blobs."""
+        linked = set(self._measurementsJson[index].get('blobs', {}).values())
+        blobIndices = [i for i, identifier in enumerate(self._blobIdentifiers())
+                       if identifier in linked]
+        jsonData = dict(self._header, blobs=self._readBlobs(blobIndices),
+                        measurements=[self._measurementJson(index)])
+        job = Job.from_json(resolveSidecar(jsonData, self._filepath))
+        return next(iter(job.measurements))
+
+    @property
+    def job(self):
+        """The complete `lsst.validate.base.Job`, deserialized on first
+        access."""
+        if self._job is None:
+            jsonData = dict(self._header,
+                            blobs=self._readBlobs(range(len(self._blobsJson))),
+                            measurements=[self._measurementJson(index)
+                                          for index in range(len(self._measurementsJson))])
+            self._job = Job.from_json(resolveSidecar(jsonData, self._filepath))
+        return self._job
+
+    @property
+    def measurements(self):
+        """Iterator over the measurements."""
+        return iter(self._measurements)
+
+    @property
+    def spec_levels(self):
+        """Specification levels of the metrics of the measurements."""
+        return self._summary.spec_levels
+
+    def get_measurement(self, metric_name, spec_name=None, filter_name=None):
+        """Get a measurement, as `lsst.validate.base.Job.get_measurement`."""
+        measurement = self._summary.get_measurement(metric_name, spec_name=spec_name,
+                                                    filter_name=filter_name)
+        for lazyMeasurement in self._measurements:
+            if lazyMeasurement._summary is measurement:
+                return lazyMeasurement
+        return measurement
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.job, name)
+
+
+class _LazyMeasurement(object):
+    """Measurement of a `LazyJob`, deserializing its extras and blobs on
+    first access."""
+
+    def __init__(self, lazyJob, index, summary):
+        self._lazyJob = lazyJob
+        self._index = index
+        self._summary = summary
+        self._measurement = None
+
+    def _complete(self):
+        if self._measurement is None:
+            self._measurement = self._lazyJob._loadMeasurement(self._index)
+        return self._measurement
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in ('extras', 'blobs'):
+            try:
+                return getattr(self._summary, name)
+            except AttributeError:
+                # An extra, which the summary does not have.
+                pass
+        return getattr(self._complete(), name)
@@ -0,0 +1,248 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Robust statistics: exact quantiles by selection, and a streaming
+quantile sketch for data that does not fit in memory.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object
+
+import numpy as np
+import scipy.stats
+
+
+__all__ = ['percentiles', 'interQuartileRange', 'QuantileSketch']
+
+# Ratio of the inter-quartile range to the standard deviation of a Gaussian.
+_gaussianIqr = 2*scipy.stats.norm.ppf(0.75)
+
+
+def percentiles(array, p, axis=None, overwriteInput=False):
+    """Compute percentiles by partial sorting, as `numpy.percentile` with
+    linear interpolation.
+
+    Parameters
+    ----------
+    array : array-like
+        Values.  `astropy.units.Quantity` values are used in their units.
+    p : `float` or sequence of `float`
+        Percentiles, between 0 and 100.
+    axis : `int`, optional
+        Axis along which to compute the percentiles, e.g. ``1`` for the
+        percentiles of each row of a ``(numRandomShuffles, nMatches)``
+        array.  By default the percentiles of the flattened array are
+        computed.
+    overwriteInput : `bool`, optional
+        Partially sort ``array`` in place, if it is a floating-point
+        `numpy.ndarray`, instead of a copy of it.
+
+    Returns
+    -------
+    result : `float` or `numpy.ndarray`
+        The percentiles, with the percentiles along the first axis if ``p``
+        is a sequence, followed by the axes of ``array`` other than
+        ``axis``.  NaN where the values include a NaN or are empty.
+
+    Notes
+    -----
+    All the order statistics needed by all the percentiles, along all the
+    rows, are selected with a single call to `numpy.partition`, which takes
+    linear time instead of the ``n log n`` of sorting.
+    """
+    if overwriteInput and isinstance(array, np.ndarray) and array.dtype.kind == 'f':
+        values = array.view(np.ndarray)
+    else:
+        values = np.array(array, dtype=float)
+    if axis is None:
+        values = values.reshape(-1)
+        axis = 0
+    values = np.rollaxis(values, axis, values.ndim)
+
+    p = np.asarray(p, dtype=float)
+    scalar = p.ndim == 0
+    p = np.atleast_1d(p)
+    if np.any((p < 0) | (p > 100)):
+        raise ValueError("Percentiles must be between 0 and 100")
+
+    numValues = values.shape[-1]
+    if numValues == 0:
+        result = np.full(values.shape[:-1] + (len(p),), np.nan)
+    else:
+        hasNan = np.isnan(values).any(axis=-1)
+        position = p/100*(numValues - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, numValues - 1)
+        values.partition(np.unique(np.concatenate((lower, upper))), axis=-1)
+
+        fraction = position - lower
+        lowerValues = values[..., lower]
+        result = lowerValues + (values[..., upper] - lowerValues)*fraction
+        result[hasNan] = np.nan
+
+    result = np.rollaxis(result, result.ndim - 1, 0)
+    if scalar:
+        result = result[0]
+        if result.ndim == 0:
+            return float(result)
+    return result
+
+
+def interQuartileRange(array, axis=None, scaled=False):
+    """Compute the inter-quartile range of an array.
+
+    Parameters
+    ----------
+    array : array-like
+        Values.
+    axis : `int`, optional
+        Axis along which to compute the range.  By default that of the
+        flattened array is computed.
+    scaled : `bool`, optional
+        Divide the range by that of a Gaussian of unit standard deviation,
+        so that it estimates the standard deviation of Gaussian values.
+
+    Returns
+    -------
+    iqr : `float` or `numpy.ndarray`
+        The inter-quartile range.
+    """
+    upper, lower = percentiles(array, [75, 25], axis=axis)
+    iqr = upper - lower
+    if scaled:
+        iqr = iqr / _gaussianIqr
+    return iqr
+
+
+class QuantileSketch(object):
+    """Streaming approximation of the quantiles of a large number of values,
+    in bounded memory.
+
+    Values are added in batches with `update`.  They are held in buffers
+    of increasing weight: when a buffer exceeds ``bufferSize`` values, it
+    is sorted and every other value is promoted to the next buffer with
+    twice the weight, as in the sketch of Manku, Rajagopalan & Lindsay
+    (1998).  Memory is ``O(bufferSize log(count/bufferSize))``.
+
+    Parameters
+    ----------
+    bufferSize : `int`, optional
+        Number of values per buffer.  The rank error is of order
+        ``2 log2(count/bufferSize)/bufferSize`` of the count.
+
+    Notes
+    -----
+    Each compaction of a buffer of weight ``w`` changes the rank of any
+    value by at most ``w``.  These are summed in `rankErrorBound`, so the
+    quantiles returned by `percentile` are guaranteed to have ranks within
+    that many values of the requested ranks.  Sketches of separate chunks
+    of the data can be combined with `merge`.
+    """
+
+    def __init__(self, bufferSize=4096):
+        if bufferSize < 2:
+            raise ValueError("bufferSize must be at least 2, not %d" % bufferSize)
+        self.bufferSize = bufferSize
+        self.count = 0
+        self.numNan = 0
+        self.rankErrorBound = 0
+        self._buffers = [np.empty(0)]
+        self._numCompactions = [0]
+
+    def update(self, values):
+        """Add values.  NaN values are counted in `numNan` and otherwise
+        ignored."""
+        values = np.asarray(values, dtype=float).reshape(-1)
+        isNan = np.isnan(values)
+        self.numNan += int(isNan.sum())
+        values = values[~isNan]
+        self.count += len(values)
+        self._buffers[0] = np.concatenate((self._buffers[0], values))
+        self._compact()
+
+    def merge(self, other):
+        """Add the values of another sketch with the same ``bufferSize``."""
+        if other.bufferSize != self.bufferSize:
+            raise ValueError("Cannot merge sketches with buffer sizes %d and %d" %
+                             (self.bufferSize, other.bufferSize))
+        for level, values in enumerate(other._buffers):
+            self._level(level)
+            self._buffers[level] = np.concatenate((self._buffers[level], values))
+        self.count += other.count
+        self.numNan += other.numNan
+        self.rankErrorBound += other.rankErrorBound
+        self._compact()
+
+    def _level(self, level):
+        while len(self._buffers) <= level:
+            self._buffers.append(np.empty(0))
+            self._numCompactions.append(0)
+
+    def _compact(self):
+        level = 0
+        while level < len(self._buffers):
+            values = self._buffers[level]
+            if len(values) > self.bufferSize:
+                values = np.sort(values)
+                # Keep one value at this level if the number is odd, so that
+                # the total weight is unchanged.
+                numPromoted = len(values) // 2 * 2
+                # Alternate the promoted half, so the errors tend to cancel.
+                offset = self._numCompactions[level] % 2
+                self._numCompactions[level] += 1
+                self._level(level + 1)
+                self._buffers[level + 1] = np.concatenate(
+                    (self._buffers[level + 1], values[offset:numPromoted:2]))
+                self._buffers[level] = values[numPromoted:]
+                self.rankErrorBound += 2**level
+            level += 1
+
+    def percentile(self, p):
+        """Approximate percentiles of the values.
+
+        Parameters
+        ----------
+        p : `float` or sequence of `float`
+            Percentiles, between 0 and 100.
+
+        Returns
+        -------
+        result : `float` or `numpy.ndarray`
+            Values whose ranks are within `rankErrorBound` of the
+            percentiles.  NaN if no values were added.
+        """
+        p = np.asarray(p, dtype=float)
+        if self.count == 0:
+            return np.full(p.shape, np.nan)[()]
+        values = np.concatenate(self._buffers)
+        weights = np.concatenate([np.full(len(buffer), 2**level)
+                                  for level, buffer in enumerate(self._buffers)])
+        order = np.argsort(values, kind='mergesort')
+        cumulative = np.cumsum(weights[order])
+        # The value of rank ``p/100*(count - 1)``, counting from 0.
+        rank = np.asarray(p/100*(self.count - 1))
+        index = np.searchsorted(cumulative, rank, side='right')
+        result = values[order][np.minimum(index, len(values) - 1)]
+        return result[()] if result.ndim == 0 else result
+
+    @property
+    def rankError(self):
+        """Bound on the rank error of `percentile`, as a fraction of the
+        count."""
+        return self.rankErrorBound / self.count if self.count else 0.
@@ -0,0 +1,562 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Per-object statistics accumulated one batch of sources (e.g. one visit)
+at a time, without holding the per-source values.
+
+Each reducer holds arrays of state for ``numObjects`` objects and is
+updated with the object index and value of each new source, so that the
+statistics of all objects are advanced in a few vectorized operations per
+batch.  The results are the same as those of the
+`~lsst.validate.drp.groupedarrays.GroupedArrays` reductions over all the
+sources, to rounding, except for quantiles of objects with more than
+``exactSize`` sources, which are approximated.  Objects may be appended with
+``extend``, and the state of each reducer is a `dict` of arrays that can be
+persisted with `numpy.savez`.
+"""
+
+from __future__ import print_function, absolute_import, division
+from builtins import object, range
+
+import numpy as np
+
+from .util import raDecToUnitVector
+
+
+__all__ = ['RunningMoments', 'RunningPositionMoments', 'RunningQuantile',
+           'RunningMatchStatistics']
+
+
+class RunningMoments(object):
+    """Count, mean and variance of the values of each object.
+
+    Batches are merged into the running moments with the pairwise update of
+    Chan et al. (1979), which is Welford's algorithm for batches of one
+    value, so the variance does not suffer from cancellation.
+
+    Parameters
+    ----------
+    numObjects : `int`
+        Number of objects.
+    """
+
+    def __init__(self, numObjects):
+        self.count = np.zeros(numObjects, dtype=np.int64)
+        self._mean = np.zeros(numObjects)
+        self._sumSqDev = np.zeros(numObjects)
+
+    def extend(self, numNew):
+        """Add ``numNew`` objects without values."""
+        self.count = np.append(self.count, np.zeros(numNew, dtype=np.int64))
+        self._mean = np.append(self._mean, np.zeros(numNew))
+        self._sumSqDev = np.append(self._sumSqDev, np.zeros(numNew))
+
+    def take(self, index):
+        """Moments of the objects selected by ``index`` (an index or
+        boolean array)."""
+        return self.fromState({name: values[index] for name, values in self.getState().items()})
+
+    def getState(self, prefix=''):
+        """State of the moments as a `dict` of arrays, e.g. to persist it
+        with `numpy.savez`."""
+        return {prefix + 'count': self.count, prefix + 'mean': self._mean,
+                prefix + 'sumSqDev': self._sumSqDev}
+
+    @classmethod
+    def fromState(cls, state, prefix=''):
+        """Restore moments from `getState`."""
+        moments = cls(0)
+        moments.count = np.asarray(state[prefix + 'count'], dtype=np.int64)
+        moments._mean = np.asarray(state[prefix + 'mean'], dtype=float)
+        moments._sumSqDev = np.asarray(state[prefix + 'sumSqDev'], dtype=float)
+        return moments
+
+    def update(self, objectIndex, values):
+        """Add values.
+
+        Parameters
+        ----------
+        objectIndex : `numpy.ndarray` of `int`
+            Index of the object of each value.  An object may appear more
+            than once.
+        values : `numpy.ndarray` of `float`
+            The values.  NaN values make the moments of their object NaN, as
+            with `numpy.mean`.
+        """
+        objectIndex = np.asarray(objectIndex, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        numObjects = len(self.count)
+
+        batchCount = np.bincount(objectIndex, minlength=numObjects)
+        inBatch = batchCount > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batchMean = np.bincount(objectIndex, weights=values, minlength=numObjects) / batchCount
+        batchSumSqDev = np.bincount(objectIndex, weights=np.square(values - batchMean[objectIndex]),
+                                    minlength=numObjects)
+
+        countA = self.count[inBatch]
+        countB = batchCount[inBatch]
+        total = countA + countB
+        delta = batchMean[inBatch] - self._mean[inBatch]
+        self._mean[inBatch] += delta * countB / total
+        self._sumSqDev[inBatch] += batchSumSqDev[inBatch] + np.square(delta) * countA * countB / total
+        self.count = self.count + batchCount
+
+    @property
+    def mean(self):
+        """Mean of each object (NaN for objects without values)."""
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def variance(self, ddof=0):
+        """Variance of each object, as `numpy.var` with ``ddof``."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self._sumSqDev / (self.count - ddof), np.nan)
+
+    def std(self, ddof=0):
+        """Standard deviation of each object, as `numpy.std` with ``ddof``."""
+        return np.sqrt(self.variance(ddof=ddof))
+
+
+class RunningPositionMoments(object):
+    """Mean position and RMS scatter of the positions of each object.
+
+    Parameters
+    ----------
+    numObjects : `int`
+        Number of objects.
+
+    Notes
+    -----
+    The moments are accumulated on the offsets of the unit vectors of the
+    positions from the first position of each object, which are small, so
+    milliarcsecond scatter is not lost to rounding.  The mean position is
+    the direction of the mean unit vector, as in
+    `~lsst.validate.drp.util.averageRaDecByGroup`, and the RMS is that of
+    the chord distances to it, which equal the angular distances of
+    `~lsst.validate.drp.util.positionRmsByGroup` to second order.
+    """
+
+    def __init__(self, numObjects):
+        self._reference = np.full((numObjects, 3), np.nan)
+        self._moments = [RunningMoments(numObjects) for i in range(3)]
+
+    def extend(self, numNew):
+        """Add ``numNew`` objects without positions."""
+        self._reference = np.append(self._reference, np.full((numNew, 3), np.nan), axis=0)
+        for moments in self._moments:
+            moments.extend(numNew)
+
+    def take(self, index):
+        """Moments of the objects selected by ``index`` (an index or
+        boolean array)."""
+        return self.fromState({name: values[index] for name, values in self.getState().items()})
+
+    def getState(self, prefix=''):
+        """State of the moments as a `dict` of arrays, e.g. to persist it
+        with `numpy.savez`."""
+        state = {prefix + 'reference': self._reference}
+        for i, moments in enumerate(self._moments):
+            state.update(moments.getState(prefix='%s%d_' % (prefix, i)))
+        return state
+
+    @classmethod
+    def fromState(cls, state, prefix=''):
+        """Restore moments from `getState`."""
+        positions = cls(0)
+        positions._reference = np.asarray(state[prefix + 'reference'], dtype=float)
+        positions._moments = [RunningMoments.fromState(state, prefix='%s%d_' % (prefix, i))
+                              for i in range(3)]
+        return positions
+
+    @property
+    def count(self):
+        """Number of positions of each object."""
+        return self._moments[0].count
+
+    def update(self, objectIndex, ra, dec):
+        """Add positions.
+
+        Parameters
+        ----------
+        objectIndex : `numpy.ndarray` of `int`
+            Index of the object of each position.
+        ra, dec : `numpy.ndarray` of `float`
+            The positions [radians].
+        """
+        objectIndex = np.asarray(objectIndex, dtype=np.int64)
+        vectors = raDecToUnitVector(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+
+        isNew = self.count[objectIndex] == 0
+        newObjects, first = np.unique(objectIndex[isNew], return_index=True)
+        self._reference[newObjects] = vectors[isNew][first]
+
+        offsets = vectors - self._reference[objectIndex]
+        for i, moments in enumerate(self._moments):
+            moments.update(objectIndex, offsets[:, i])
+
+    def meanRaDec(self):
+        """Mean position of each object.
+
+        Returns
+        -------
+        ra, dec : `numpy.ndarray` of `float`
+            Mean RA and Dec [radians], NaN for objects without positions.
+        """
+        x, y, z = [self._reference[:, i] + moments.mean
+                   for i, moments in enumerate(self._moments)]
+        return np.arctan2(y, x) % (2*np.pi), np.arctan2(z, np.hypot(x, y))
+
+    @property
+    def rms(self):
+        """RMS distance of the positions of each object to its mean
+        position [radians]."""
+        return np.sqrt(sum(moments.variance() for moments in self._moments))
+
+
+class RunningQuantile(object):
+    """Quantile of the values of each object.
+
+    The first ``exactSize`` values of each object are kept, and their
+    quantile is exact.  Beyond that, the quantile is estimated with the P²
+    algorithm of Jain & Chlamtac (1985), which tracks five markers per
+    object, started from the kept values.
+
+    Parameters
+    ----------
+    numObjects : `int`
+        Number of objects.
+    quantile : `float`, optional
+        Quantile to estimate, between 0 and 1.  Default is the median.
+    exactSize : `int`, optional
+        Number of values per object for which the quantile is exact, at
+        least 5.
+    """
+
+    def __init__(self, numObjects, quantile=0.5, exactSize=20):
+        if exactSize < 5:
+            raise ValueError("exactSize must be at least 5, not %d" % exactSize)
+        self.quantile = quantile
+        self.exactSize = exactSize
+        self.count = np.zeros(numObjects, dtype=np.int64)
+        self._hasNan = np.zeros(numObjects, dtype=bool)
+        self._values = np.full((numObjects, exactSize), np.nan)
+        self._markers = np.full((numObjects, 5), np.nan)
+        self._positions = np.zeros((numObjects, 5))
+        self._increments = np.array([0., quantile/2, quantile, (1 + quantile)/2, 1.])
+
+    def extend(self, numNew):
+        """Add ``numNew`` objects without values."""
+        self.count = np.append(self.count, np.zeros(numNew, dtype=np.int64))
+        self._hasNan = np.append(self._hasNan, np.zeros(numNew, dtype=bool))
+        self._values = np.append(self._values, np.full((numNew, self.exactSize), np.nan), axis=0)
+        self._markers = np.append(self._markers, np.full((numNew, 5), np.nan), axis=0)
+        self._positions = np.append(self._positions, np.zeros((numNew, 5)), axis=0)
+
+    def take(self, index):
+        """Quantiles of the objects selected by ``index`` (an index or
+        boolean array)."""
+        state = self.getState()
+        for name in ('count', 'hasNan', 'values', 'markers', 'positions'):
+            state[name] = state[name][index]
+        return self.fromState(state)
+
+    def getState(self, prefix=''):
+        """State of the quantiles as a `dict` of arrays, e.g. to persist it
+        with `numpy.savez`."""
+        return {prefix + 'quantile': np.array(self.quantile),
+                prefix + 'exactSize': np.array(self.exactSize),
+                prefix + 'count': self.count, prefix + 'hasNan': self._hasNan,
+                prefix + 'values': self._values, prefix + 'markers': self._markers,
+                prefix + 'positions': self._positions}
+
+    @classmethod
+    def fromState(cls, state, prefix=''):
+        """Restore quantiles from `getState`."""
+        quantiles = cls(0, quantile=float(state[prefix + 'quantile']),
+                        exactSize=int(state[prefix + 'exactSize']))
+        quantiles.count = np.asarray(state[prefix + 'count'], dtype=np.int64)
+        quantiles._hasNan = np.asarray(state[prefix + 'hasNan'], dtype=bool)
+        quantiles._values = np.asarray(state[prefix + 'values'], dtype=float)
+        quantiles._markers = np.asarray(state[prefix + 'markers'], dtype=float)
+        quantiles._positions = np.asarray(state[prefix + 'positions'], dtype=float)
+        return quantiles
+
+    def update(self, objectIndex, values):
+        """Add at most one value per object.
+
+        Parameters
+        ----------
+        objectIndex : `numpy.ndarray` of `int`
+            Index of the object of each value, without repetitions.
+        values : `numpy.ndarray` of `float`
+            The values.  A NaN value makes the quantile of its object NaN,
+            as with `numpy.median`.
+
+        Raises
+        ------
+        ValueError
+            Raised if an object appears more than once.
+        """
+        objectIndex = np.asarray(objectIndex, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        if len(np.unique(objectIndex)) != len(objectIndex):
+            raise ValueError("RunningQuantile takes at most one value per object per update")
+
+        isNan = np.isnan(values)
+        self._hasNan[objectIndex[isNan]] = True
+        objectIndex, values = objectIndex[~isNan], values[~isNan]
+
+        count = self.count[objectIndex]
+        exact = count < self.exactSize
+        self._values[objectIndex[exact], count[exact]] = values[exact]
+
+        start = objectIndex[count == self.exactSize]
+        if len(start) > 0:
+            self._startMarkers(start)
+        if (~exact).any():
+            self._updateMarkers(objectIndex[~exact], values[~exact], count[~exact] + 1)
+
+        self.count[objectIndex] += 1
+
+    def _startMarkers(self, objects):
+        """Place the markers at the kept values of ``objects``."""
+        desired = 1 + (self.exactSize - 1)*self._increments
+        positions = np.round(desired)
+        self._positions[objects] = positions
+        sortedValues = np.sort(self._values[objects], axis=1)
+        self._markers[objects] = sortedValues[:, positions.astype(int) - 1]
+
+    def _updateMarkers(self, objects, values, newCount):
+        """Advance the P² markers of ``objects`` with one value each."""
+        q = self._markers[objects]
+        n = self._positions[objects]
+
+        q[:, 0] = np.minimum(q[:, 0], values)
+        q[:, 4] = np.maximum(q[:, 4], values)
+        cell = np.sum(values[:, np.newaxis] >= q[:, 1:4], axis=1)
+        n += np.arange(5)[np.newaxis, :] > cell[:, np.newaxis]
+        desired = 1 + (newCount[:, np.newaxis] - 1)*self._increments[np.newaxis, :]
+
+        for i in range(1, 4):
+            d = desired[:, i] - n[:, i]
+            moveUp = (d >= 1) & (n[:, i + 1] - n[:, i] > 1)
+            moveDown = (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+            move = moveUp | moveDown
+            if not move.any():
+                continue
+            s = np.sign(d[move])
+            qm, nm = q[move], n[move]
+            slopeAbove = (qm[:, i + 1] - qm[:, i])/(nm[:, i + 1] - nm[:, i])
+            slopeBelow = (qm[:, i] - qm[:, i - 1])/(nm[:, i] - nm[:, i - 1])
+            weightAbove = nm[:, i] - nm[:, i - 1] + s
+            weightBelow = nm[:, i + 1] - nm[:, i] - s
+            parabolic = qm[:, i] + s/(nm[:, i + 1] - nm[:, i - 1])*(
+                weightAbove*slopeAbove + weightBelow*slopeBelow)
+            neighbour = np.where(s > 0, i + 1, i - 1)
+            rows = np.arange(len(s))
+            linear = qm[:, i] + s*(qm[rows, neighbour] - qm[:, i])/(nm[rows, neighbour] - nm[:, i])
+            inside = (qm[:, i - 1] < parabolic) & (parabolic < qm[:, i + 1])
+            q[move, i] = np.where(inside, parabolic, linear)
+            n[move, i] += s
+
+        self._markers[objects] = q
+        self._positions[objects] = n
+
+    @property
+    def value(self):
+        """Quantile of each object (NaN for objects without values or with
+        a NaN value)."""
+        result = np.full(len(self.count), np.nan)
+        exact = (self.count > 0) & (self.count <= self.exactSize)
+        if exact.any():
+            result[exact] = np.nanpercentile(self._values[exact], 100*self.quantile, axis=1)
+        approximate = self.count > self.exactSize
+        result[approximate] = self._markers[approximate, 2]
+        result[self._hasNan] = np.nan
+        return result
+
+
+def _rankWithinObject(objectIndex):
+    """Rank of each entry of ``objectIndex`` among the entries of the same
+    object, in input order."""
+    order = np.argsort(objectIndex, kind='mergesort')
+    sortedIndex = objectIndex[order]
+    starts = np.flatnonzero(np.append(True, sortedIndex[1:] != sortedIndex[:-1]))
+    runStarts = np.repeat(starts, np.diff(np.append(starts, len(sortedIndex))))
+    rank = np.empty(len(objectIndex), dtype=np.int64)
+    rank[order] = np.arange(len(objectIndex)) - runStarts
+    return rank
+
+
+class RunningMatchStatistics(object):
+    """Per-object statistics of matched sources used to select and
+    summarize stars, as in
+    `~lsst.validate.drp.matchreduce.MatchedMultiVisitDataset`.
+
+    Parameters
+    ----------
+    numObjects : `int`
+        Number of objects.
+    flagNames : `list` of `str`
+        Names of the per-source flags that reject an object.
+
+    Attributes
+    ----------
+    count : `numpy.ndarray` of `int`
+        Number of sources of each object.
+    positions : `RunningPositionMoments`
+        Moments of the source positions.
+    mag : `RunningMoments`
+        Moments of the PSF magnitudes.
+    magErr : `RunningQuantile`
+        Median of the PSF magnitude uncertainties.
+    snr : `RunningQuantile`
+        Median of the PSF signal-to-noise ratios.
+    flagged : `numpy.ndarray` of `bool`
+        Whether any source of each object has one of ``flagNames`` set.
+    allFiniteMag : `numpy.ndarray` of `bool`
+        Whether all the PSF magnitudes of each object are finite.
+    """
+
+    raKey = "coord_ra"
+    decKey = "coord_dec"
+    magKey = "base_PsfFlux_mag"
+    magErrKey = "base_PsfFlux_magerr"
+    snrKey = "base_PsfFlux_snr"
+    extendedKey = "base_ClassificationExtendedness_value"
+
+    def __init__(self, numObjects, flagNames):
+        self.flagNames = list(flagNames)
+        self.count = np.zeros(numObjects, dtype=np.int64)
+        self.positions = RunningPositionMoments(numObjects)
+        self.mag = RunningMoments(numObjects)
+        self.magErr = RunningQuantile(numObjects)
+        self.snr = RunningQuantile(numObjects)
+        self.flagged = np.zeros(numObjects, dtype=bool)
+        self.allFiniteMag = np.ones(numObjects, dtype=bool)
+        self._maxExtendedness = np.full(numObjects, -np.inf)
+
+    @classmethod
+    def fromGroups(cls, groups, flagNames):
+        """Accumulate the statistics of matched sources.
+
+        Parameters
+        ----------
+        groups : `lsst.validate.drp.groupedarrays.GroupedArrays`
+            Matched sources, grouped by object.
+        flagNames : `list` of `str`
+            Names of the per-source flags that reject an object.
+
+        Returns
+        -------
+        statistics : `RunningMatchStatistics`
+            The statistics of each group of ``groups``.
+        """
+        statistics = cls(len(groups), flagNames)
+        statistics.update(groups.groupIndex, {name: groups[name] for name in groups.names})
+        return statistics
+
+    def update(self, objectIndex, columns):
+        """Add sources.
+
+        Parameters
+        ----------
+        objectIndex : `numpy.ndarray` of `int`
+            Index of the object of each source.
+        columns : `dict` of `numpy.ndarray`
+            Per-source columns, including the keys of this class and
+            ``flagNames``.
+        """
+        objectIndex = np.asarray(objectIndex, dtype=np.int64)
+        self.count += np.bincount(objectIndex, minlength=len(self.count))
+        self.positions.update(objectIndex, columns[self.raKey], columns[self.decKey])
+
+        mag = np.asarray(columns[self.magKey], dtype=float)
+        self.mag.update(objectIndex, mag)
+        np.logical_and.at(self.allFiniteMag, objectIndex, np.isfinite(mag))
+        np.maximum.at(self._maxExtendedness, objectIndex,
+                      np.asarray(columns[self.extendedKey], dtype=float))
+        flagged = np.zeros(len(objectIndex), dtype=bool)
+        for flagName in self.flagNames:
+            flagged |= columns[flagName]
+        self.flagged[objectIndex[flagged]] = True
+
+        # The quantiles take one value per object per update.
+        magErr = np.asarray(columns[self.magErrKey], dtype=float)
+        snr = np.asarray(columns[self.snrKey], dtype=float)
+        rank = _rankWithinObject(objectIndex)
+        for r in range(rank.max() + 1 if len(rank) else 0):
+            inRank = rank == r
+            self.magErr.update(objectIndex[inRank], magErr[inRank])
+            self.snr.update(objectIndex[inRank], snr[inRank])
+
+    @property
+    def maxExtendedness(self):
+        """Maximum extendedness of each object (NaN for objects without
+        sources or with a NaN extendedness)."""
+        return np.where(self.count > 0, self._maxExtendedness, np.nan)
+
+    def extend(self, numNew):
+        """Add ``numNew`` objects without sources."""
+        self.count = np.append(self.count, np.zeros(numNew, dtype=np.int64))
+        for reducer in (self.positions, self.mag, self.magErr, self.snr):
+            reducer.extend(numNew)
+        self.flagged = np.append(self.flagged, np.zeros(numNew, dtype=bool))
+        self.allFiniteMag = np.append(self.allFiniteMag, np.ones(numNew, dtype=bool))
+        self._maxExtendedness = np.append(self._maxExtendedness, np.full(numNew, -np.inf))
+
+    def take(self, index):
+        """Statistics of the objects selected by ``index`` (an index or
+        boolean array)."""
+        statistics = type(self)(0, self.flagNames)
+        statistics.count = self.count[index]
+        statistics.positions = self.positions.take(index)
+        statistics.mag = self.mag.take(index)
+        statistics.magErr = self.magErr.take(index)
+        statistics.snr = self.snr.take(index)
+        statistics.flagged = self.flagged[index]
+        statistics.allFiniteMag = self.allFiniteMag[index]
+        statistics._maxExtendedness = self._maxExtendedness[index]
+        return statistics
+
+    def getState(self, prefix=''):
+        """State of the statistics as a `dict` of arrays, e.g. to persist it
+        with `numpy.savez`."""
+        state = {prefix + 'count': self.count, prefix + 'flagged': self.flagged,
+                 prefix + 'allFiniteMag': self.allFiniteMag,
+                 prefix + 'maxExtendedness': self._maxExtendedness}
+        state.update(self.positions.getState(prefix=prefix + 'positions_'))
+        state.update(self.mag.getState(prefix=prefix + 'mag_'))
+        state.update(self.magErr.getState(prefix=prefix + 'magErr_'))
+        state.update(self.snr.getState(prefix=prefix + 'snr_'))
+        return state
+
+    @classmethod
+    def fromState(cls, state, flagNames, prefix=''):
+        """Restore statistics from `getState`."""
+        statistics = cls(0, flagNames)
+        statistics.count = np.asarray(state[prefix + 'count'], dtype=np.int64)
+        statistics.positions = RunningPositionMoments.fromState(state, prefix=prefix + 'positions_')
+        statistics.mag = RunningMoments.fromState(state, prefix=prefix + 'mag_')
+        statistics.magErr = RunningQuantile.fromState(state, prefix=prefix + 'magErr_')
+        statistics.snr = RunningQuantile.fromState(state, prefix=prefix + 'snr_')
+        statistics.flagged = np.asarray(state[prefix + 'flagged'], dtype=bool)
+        statistics.allFiniteMag = np.asarray(state[prefix + 'allFiniteMag'], dtype=bool)
+        statistics._maxExtendedness = np.asarray(state[prefix + 'maxExtendedness'], dtype=float)
+        return statistics
@@ -0,0 +1,145 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Run interdependent computations concurrently, in dependency order."""
+
+from __future__ import print_function, absolute_import
+from builtins import object
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+__all__ = ['TaskGraph']
+
+
+class TaskGraph(object):
+    """A set of named tasks, each run once all the tasks it depends on are
+    done.
+
+    Tasks are added in an order that respects their dependencies, which is
+    the order in which they run serially.  With several threads, every task
+    whose dependencies are done may run concurrently.
+
+    Examples
+    --------
+    >>> graph = TaskGraph()
+    >>> graph.add('a', lambda: 1)
+    >>> graph.add('b', lambda: 2)
+    >>> graph.add('sum', lambda a, b: a + b, dependencies=['a', 'b'])
+    >>> graph.run(numThreads=2)['sum']
+    3
+    """
+
+    def __init__(self):
+        self._tasks = OrderedDict()
+
+    def add(self, name, function, dependencies=()):
+        """Add a task.
+
+        Parameters
+        ----------
+        name : `str`
+            Unique name of the task, under which its result is returned.
+        function : callable
+            Called with the results of ``dependencies``, in order.
+        dependencies : `list` of `str`, optional
+            Names of previously added tasks that must be done first.
+        """
+        assert name not in self._tasks, "Task {0} already added".format(name)
+        for dependency in dependencies:
+            assert dependency in self._tasks, \
+                "Task {0} depends on unknown task {1}".format(name, dependency)
+        self._tasks[name] = (function, list(dependencies))
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def run(self, numThreads=1):
+        """Run all the tasks.
+
+        Parameters
+        ----------
+        numThreads : `int`, optional
+            Number of tasks to run at once.
+
+        Returns
+        -------
+        results : `collections.OrderedDict`
+            Result of each task, in the order the tasks were added.
+
+        Raises
+        ------
+        Exception
+            The first exception raised by a task.  Once a task has failed,
+            the tasks that have not started are skipped, and the exception
+            is raised when the tasks already running are done.
+        """
+        results = {}
+        if numThreads <= 1 or len(self._tasks) <= 1:
+            for name, (function, dependencies) in self._tasks.items():
+                results[name] = function(*[results[d] for d in dependencies])
+        else:
+            self._runConcurrently(results, numThreads)
+        return OrderedDict((name, results[name]) for name in self._tasks)
+
+    def _runConcurrently(self, results, numThreads):
+        done = Queue()
+        failed = threading.Event()
+
+        def runTask(name):
+            if failed.is_set():
+                # Submitted before the failure, but not started.
+                return
+            function, dependencies = self._tasks[name]
+            try:
+                done.put((name, function(*[results[d] for d in dependencies]), None))
+            except Exception:
+                done.put((name, None, sys.exc_info()[1]))
+
+        waiting = OrderedDict((name, set(dependencies))
+                              for name, (function, dependencies) in self._tasks.items())
+        running = 0
+        pool = ThreadPool(min(numThreads, len(self._tasks)))
+        try:
+            while waiting or running:
+                ready = [name for name, dependencies in waiting.items() if not dependencies]
+                for name in ready:
+                    del waiting[name]
+                    pool.apply_async(runTask, (name,))
+                    running += 1
+
+                name, result, error = done.get()
+                running -= 1
+                if error is not None:
+                    failed.set()
+                    raise error
+                results[name] = result
+                for dependencies in waiting.values():
+                    dependencies.discard(name)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,144 @@
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+"""Partitioning of the sky into tiles for matching large datasets piecewise."""
+
+from __future__ import print_function, absolute_import
+from builtins import object, range
+
+import numpy as np
+
+
+__all__ = ['SkyTiling']
+
+
+class SkyTiling(object):
+    """Partition of the sky into tiles of roughly equal area.
+
+    The sky is divided into declination bands of height ``tileSize``, and
+    each band into equal RA ranges at least ``tileSize`` wide on the sky.
+    Tiles are numbered consecutively, band by band, from the south pole.
+
+    Parameters
+    ----------
+    tileSize : `float`
+        Minimum height and width of the tiles [radians].
+    margin : `float`, optional
+        Width of the overlap margin around each tile [radians], see
+        `tilesWithMargin`.
+    """
+
+    def __init__(self, tileSize, margin=0.):
+        assert 0 < tileSize, "tileSize must be positive"
+        self.tileSize = tileSize
+        self.margin = margin
+
+        self.numBands = max(1, int(np.floor(np.pi / tileSize)))
+        self.bandHeight = np.pi / self.numBands
+        decLow = -np.pi/2 + np.arange(self.numBands) * self.bandHeight
+        decHigh = decLow + self.bandHeight
+        # Width of the band on the sky is largest at the declination
+        # closest to the equator.
+        maxCosDec = np.where((decLow <= 0) & (decHigh >= 0), 1.,
+                             np.cos(np.minimum(np.abs(decLow), np.abs(decHigh))))
+        self.numRa = np.maximum(1, np.floor(2*np.pi*maxCosDec / tileSize)).astype(np.int64)
+        self.firstTile = np.concatenate(([0], np.cumsum(self.numRa)))
+
+    def __len__(self):
+        return int(self.firstTile[-1])
+
+    def _band(self, dec):
+        band = np.floor((np.asarray(dec) + np.pi/2) / self.bandHeight).astype(np.int64)
+        return np.clip(band, 0, self.numBands - 1)
+
+    def tileIndex(self, ra, dec):
+        """Tile containing each position.
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray` of `float`
+            Positions [radians].
+
+        Returns
+        -------
+        tiles : `numpy.ndarray` of `int`
+            Index of the tile of each position.
+        """
+        band = self._band(dec)
+        numRa = self.numRa[band]
+        raIndex = np.floor((np.asarray(ra) % (2*np.pi)) / (2*np.pi) * numRa).astype(np.int64)
+        return self.firstTile[band] + np.minimum(raIndex, numRa - 1)
+
+    def tilesWithMargin(self, ra, dec):
+        """Tiles that each position belongs to, including the tiles within
+        ``margin`` of it.
+
+        Every position within ``margin`` of a tile (not only inside it) is
+        assigned to that tile, so a group of positions spread over less
+        than ``margin`` is entirely assigned to the tile of each of them.
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray` of `float`
+            Positions [radians].
+
+        Returns
+        -------
+        tiles, indices : `numpy.ndarray` of `int`
+            Pairs of tile and index of a position in ``ra`` and ``dec``,
+            sorted by tile and then by index.
+        """
+        ra = np.asarray(ra, dtype=float) % (2*np.pi)
+        dec = np.asarray(dec, dtype=float)
+        indices = np.arange(len(ra))
+
+        # Extent in RA of the circle of radius margin around each position;
+        # circles containing a pole cover all RAs.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coversPole = np.abs(dec) + self.margin >= np.pi/2
+            dRa = np.where(coversPole, np.pi,
+                           np.arcsin(np.minimum(1., np.sin(self.margin) / np.cos(dec))))
+
+        bandLow = self._band(dec - self.margin)
+        bandHigh = self._band(dec + self.margin)
+
+        tiles, sources = [], []
+        for bandStep in range(int((bandHigh - bandLow).max()) + 1 if len(ra) else 0):
+            band = bandLow + bandStep
+            inBand = band <= bandHigh
+            band = np.minimum(band, self.numBands - 1)
+            numRa = self.numRa[band]
+            width = 2*np.pi / numRa
+            low = np.floor((ra - dRa) / width).astype(np.int64)
+            high = np.floor((ra + dRa) / width).astype(np.int64)
+            span = np.where(dRa >= np.pi, numRa, np.minimum(high - low + 1, numRa))
+            low = np.where(dRa >= np.pi, 0, low)
+            for raStep in range(int(span[inBand].max()) if inBand.any() else 0):
+                selected = inBand & (raStep < span)
+                raIndex = (low[selected] + raStep) % numRa[selected]
+                tiles.append(self.firstTile[band[selected]] + raIndex)
+                sources.append(indices[selected])
+
+        if not tiles:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        tiles = np.concatenate(tiles)
+        sources = np.concatenate(sources)
+        # Remove duplicates, which occur when a circle covers a whole band.
+        pairs = np.unique(tiles * len(ra) + sources)
+        return pairs // len(ra), pairs % len(ra)
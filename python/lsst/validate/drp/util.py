@@ -20,18 +20,20 @@
 """Miscellaneous functions to support lsst.validate.drp."""
 
 from __future__ import print_function, division
-from builtins import zip
+from builtins import range, zip
 from past.builtins import basestring
 
+from collections import deque
+from itertools import islice
 import os
 
 import numpy as np
 import yaml
+from scipy.spatial import cKDTree
 
 import lsst.daf.persistence as dafPersist
 import lsst.pipe.base as pipeBase
 import lsst.afw.geom as afwGeom
-import lsst.afw.coord as afwCoord
 
 
 def averageRaDec(ra, dec):
@@ -51,13 +53,50 @@ def averageRaDec(ra, dec):
     """
     assert(len(ra) == len(dec))
 
-    angleRa = [afwGeom.Angle(r, afwGeom.radians) for r in ra]
-    angleDec = [afwGeom.Angle(d, afwGeom.radians) for d in dec]
-    coords = [afwCoord.IcrsCoord(ar, ad) for (ar, ad) in zip(angleRa, angleDec)]
+    meanRa, meanDec = averageRaDecByGroup(ra, dec, [0, len(ra)])
 
-    meanRa, meanDec = afwCoord.averageCoord(coords)
+    return meanRa[0], meanDec[0]
 
-    return meanRa.asRadians(), meanDec.asRadians()
+
+def averageRaDecByGroup(ra, dec, offsets):
+    """Calculate the average RA, Dec of many groups of positions at once
+    using spherical geometry.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians], sorted by group.
+    dec : numpy.array of float
+        Dec in [radians], sorted by group.
+    offsets : numpy.array of int
+        Group boundaries: group ``i`` is ``ra[offsets[i]:offsets[i+1]]``.
+
+    Returns
+    -------
+    numpy.array, numpy.array
+       meanRa, meanDec -- Average RA in [0, 2 pi) and Dec of each group
+       [radians].  NaN for empty groups.
+
+    Notes
+    -----
+    The average is the direction of the sum of the unit vectors of the
+    positions, as computed by `lsst.afw.coord.averageCoord`.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    nGroups = len(counts)
+    groupIndex = np.repeat(np.arange(nGroups), counts)
+
+    vectors = raDecToUnitVector(ra, dec)
+    x, y, z = [np.bincount(groupIndex, weights=vectors[:, i], minlength=nGroups)
+               for i in range(3)]
+
+    meanRa = np.arctan2(y, x) % (2*np.pi)
+    meanDec = np.arctan2(z, np.hypot(x, y))
+    meanRa[counts == 0] = np.nan
+    meanDec[counts == 0] = np.nan
+
+    return meanRa, meanDec
 
 
 def averageRaDecFromCat(cat):
@@ -110,6 +149,43 @@ def positionRmsFromCat(cat):
     return positionRms(ra_avg, dec_avg, ra, dec)
 
 
+def positionRmsByGroup(ra, dec, offsets, ra_avg=None, dec_avg=None):
+    """Calculate the RMS of RA, Dec about their average for many groups of
+    positions at once.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians], sorted by group.
+    dec : numpy.array of float
+        Dec in [radians], sorted by group.
+    offsets : numpy.array of int
+        Group boundaries: group ``i`` is ``ra[offsets[i]:offsets[i+1]]``.
+    ra_avg, dec_avg : numpy.array of float, optional
+        Average RA, Dec of each group [radians], if already known
+        (see `averageRaDecByGroup`).
+
+    Returns
+    -------
+    numpy.array
+        RMS of positions of each group in milliarcsecond, as
+        `positionRmsFromCat` would compute for each group.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    groupIndex = np.repeat(np.arange(len(counts)), counts)
+
+    if ra_avg is None or dec_avg is None:
+        ra_avg, dec_avg = averageRaDecByGroup(ra, dec, offsets)
+    separations = sphDist(ra_avg[groupIndex], dec_avg[groupIndex], ra, dec)
+    sumSq = np.bincount(groupIndex, weights=separations**2, minlength=len(counts))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pos_rms_rad = np.sqrt(sumSq / counts)  # radians
+    pos_rms_mas = afwGeom.radToMas(pos_rms_rad)  # milliarcsec
+
+    return pos_rms_mas
+
+
 def sphDist(ra1, dec1, ra2, dec2):
     """Calculate distance on the surface of a unit sphere.
 
@@ -140,6 +216,186 @@ def sphDist(ra1, dec1, ra2, dec2):
     return dist
 
 
+def raDecToUnitVector(ra, dec):
+    """Convert RA, Dec to Cartesian unit vectors.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians]
+    dec : numpy.array of float
+        Dec in [radians]
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape ``(N, 3)`` of unit vectors.
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    cosDec = np.cos(dec)
+    return np.column_stack((cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)))
+
+
+def findPairsInAnnulus(ra, dec, annulus):
+    """Find all pairs of positions separated by a distance within an annulus.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians]
+    dec : numpy.array of float
+        Dec in [radians]
+    annulus : length-2 sequence of float
+        Inner and outer radii [radians].  A pair is selected if
+        ``annulus[0] <= sphDist < annulus[1]``.
+
+    Returns
+    -------
+    obj1, obj2 : numpy.ndarray of int
+        Indices of the pairs, with ``obj1 < obj2``, sorted by ``obj1``
+        and then by ``obj2``.
+
+    Notes
+    -----
+    See `findPairsInAnnuli`.
+    """
+    obj1, obj2, inAnnulus = findPairsInAnnuli(ra, dec, [annulus])
+    return obj1, obj2
+
+
+def findPairsInAnnuli(ra, dec, annuli):
+    """Find all pairs of positions separated by a distance within any of
+    several annuli.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians]
+    dec : numpy.array of float
+        Dec in [radians]
+    annuli : sequence of length-2 sequences of float
+        Inner and outer radii [radians] of each annulus.  A pair is in
+        annulus ``k`` if ``annuli[k][0] <= sphDist < annuli[k][1]``.
+
+    Returns
+    -------
+    obj1, obj2 : numpy.ndarray of int
+        Indices of the pairs that are in at least one annulus, with
+        ``obj1 < obj2``, sorted by ``obj1`` and then by ``obj2``.
+    inAnnulus : numpy.ndarray of bool
+        Array of shape ``(len(annuli), len(obj1))``: whether each pair is
+        in each annulus.
+
+    Notes
+    -----
+    This concatenates the blocks of `iterPairsInAnnuli`; use that directly
+    to process the pairs of a large field without holding them all.
+    """
+    blocks = list(iterPairsInAnnuli(ra, dec, annuli))
+    if not blocks:
+        nAnnuli = len(np.asarray(annuli, dtype=float).reshape(-1, 2))
+        return (np.array([], dtype=int), np.array([], dtype=int),
+                np.zeros((nAnnuli, 0), dtype=bool))
+
+    obj1, obj2, inAnnulus = zip(*blocks)
+    return np.concatenate(obj1), np.concatenate(obj2), np.concatenate(inAnnulus, axis=1)
+
+
+def iterPairsInAnnuli(ra, dec, annuli, blockSize=256):
+    """Iterate over the pairs of positions separated by a distance within
+    any of several annuli, one block of first objects at a time.
+
+    Parameters
+    ----------
+    ra : numpy.array of float
+        RA in [radians]
+    dec : numpy.array of float
+        Dec in [radians]
+    annuli : sequence of length-2 sequences of float
+        Inner and outer radii [radians] of each annulus.  A pair is in
+        annulus ``k`` if ``annuli[k][0] <= sphDist < annuli[k][1]``.
+    blockSize : int, optional
+        Number of first objects whose pairs are searched for at a time.
+
+    Yields
+    ------
+    obj1, obj2 : numpy.ndarray of int
+        Indices of the pairs of the block that are in at least one annulus,
+        with ``obj1 < obj2``, sorted by ``obj1`` and then by ``obj2``.
+        Successive blocks continue this order.
+    inAnnulus : numpy.ndarray of bool
+        Array of shape ``(len(annuli), len(obj1))``: whether each pair is
+        in each annulus.
+
+    Notes
+    -----
+    Candidate pairs of each block are found with a KD-tree on the unit
+    vectors between the chord lengths of the smallest inner and largest
+    outer radius (slightly padded for round-off), then the exact annulus
+    cuts are applied with `sphDist` so that the selection agrees with a
+    brute-force comparison of all pairs.  Only one block of candidates is
+    held at a time, so memory does not grow with the number of pairs.
+    Positions with non-finite coordinates are never paired.
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    annuli = np.asarray(annuli, dtype=float).reshape(-1, 2)
+
+    finite, = np.where(np.isfinite(ra) & np.isfinite(dec))
+    outer = annuli[:, 1].max() if len(annuli) else 0
+    if len(finite) < 2 or outer <= 0:
+        return
+
+    inner = max(annuli[:, 0].min(), 0)
+    outerChord = 2*np.sin(min(outer, np.pi)/2)*(1 + 1e-9) + 1e-15
+    innerChord = 2*np.sin(min(inner, np.pi)/2)*(1 - 1e-9) - 1e-15
+
+    vectors = raDecToUnitVector(ra[finite], dec[finite])
+    tree = cKDTree(vectors)
+    for start in range(0, len(finite), blockSize):
+        block = cKDTree(vectors[start:start + blockSize])
+        candidates = block.sparse_distance_matrix(tree, outerChord, output_type='ndarray')
+        first = candidates['i'] + start
+        second = candidates['j']
+        keep = (first < second) & (candidates['v'] >= innerChord)
+        obj1, obj2 = finite[first[keep]], finite[second[keep]]
+
+        dist = sphDist(ra[obj1], dec[obj1], ra[obj2], dec[obj2])
+        inAnnulus = (annuli[:, :1] <= dist) & (dist < annuli[:, 1:])
+        inAny = inAnnulus.any(axis=0)
+        if not inAny.any():
+            continue
+        obj1, obj2, inAnnulus = obj1[inAny], obj2[inAny], inAnnulus[:, inAny]
+
+        order = np.lexsort((obj2, obj1))
+        yield obj1[order], obj2[order], inAnnulus[:, order]
+
+
+def imapBounded(pool, func, iterable, maxPending):
+    """Apply ``func`` to each item of ``iterable`` in ``pool``, like
+    `multiprocessing.pool.ThreadPool.imap`, but with at most ``maxPending``
+    items submitted ahead of the consumer.
+
+    `~multiprocessing.pool.ThreadPool.imap` submits every item at once, so
+    all of the results may be held before they are consumed, and all of
+    the items are computed even if the consumer stops early.  Here, items
+    are only submitted as results are consumed.
+
+    Yields
+    ------
+    result
+        ``func(item)`` for each item, in order.
+    """
+    items = iter(iterable)
+    pending = deque(pool.apply_async(func, (item,)) for item in islice(items, maxPending))
+    while pending:
+        result = pending.popleft().get()
+        for item in islice(items, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield result
+
+
 def getCcdKeyName(dataid):
     """Return the key in a dataId that's referring to the CCD or moral equivalent.
 
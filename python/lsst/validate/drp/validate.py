@@ -22,20 +22,26 @@ grading, and persistence.
 """
 
 from __future__ import print_function, absolute_import
-from builtins import object
-import json
+from builtins import object, zip
+from collections import OrderedDict
+import functools
+import multiprocessing
 import os
 
 from textwrap import TextWrapper
 
+import lsst.afw.geom as afwGeom
 from lsst.validate.base import Job
 
 from .util import repoNameToPrefix
+from .persistence import LazyJob, readJson, writeJsonStream
 from .matchreduce import MatchedMultiVisitDataset
 from .photerrmodel import PhotometricErrorModel
 from .astromerrmodel import AstrometricErrorModel
 from .calcsrd import (AMxMeasurement, AFxMeasurement, ADxMeasurement,
-                      PA1Measurement, PA2Measurement, PF1Measurement)
+                      PA1Measurement, PA2Measurement, PF1Measurement,
+                      calcAMxRmsDistances)
+from .taskgraph import TaskGraph
 from .plot import (plotAMx, plotPA1, plotPhotometryErrorModel,
                    plotAstrometryErrorModel)
 
@@ -55,7 +61,7 @@ class bcolors(object):
     UNDERLINE = '\033[4m'
 
 
-def load_json_output(filepath):
+def load_json_output(filepath, lazy=False):
     """Read JSON from a file into a job object.
 
     Currently just does a trivial de-serialization with no checking
@@ -64,14 +70,23 @@ def load_json_output(filepath):
     Parameters
     ----------
     filepath : `str`
-        Source file name for JSON output.
+        Source file name for JSON output.  Arrays written to a ``.npz``
+        sidecar file by `lsst.validate.drp.persistence.writeJobJson` are
+        read from it.
+    lazy : `bool`, optional
+        Return a `lsst.validate.drp.persistence.LazyJob`, which defers the
+        deserialization of the blobs and measurement extras until they are
+        used.  This is faster when only the measured quantities are needed,
+        e.g. to print them or grade them against specifications.
 
     Returns
     -------
     job : A `validate.base.job` object.
     """
-    with open(filepath, 'r') as infile:
-        json_data = json.load(infile)
+    if lazy:
+        return LazyJob(filepath)
+
+    json_data = readJson(filepath)
 
     return Job.from_json(json_data)
 
@@ -138,7 +153,8 @@ def run(repo_or_json, metrics=None, makePrint=True, makePlot=True,
             return
 
         json_path = repo_or_json
-        job = load_json_output(json_path)
+        # The blobs and extras are only needed for the plots.
+        job = load_json_output(json_path, lazy=not makePlot)
         filterName = get_filter_name_from_job(job)
         jobs = {filterName: job}
     else:
@@ -148,20 +164,22 @@ def run(repo_or_json, metrics=None, makePrint=True, makePlot=True,
         kwargs['metrics'] = metrics
 
         repo_path = repo_or_json
-        jobs = runOneRepo(repo_path, **kwargs)
+        jobs = runOneRepo(repo_path, makePlot=makePlot, plotOutputPrefix=outputPrefix,
+                          **kwargs)
 
     for filterName, job in jobs.items():
         if makePrint:
             if metrics is None:
                 metrics = {meas.metric.name: meas.metric for meas in job.measurements}
             print_metrics(job, filterName, metrics)
-        if makePlot:
+        if makePlot and load_json:
             plot_metrics(job, filterName, outputPrefix=outputPrefix)
 
     print_pass_fail_summary(jobs, level=level)
 
 
-def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False, **kwargs):
+def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False,
+               makePlot=False, plotOutputPrefix=None, numJobs=1, **kwargs):
     """Calculate statistics for all filters in a repo.
 
     Runs multiple filters, if necessary, through repeated calls to `runOneFilter`.
@@ -186,6 +204,17 @@ def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False,
         The level of the specification to check: "design", "minimum", "stretch".
     verbose : `bool`
         Provide detailed output.
+    makePlot : `bool`, optional
+        Create plots for the metrics of each filter, as soon as it is done.
+    plotOutputPrefix : `str`, optional
+        Beginning of the plot filenames, as for `plot_metrics`.
+    numJobs : `int`, optional
+        Number of filters to process at once, each in its own process.
+
+    Returns
+    -------
+    jobs : `collections.OrderedDict`
+        `lsst.validate.base.Job` of each filter, ordered by filter name.
 
     Notes
     -----
@@ -195,11 +224,14 @@ def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False,
         will result in filenames that start with "CFHT_output_".
     The filter name is added to this prefix.  If the filter name has spaces,
         there will be annoyance and sadness as those spaces will appear in the filenames.
+
+    With ``numJobs > 1`` each worker process writes the JSON file and plots
+    of its filter, and the returned jobs are read back from those JSON files.
     """
 
-    allFilters = set([d['filter'] for d in dataIds])
+    allFilters = sorted(set([d['filter'] for d in dataIds]))
 
-    jobs = {}
+    filterArgs = []
     for filterName in allFilters:
         # Do this here so that each outputPrefix will have a different name for each filter.
         if outputPrefix is None:
@@ -207,20 +239,58 @@ def runOneRepo(repo, dataIds=None, metrics=None, outputPrefix='', verbose=False,
         else:
             thisOutputPrefix = "%s_%s_" % (outputPrefix.rstrip('_'), filterName)
         theseVisitDataIds = [v for v in dataIds if v['filter'] == filterName]
-        job = runOneFilter(repo, theseVisitDataIds, metrics,
-                           outputPrefix=thisOutputPrefix,
-                           verbose=verbose, filterName=filterName,
-                           **kwargs)
-        jobs[filterName] = job
+        filterKwargs = dict(kwargs, outputPrefix=thisOutputPrefix,
+                            verbose=verbose, filterName=filterName)
+        filterArgs.append((repo, theseVisitDataIds, metrics, filterKwargs,
+                           makePlot, plotOutputPrefix))
+
+    jobs = OrderedDict()
+    if numJobs > 1 and len(filterArgs) > 1:
+        pool = multiprocessing.Pool(min(numJobs, len(filterArgs)))
+        try:
+            jsonPaths = pool.map(_runOneFilterToJson, filterArgs)
+        finally:
+            pool.close()
+            pool.join()
+        for filterName, jsonPath in zip(allFilters, jsonPaths):
+            jobs[filterName] = load_json_output(jsonPath)
+    else:
+        for filterName, args in zip(allFilters, filterArgs):
+            jobs[filterName] = _runOneFilterAndPlot(*args)
 
     return jobs
 
 
+def _runOneFilterAndPlot(repo, visitDataIds, metrics, filterKwargs,
+                         makePlot, plotOutputPrefix):
+    job = runOneFilter(repo, visitDataIds, metrics, **filterKwargs)
+    if makePlot:
+        plot_metrics(job, filterKwargs['filterName'], outputPrefix=plotOutputPrefix)
+    return job
+
+
+def _runOneFilterToJson(args):
+    """Process one filter in a worker process of `runOneRepo`.
+
+    Returns the name of the JSON file written by `runOneFilter`, as the
+    `~lsst.validate.base.Job` itself is read back by the parent process.
+    """
+    _runOneFilterAndPlot(*args)
+    filterKwargs = args[3]
+    return _jsonFilename(filterKwargs['outputPrefix'])
+
+
+def _jsonFilename(outputPrefix):
+    return outputPrefix.rstrip('_') + '.json'
+
+
 def runOneFilter(repo, visitDataIds, metrics, brightSnr=100,
                  makePrint=True, makePlot=True, makeJson=True,
                  filterName=None, outputPrefix=None,
-                 verbose=False,
-                 **kwargs):
+                 loadThreads=1, cacheDir=None, matchDir=None, tileSize=None,
+                 seed=None, measureThreads=1, matcher='afw', incremental=False,
+                 sidecar=False, numRandomShuffles=50, numKeptShuffles=1, pa1Tolerance=None,
+                 verbose=False, **kwargs):
     """Main executable for the case where there is just one filter.
 
     Plot files and JSON files are generated in the local directory
@@ -249,54 +319,143 @@ def runOneFilter(repo, visitDataIds, metrics, brightSnr=100,
         Specify the beginning filename for output files.
     filterName : str, optional
         Name of the filter (bandpass).
+    loadThreads : int, optional
+        Number of threads used to read and calibrate the source catalogs.
+    cacheDir : str, optional
+        Directory in which to cache the calibrated source catalogs
+        between runs.
+    matchDir : str, optional
+        Directory in which to persist the matched catalog, named after
+        ``outputPrefix``.  Later runs on the same inputs reuse it.
+    tileSize : float, optional
+        Match the sources tile by tile over tiles of this size [degrees],
+        to bound the memory used by the matching on large datasets.
+        Requires the ``'afw'`` matcher.
+    seed : int, optional
+        Seed of the random shuffles of PA1, for reproducible results.
+    measureThreads : int, optional
+        Number of threads used to compute independent measurements
+        concurrently.
+    matcher : str, optional
+        Backend used to match the sources across visits: ``'afw'``
+        (`lsst.afw.table.MultiMatch`) or ``'fof'``
+        (`lsst.validate.drp.matchers.FriendsOfFriendsMatcher`).
+    incremental : bool, optional
+        If the match persisted in ``matchDir`` lacks some of the
+        ``visitDataIds``, match only those against it instead of matching
+        all the visits again.
+    numRandomShuffles : int, optional
+        Number of random shuffles of PA1, or the maximum number if
+        ``pa1Tolerance`` is given.
+    numKeptShuffles : int, optional
+        Number of PA1 random shuffles whose per-star magnitude differences
+        are kept in the measurement extras, at least 1; `None` keeps all of
+        them.
+    pa1Tolerance : float, optional
+        Stop drawing random shuffles of PA1 once the standard error of PA1
+        is below this [mmag].
+    sidecar : bool, optional
+        Write the large arrays of the JSON output to a ``.npz`` file next
+        to it, see `lsst.validate.drp.persistence.writeJsonStream`.
     verbose : bool, optional
         Output additional information on the analysis steps.
     """
     if outputPrefix is None:
         outputPrefix = repoNameToPrefix(repo)
 
-    matchedDataset = MatchedMultiVisitDataset(repo, visitDataIds,
-                                              verbose=verbose)
-    photomModel = PhotometricErrorModel(matchedDataset)
-    astromModel = AstrometricErrorModel(matchedDataset)
-    linkedBlobs = {'photomModel': photomModel, 'astromModel': astromModel}
+    if matchDir:
+        matchFile = os.path.join(matchDir, outputPrefix.rstrip('_') + '_matches.npz')
+    else:
+        matchFile = None
 
-    job = Job(blobs=[matchedDataset, photomModel, astromModel])
+    if tileSize:
+        tileSize = afwGeom.Angle(tileSize, afwGeom.degrees)
+    else:
+        tileSize = None
 
-    for x in (1, 2, 3):
-        amxName = 'AM{0:d}'.format(x)
+    matchedDataset = MatchedMultiVisitDataset(repo, visitDataIds,
+                                              loadThreads=loadThreads,
+                                              cacheDir=cacheDir,
+                                              matchFile=matchFile,
+                                              tileSize=tileSize,
+                                              matcher=matcher,
+                                              incremental=incremental,
+                                              verbose=verbose)
+    # The error models, the AMx chains and the PA1 chain only depend on
+    # matchedDataset, so they can run concurrently.
+    graph = TaskGraph()
+    graph.add('photomModel', lambda: PhotometricErrorModel(matchedDataset))
+    graph.add('astromModel', lambda: AstrometricErrorModel(matchedDataset))
+
+    # One pair search serves the annuli of AM1, AM2 and AM3.
+    graph.add('amxRmsDistances', lambda: calcAMxRmsDistances(
+        [metrics['AM{0:d}'.format(x)] for x in (1, 2, 3)],
+        matchedDataset, verbose=verbose))
+
+    def measureAMx(x, amxRmsDistances):
+        return [AMxMeasurement(metrics['AM{0:d}'.format(x)], matchedDataset, filterName,
+                               verbose=verbose, rmsDistances=amxRmsDistances[x - 1])]
+
+    def measureAFxADx(x, amxMeasurements):
+        amx, = amxMeasurements
         afxName = 'AF{0:d}'.format(x)
         adxName = 'AD{0:d}'.format(x)
-
-        AMxMeasurement(metrics[amxName], matchedDataset, filterName,
-                       job=job, linkedBlobs=linkedBlobs, verbose=verbose)
-
+        measurements = []
         for specName in metrics[afxName].get_spec_names(filter_name=filterName):
-            AFxMeasurement(metrics[afxName], matchedDataset,
-                           job.get_measurement(amxName), filterName, specName,
-                           job=job, linkedBlobs=linkedBlobs, verbose=verbose)
+            measurements.append(AFxMeasurement(metrics[afxName], matchedDataset,
+                                               amx, filterName, specName,
+                                               verbose=verbose))
+            measurements.append(ADxMeasurement(metrics[adxName], matchedDataset,
+                                               amx, filterName, specName,
+                                               verbose=verbose))
+        return measurements
 
-            ADxMeasurement(metrics[adxName], matchedDataset,
-                           job.get_measurement(amxName), filterName, specName,
-                           job=job, linkedBlobs=linkedBlobs, verbose=verbose)
-
-    PA1Measurement(metrics['PA1'], matchedDataset, filterName,
-                   job=job, linkedBlobs=linkedBlobs,
-                   verbose=verbose)
-
-    for specName in metrics['PA2'].get_spec_names(filter_name=filterName):
+    for x in (1, 2, 3):
+        amxName = 'AM{0:d}'.format(x)
+        graph.add(amxName, functools.partial(measureAMx, x), ['amxRmsDistances'])
+        graph.add('AF{0:d}/AD{0:d}'.format(x), functools.partial(measureAFxADx, x), [amxName])
+
+    graph.add('PA1', lambda: [PA1Measurement(metrics['PA1'], matchedDataset, filterName,
+                                             numRandomShuffles=numRandomShuffles,
+                                             seed=seed, numKeptShuffles=numKeptShuffles,
+                                             tolerance=pa1Tolerance,
+                                             numThreads=measureThreads,
+                                             verbose=verbose)])
+    graph.add('PA2', lambda pa1: [
         PA2Measurement(metrics['PA2'], matchedDataset,
-                       pa1=job.get_measurement('PA1'), filter_name=filterName,
-                       spec_name=specName, verbose=verbose,
-                       job=job, linkedBlobs=linkedBlobs)
-
-    for specName in metrics['PF1'].get_spec_names(filter_name=filterName):
+                       pa1=pa1[0], filter_name=filterName,
+                       spec_name=specName, verbose=verbose)
+        for specName in metrics['PA2'].get_spec_names(filter_name=filterName)], ['PA1'])
+    graph.add('PF1', lambda pa1: [
         PF1Measurement(metrics['PF1'], matchedDataset,
-                       job.get_measurement('PA1'),
-                       filterName, specName, verbose=verbose,
-                       job=job, linkedBlobs=linkedBlobs)
+                       pa1[0], filterName, specName, verbose=verbose)
+        for specName in metrics['PF1'].get_spec_names(filter_name=filterName)], ['PA1'])
+
+    results = graph.run(numThreads=measureThreads)
+
+    photomModel = results['photomModel']
+    astromModel = results['astromModel']
+    linkedBlobs = {'photomModel': photomModel, 'astromModel': astromModel}
 
-    job.write_json(outputPrefix.rstrip('_') + '.json')
+    blobs = [matchedDataset, photomModel, astromModel]
+    job = Job(blobs=blobs)
+    measurements = []
+
+    # Register the measurements in a fixed order, whatever order they
+    # were computed in.
+    for name in ('AM1', 'AF1/AD1', 'AM2', 'AF2/AD2', 'AM3', 'AF3/AD3',
+                 'PA1', 'PA2', 'PF1'):
+        for measurement in results[name]:
+            # Add external blob so that links will be persisted with
+            # the measurement
+            for blobName, blob in linkedBlobs.items():
+                setattr(measurement, blobName, blob)
+            job.register_measurement(measurement)
+            measurements.append(measurement)
+
+    # Write the blobs and measurements one at a time, rather than building
+    # the JSON of the whole job in memory.
+    writeJsonStream(_jsonFilename(outputPrefix), blobs, measurements, sidecar=sidecar)
 
     return job
 
@@ -31,7 +31,17 @@ import numpy as np
 from numpy.testing import assert_allclose
 
 import lsst.utils
-from lsst.validate.drp.calcsrd.amx import matchVisitComputeDistance
+import astropy.units as u
+
+from lsst.validate.drp.calcsrd.amx import (calcRmsDistances,
+                                           calcRmsDistancesInAnnuli,
+                                           makeObjectVisitIndex,
+                                           matchVisitComputeDistance,
+                                           matchVisitComputeDistances,
+                                           matchVisitComputeRmsDistance)
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.util import (averageRaDecByGroup, findPairsInAnnuli,
+                                    findPairsInAnnulus, iterPairsInAnnuli, sphDist)
 
 
 def test_basic_matchVisitComputeDistance():
@@ -95,6 +105,128 @@ def test_speed_matchVisitComputeDistance(N=5000):
                               visit_obj2, ra_obj2, dec_obj2)
 
 
+def test_batched_matchVisitComputeDistance():
+    np.random.seed(54321)
+    nObj = 40
+    counts = np.random.randint(1, 8, nObj)
+    visit = np.concatenate([np.random.choice(10, n, replace=False) for n in counts])
+    ra = np.deg2rad(10 + np.random.normal(0, 0.1, len(visit)))
+    dec = np.deg2rad(20 + np.random.normal(0, 0.1, len(visit)))
+    ra[::11] = np.nan
+    groups = GroupedArrays(np.concatenate(([0], np.cumsum(counts))),
+                           visit=visit, coord_ra=ra, coord_dec=dec)
+
+    obj1, obj2 = np.triu_indices(nObj, 1)
+    pairIndex, distances = matchVisitComputeDistances(groups, obj1, obj2)
+    rms = matchVisitComputeRmsDistance(groups, obj1, obj2, chunkSize=97)
+    objectVisitIndex = makeObjectVisitIndex(groups)
+    assert_allclose(matchVisitComputeRmsDistance(groups, obj1, obj2, chunkSize=97,
+                                                 objectVisitIndex=objectVisitIndex), rms)
+
+    for p, (o1, o2) in enumerate(zip(obj1, obj2)):
+        exp = matchVisitComputeDistance(
+            groups.group(o1, 'visit'), groups.group(o1, 'coord_ra'), groups.group(o1, 'coord_dec'),
+            groups.group(o2, 'visit'), groups.group(o2, 'coord_ra'), groups.group(o2, 'coord_dec'))
+        obs = distances[pairIndex == p]
+        assert_allclose(np.sort(exp), np.sort(obs), rtol=1e-12)
+        if exp:
+            assert_allclose(rms[p], np.std(exp), rtol=1e-9, atol=1e-15)
+        else:
+            assert np.isnan(rms[p])
+
+
+def bruteForcePairsInAnnulus(ra, dec, annulus):
+    """Reference O(N^2) pair search, as formerly done in calcRmsDistances."""
+    pairs = []
+    for obj1 in range(len(ra)):
+        dist = sphDist(ra[obj1], dec[obj1], ra[obj1+1:], dec[obj1+1:])
+        objectsInAnnulus, = np.where((annulus[0] <= dist) & (dist < annulus[1]))
+        pairs.extend((obj1, obj1 + 1 + obj2) for obj2 in objectsInAnnulus)
+    return pairs
+
+
+def test_findPairsInAnnulus():
+    np.random.seed(12345)
+    N = 500
+    # Straddle RA=0 to check wrapping.
+    ra = np.deg2rad(np.random.uniform(-2, 2, N) % 360)
+    dec = np.deg2rad(np.random.uniform(-2, 2, N))
+    for annulusArcmin in ([3, 7], [18, 22], [0, 5], [150, 250]):
+        annulus = np.deg2rad(np.array(annulusArcmin) / 60)
+        exp = bruteForcePairsInAnnulus(ra, dec, annulus)
+        obj1, obj2 = findPairsInAnnulus(ra, dec, annulus)
+        assert list(zip(obj1, obj2)) == exp
+
+
+def test_findPairsInAnnulus_nonfinite():
+    ra = np.deg2rad(np.array([10.0, 10.05, np.nan, 10.1]))
+    dec = np.deg2rad(np.array([20.0, 20.0, 20.0, 20.0]))
+    annulus = np.deg2rad(np.array([1, 10]) / 60)
+    obj1, obj2 = findPairsInAnnulus(ra, dec, annulus)
+    assert list(zip(obj1, obj2)) == [(0, 1), (0, 3), (1, 3)]
+
+
+def test_findPairsInAnnuli():
+    np.random.seed(12345)
+    N = 300
+    ra = np.deg2rad(np.random.uniform(-2, 2, N) % 360)
+    dec = np.deg2rad(np.random.uniform(-2, 2, N))
+    annuli = np.deg2rad(np.array([[4, 6], [19, 21], [0, 5], [150, 250]]) / 60)
+    obj1, obj2, inAnnulus = findPairsInAnnuli(ra, dec, annuli)
+    assert inAnnulus.shape == (len(annuli), len(obj1))
+    assert inAnnulus.any(axis=0).all()
+    for annulus, selected in zip(annuli, inAnnulus):
+        exp = bruteForcePairsInAnnulus(ra, dec, annulus)
+        assert list(zip(obj1[selected], obj2[selected])) == exp
+
+
+def test_iterPairsInAnnuli():
+    np.random.seed(13579)
+    N = 300
+    ra = np.deg2rad(np.random.uniform(-1, 1, N) % 360)
+    dec = np.deg2rad(np.random.uniform(-1, 1, N))
+    annuli = np.deg2rad(np.array([[4, 6], [19, 21]]) / 60)
+    blocks = list(iterPairsInAnnuli(ra, dec, annuli, blockSize=17))
+    assert len(blocks) > 1
+    obj1, obj2, inAnnulus = findPairsInAnnuli(ra, dec, annuli)
+    assert_allclose(np.concatenate([b[0] for b in blocks]), obj1)
+    assert_allclose(np.concatenate([b[1] for b in blocks]), obj2)
+    assert (np.concatenate([b[2] for b in blocks], axis=1) == inAnnulus).all()
+
+
+def test_calcRmsDistancesInAnnuli():
+    np.random.seed(2468)
+    nObj, nVisit = 60, 5
+    objRa = np.deg2rad(10 + np.random.uniform(-0.5, 0.5, nObj))
+    objDec = np.deg2rad(20 + np.random.uniform(-0.5, 0.5, nObj))
+    scatter = np.deg2rad(1e-5)
+    groups = GroupedArrays(
+        np.arange(0, nObj*nVisit + 1, nVisit),
+        visit=np.tile(np.arange(nVisit), nObj),
+        coord_ra=np.repeat(objRa, nVisit) + np.random.normal(0, scatter, nObj*nVisit),
+        coord_dec=np.repeat(objDec, nVisit) + np.random.normal(0, scatter, nObj*nVisit),
+        base_PsfFlux_mag=np.repeat(np.random.uniform(16, 23, nObj), nVisit))
+
+    magRange = np.array([17.0, 21.5]) * u.mag
+    annuli = [np.array([4, 6]) * u.arcmin, np.array([19, 21]) * u.arcmin,
+              np.array([10, 30]) * u.arcmin]
+    shared = calcRmsDistancesInAnnuli(groups, annuli, magRange)
+    assert len(shared) == len(annuli)
+    medianMag = groups.median('base_PsfFlux_mag')
+    bright = groups.subset((17.0 <= medianMag) & (medianMag < 21.5))
+    meanRa, meanDec = averageRaDecByGroup(bright['coord_ra'], bright['coord_dec'], bright.offsets)
+    for annulus, rmsDistances in zip(annuli, shared):
+        pairs = bruteForcePairsInAnnulus(meanRa, meanDec, annulus.to(u.radian).value)
+        exp = [np.std(matchVisitComputeDistance(
+            bright.group(o1, 'visit'), bright.group(o1, 'coord_ra'), bright.group(o1, 'coord_dec'),
+            bright.group(o2, 'visit'), bright.group(o2, 'coord_ra'), bright.group(o2, 'coord_dec')))
+            for o1, o2 in pairs]
+        assert len(exp) > 0
+        assert_allclose(rmsDistances.to(u.radian).value, exp, rtol=1e-9)
+        single = calcRmsDistances(groups, annulus, magRange)
+        assert_allclose(rmsDistances.to(u.radian).value, single.to(u.radian).value)
+
+
 if __name__ == "__main__":
     lsst.utils.tests.init()
     unittest.main()
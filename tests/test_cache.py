@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import lsst.utils
+
+from lsst.validate.drp.cache import MatchedCatalogCache, VisitCatalogCache
+from lsst.validate.drp.groupedarrays import GroupedArrays
+
+
+class FakeButler(object):
+    """Return the paths of on-disk files for the `*_filename` datasets."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def get(self, datasetType, dataId, immediate=False):
+        return [self.files[datasetType]]
+
+
+class FakeSchema(object):
+    def getNames(self):
+        return set(['id', 'coord_ra', 'coord_dec'])
+
+
+class VisitCatalogCacheTestCase(unittest.TestCase):
+    """Testing the per-visit catalog cache."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.files = {}
+        for dataset in ('src', 'calexp'):
+            path = os.path.join(self.tmpDir, dataset + '.fits')
+            with open(path, 'w') as outfile:
+                outfile.write(dataset)
+            self.files[dataset + '_filename'] = path
+        self.butler = FakeButler(self.files)
+        self.cache = VisitCatalogCache(os.path.join(self.tmpDir, 'cache'))
+        self.dataId = {'visit': 1, 'ccd': 2, 'filter': 'r'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testRoundTrip(self):
+        key = self.cache.makeKey(self.butler, self.tmpDir, self.dataId, FakeSchema())
+        self.assertIsNone(self.cache.get(key))
+
+        columns = {'id': np.arange(5), 'coord_ra': np.linspace(0, 1, 5),
+                   'base_PixelFlags_flag_cr': np.array([0, 1, 0, 0, 1], dtype=bool)}
+        self.cache.put(key, columns)
+        cached = self.cache.get(key)
+        self.assertEqual(set(cached.keys()), set(columns.keys()))
+        for name in columns:
+            assert_array_equal(cached[name], columns[name])
+
+    def testKeyChanges(self):
+        key = self.cache.makeKey(self.butler, self.tmpDir, self.dataId, FakeSchema())
+        otherId = dict(self.dataId, ccd=3)
+        self.assertNotEqual(key, self.cache.makeKey(self.butler, self.tmpDir, otherId, FakeSchema()))
+
+        fieldsKey = self.cache.makeKey(self.butler, self.tmpDir, self.dataId, FakeSchema(),
+                                       fields=['id', 'coord_ra'])
+        self.assertNotEqual(key, fieldsKey)
+        self.assertNotEqual(fieldsKey, self.cache.makeKey(self.butler, self.tmpDir, self.dataId,
+                                                          FakeSchema(), fields=['id', 'extra']))
+
+        with open(self.files['src_filename'], 'a') as outfile:
+            outfile.write('modified')
+        self.assertNotEqual(key, self.cache.makeKey(self.butler, self.tmpDir, self.dataId, FakeSchema()))
+
+
+class MatchedCatalogCacheTestCase(unittest.TestCase):
+    """Testing persistence of matched catalogs."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpDir, 'matches.npz')
+        self.matches = GroupedArrays.fromGroupIds(
+            [3, 1, 3, 2, 1], coord_ra=np.arange(5.), visit=np.array([10, 10, 11, 11, 12]),
+            base_PixelFlags_flag_cr=np.array([0, 0, 1, 0, 0], dtype=bool))
+        self.description = {'repo': '/repo', 'matchRadiusArcsec': 1.0,
+                            'inputs': [[[('ccd', '1'), ('visit', '10')], None]]}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testRoundTrip(self):
+        cache = MatchedCatalogCache(self.filename)
+        self.assertIsNone(cache.read(self.description))
+        cache.write(self.matches, self.description)
+
+        matches = cache.read(self.description)
+        assert_array_equal(matches.offsets, self.matches.offsets)
+        assert_array_equal(matches.ids, self.matches.ids)
+        self.assertEqual(set(matches.names), set(self.matches.names))
+        for name in self.matches.names:
+            assert_array_equal(matches[name], self.matches[name])
+
+    def testChangedInputs(self):
+        cache = MatchedCatalogCache(self.filename)
+        cache.write(self.matches, self.description)
+        changed = dict(self.description, matchRadiusArcsec=2.0)
+        self.assertIsNone(cache.read(changed))
+        self.assertIsNotNone(cache.read())
+
+    def testReadForUpdate(self):
+        cache = MatchedCatalogCache(self.filename)
+        self.assertEqual(cache.readForUpdate(self.description), (None, None))
+        cache.write(self.matches, self.description)
+
+        newInput = [[('ccd', '1'), ('visit', '11')], None]
+        extended = dict(self.description, inputs=[newInput] + self.description['inputs'])
+        matches, newInputs = cache.readForUpdate(extended)
+        self.assertEqual(newInputs, [0])
+        assert_array_equal(matches.offsets, self.matches.offsets)
+
+        self.assertEqual(cache.readForUpdate(dict(extended, matchRadiusArcsec=2.0)),
+                         (None, None))
+        self.assertEqual(cache.readForUpdate(dict(self.description, inputs=[newInput])),
+                         (None, None))
+
+    def testStatistics(self):
+        cache = MatchedCatalogCache(self.filename)
+        cache.write(self.matches, self.description)
+        self.assertIsNone(cache.readStatistics())
+
+        statistics = {'count': self.matches.counts, 'mag_mean': np.array([1., 2., 3.])}
+        cache.write(self.matches, self.description, statistics=statistics)
+        state = cache.readStatistics()
+        self.assertEqual(set(state), set(statistics))
+        for name, values in statistics.items():
+            assert_array_equal(state[name], values)
+        self.assertEqual(set(cache.read(self.description).names), set(self.matches.names))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -30,10 +30,21 @@ import numpy as np
 from numpy.testing import assert_allclose
 
 import lsst.utils
+import lsst.afw.geom as afwGeom
+import lsst.afw.coord as afwCoord
 
 from lsst.validate.drp import util
 
 
+def afwAverageRaDec(ra, dec):
+    """Reference average using afw coordinate objects."""
+    coords = [afwCoord.IcrsCoord(afwGeom.Angle(r, afwGeom.radians),
+                                 afwGeom.Angle(d, afwGeom.radians))
+              for (r, d) in zip(ra, dec)]
+    meanRa, meanDec = afwCoord.averageCoord(coords)
+    return meanRa.asRadians(), meanDec.asRadians()
+
+
 class CoordTestCase(unittest.TestCase):
     """Testing basic coordinate calculations."""
 
@@ -60,6 +71,35 @@ class CoordTestCase(unittest.TestCase):
         meanRa, meanDec = util.averageRaDec(self.simpleRa, self.simpleDec)
         assert_allclose([19.493625, 37.60447], np.rad2deg([meanRa, meanDec]))
 
+    def testWrapAverageCoord(self):
+        meanRa, meanDec = util.averageRaDec(np.deg2rad(self.wrapRa), np.deg2rad(self.wrapDec))
+        expRa, expDec = afwAverageRaDec(np.deg2rad(self.wrapRa), np.deg2rad(self.wrapDec))
+        microarcsec = np.deg2rad(1e-6/3600)
+        assert_allclose([meanRa, meanDec], [expRa, expDec], rtol=0, atol=1e-3*microarcsec)
+
+    def testAverageCoordByGroup(self):
+        """Does the batched average match afw averageCoord for each group?"""
+        np.random.seed(4321)
+        counts = np.random.randint(1, 10, 50)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        centerRa = np.repeat(np.random.uniform(0, 360, len(counts)), counts)
+        centerDec = np.repeat(np.random.uniform(-89.9, 89.9, len(counts)), counts)
+        ra = np.deg2rad((centerRa + np.random.normal(0, 1e-4, len(centerRa))) % 360)
+        dec = np.deg2rad(centerDec + np.random.normal(0, 1e-4, len(centerDec)))
+
+        meanRa, meanDec = util.averageRaDecByGroup(ra, dec, offsets)
+        microarcsec = np.deg2rad(1e-6/3600)
+        for i in range(len(counts)):
+            expRa, expDec = afwAverageRaDec(ra[offsets[i]:offsets[i+1]],
+                                            dec[offsets[i]:offsets[i+1]])
+            self.assertLess(util.sphDist(meanRa[i], meanDec[i], expRa, expDec), 1e-3*microarcsec)
+
+        rms = util.positionRmsByGroup(ra, dec, offsets)
+        for i in range(len(counts)):
+            r, d = ra[offsets[i]:offsets[i+1]], dec[offsets[i]:offsets[i+1]]
+            expRa, expDec = afwAverageRaDec(r, d)
+            assert_allclose(rms[i], util.positionRms(expRa, expDec, r, d), rtol=1e-6, atol=1e-6)
+
 
 def setup_module(module):
     lsst.utils.tests.init()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+
+from lsst.validate.drp.groupedarrays import GroupedArrays
+
+
+class GroupedArraysTestCase(unittest.TestCase):
+    """Testing per-group reductions against per-group numpy calls."""
+
+    def setUp(self):
+        np.random.seed(2017)
+        nSources = 300
+        self.groupIds = np.random.randint(100, 160, nSources)
+        self.values = np.random.normal(20, 2, nSources)
+        self.values[::37] = np.nan
+        self.flags = np.random.uniform(size=nSources) < 0.05
+        self.groups = GroupedArrays.fromGroupIds(self.groupIds, values=self.values,
+                                                 flags=self.flags)
+        self.perGroup = [self.values[self.groupIds == i] for i in self.groups.ids]
+
+    def tearDown(self):
+        pass
+
+    def testPacking(self):
+        assert_array_equal(self.groups.ids, np.unique(self.groupIds))
+        assert_array_equal(self.groups.counts, [len(v) for v in self.perGroup])
+        for i, exp in enumerate(self.perGroup):
+            assert_array_equal(self.groups.group(i, 'values'), exp)
+
+    def testReductions(self):
+        for method, func in (('mean', np.mean), ('std', np.std),
+                             ('median', np.median), ('max', np.max), ('min', np.min)):
+            exp = [func(v) for v in self.perGroup]
+            obs = getattr(self.groups, method)('values')
+            assert_allclose(obs, exp, rtol=1e-12, err_msg=method)
+
+    def testAnyAll(self):
+        perGroupFlags = [self.flags[self.groupIds == i] for i in self.groups.ids]
+        assert_array_equal(self.groups.any('flags'), [f.any() for f in perGroupFlags])
+        assert_array_equal(self.groups.all(~self.groups['flags']), [(~f).all() for f in perGroupFlags])
+
+    def testSubset(self):
+        keep = self.groups.counts >= 5
+        subset = self.groups.subset(keep)
+        assert_array_equal(subset.ids, self.groups.ids[keep])
+        assert_allclose(subset.mean('values'), self.groups.mean('values')[keep])
+
+        isFinite = np.isfinite(self.values[np.argsort(self.groupIds, kind='mergesort')])
+        finite = self.groups.subsetSources(isFinite)
+        self.assertEqual(len(finite), len(self.groups))
+        assert_allclose(finite.median('values'), [np.median(v[np.isfinite(v)]) for v in self.perGroup])
+
+    def testGroupColumns(self):
+        self.groups.setGroupColumn('meanValue', self.groups.mean('values'))
+        keep = self.groups.counts >= 5
+        subset = self.groups.subset(keep)
+        assert_allclose(subset.groupColumns['meanValue'], subset.mean('values'))
+        self.assertIn('meanValue', subset.subsetSources(np.ones(subset.offsets[-1], dtype=bool)).groupColumns)
+
+    def testAggregate(self):
+        obs = self.groups.aggregate(lambda cat: len(cat.get('values')))
+        assert_array_equal(obs, self.groups.counts)
+        obs = self.groups.aggregate(np.mean, field='values')
+        assert_allclose(obs, [np.mean(v) for v in self.perGroup])
+
+    def testConcatenate(self):
+        first = self.groups.subset(np.arange(len(self.groups)) < 20)
+        second = self.groups.subset(np.arange(len(self.groups)) >= 20)
+        first.setGroupColumn('index', np.arange(20))
+        second.setGroupColumn('index', np.arange(20, len(self.groups)))
+        merged = GroupedArrays.concatenate([first, second])
+        assert_array_equal(merged.offsets, self.groups.offsets)
+        assert_array_equal(merged.ids, self.groups.ids)
+        assert_array_equal(merged['values'], self.groups['values'])
+        assert_array_equal(merged.groupColumns['index'], np.arange(len(self.groups)))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+
+from __future__ import print_function
+from builtins import range
+
+import os
+import threading
+import time
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+import lsst.utils.tests
+
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.matchers import FriendsOfFriendsMatcher
+from lsst.validate.drp.matchreduce import MatchedMultiVisitDataset
+from lsst.validate.drp.reducers import RunningMatchStatistics
+from lsst.validate.drp.util import averageRaDecByGroup, sphDist
+
+
+def bruteForceGroups(ra, dec, matchRadius):
+    """Friends-of-friends groups from all pairwise distances, as a set of
+    frozensets of source indices."""
+    n = len(ra)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i in range(n):
+        close = np.flatnonzero(sphDist(ra[i], dec[i], ra, dec) < matchRadius)
+        for j in close:
+            parent[find(j)] = find(i)
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), set()).add(i)
+    return set(frozenset(g) for g in groups.values())
+
+
+def makeVisits(random, starRa, starDec, matchRadius, numVisits):
+    """Detect 90% of the stars in each visit, with a scatter of a fifth of
+    the match radius."""
+    raList, decList = [], []
+    for visit in range(numVisits):
+        detected = random.uniform(size=len(starRa)) < 0.9
+        scatter = 0.2*matchRadius
+        raList.append(starRa[detected] + random.normal(0, scatter, detected.sum()))
+        decList.append(starDec[detected] + random.normal(0, scatter, detected.sum()))
+    return raList, decList
+
+
+def groupsFromIds(objectIds):
+    groups = {}
+    for i, objectId in enumerate(objectIds):
+        groups.setdefault(objectId, set()).add(i)
+    return set(frozenset(g) for g in groups.values())
+
+
+class FriendsOfFriendsMatcherTestCase(unittest.TestCase):
+    """Testing the vectorized friends-of-friends matcher."""
+
+    def setUp(self):
+        random = np.random.RandomState(12345)
+        self.matchRadius = np.radians(1./3600)
+        numStars = 200
+        # A crowded field, where neighbouring stars are linked.
+        starRa = np.radians(150. + random.uniform(0, 0.01, numStars))
+        starDec = np.radians(2. + random.uniform(0, 0.01, numStars))
+        self.numVisits = 4
+        self.raList, self.decList = makeVisits(random, starRa, starDec, self.matchRadius,
+                                               self.numVisits)
+
+    def testMatchesBruteForce(self):
+        matcher = FriendsOfFriendsMatcher(self.matchRadius)
+        objectIdList = matcher.match(self.raList, self.decList)
+        self.assertEqual([len(ids) for ids in objectIdList],
+                         [len(ra) for ra in self.raList])
+
+        ra = np.concatenate(self.raList)
+        dec = np.concatenate(self.decList)
+        self.assertEqual(groupsFromIds(np.concatenate(objectIdList)),
+                         bruteForceGroups(ra, dec, self.matchRadius))
+
+    def testIdsInOrderOfFirstSource(self):
+        matcher = FriendsOfFriendsMatcher(self.matchRadius)
+        objectIds = np.concatenate(matcher.match(self.raList, self.decList))
+        firstIds = objectIds[np.sort(np.unique(objectIds, return_index=True)[1])]
+        np.testing.assert_array_equal(firstIds, np.arange(len(firstIds)))
+
+    def testNonFiniteAndEmpty(self):
+        matcher = FriendsOfFriendsMatcher(self.matchRadius)
+        ra = np.array([0.1, np.nan, 0.1, np.nan])
+        dec = np.array([0.2, 0.2, 0.2, np.nan])
+        objectIds = matcher.matchArrays(ra, dec)
+        self.assertEqual(objectIds[0], objectIds[2])
+        self.assertEqual(len(set(objectIds)), 3)
+
+        objectIdList = matcher.match([np.array([]), np.array([])],
+                                     [np.array([]), np.array([])])
+        self.assertEqual([len(ids) for ids in objectIdList], [0, 0])
+
+
+class Radians(object):
+    """Stand-in for `lsst.afw.geom.Angle`."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def asRadians(self):
+        return self.value
+
+
+class ExtendMatchTestCase(unittest.TestCase):
+    """Testing the incremental addition of visits to a match."""
+
+    def setUp(self):
+        random = np.random.RandomState(54321)
+        self.matchRadius = np.radians(1./3600)
+        # Isolated stars, 10 arcseconds apart.
+        ra, dec = np.meshgrid(np.arange(15), np.arange(15))
+        starRa = np.radians(150. + ra.flatten()*10./3600)
+        starDec = np.radians(2. + dec.flatten()*10./3600)
+        self.numVisits = 4
+        self.raList, self.decList = makeVisits(random, starRa, starDec, self.matchRadius,
+                                               self.numVisits)
+
+    def visitColumns(self, visit):
+        n = len(self.raList[visit])
+        columns = {'id': np.arange(n), 'coord_ra': self.raList[visit],
+                   'coord_dec': self.decList[visit],
+                   'base_PsfFlux_mag': np.full(n, 20.) + 0.01*visit,
+                   'base_PsfFlux_magerr': np.full(n, 0.01),
+                   'base_PsfFlux_snr': np.full(n, 100.) + visit,
+                   'base_ClassificationExtendedness_value': np.zeros(n)}
+        for flagName in MatchedMultiVisitDataset._flagNames:
+            columns[flagName] = np.zeros(n, dtype=bool)
+        return columns
+
+    def extend(self, previous, catalogs, dataIds):
+        statistics = RunningMatchStatistics.fromGroups(previous,
+                                                       MatchedMultiVisitDataset._flagNames)
+        return MatchedMultiVisitDataset._extendMatch(previous, statistics, catalogs, dataIds,
+                                                     'ccd', Radians(self.matchRadius))
+
+    def match(self, visits):
+        matcher = FriendsOfFriendsMatcher(self.matchRadius)
+        objectIds = matcher.match([self.raList[v] for v in visits],
+                                  [self.decList[v] for v in visits])
+        columns = [self.visitColumns(v) for v in visits]
+        return GroupedArrays.fromGroupIds(
+            np.concatenate(objectIds),
+            visit=np.concatenate([np.full(len(ids), v, dtype=np.int32)
+                                  for v, ids in zip(visits, objectIds)]),
+            ccd=np.zeros(sum(len(ids) for ids in objectIds), dtype=np.int32),
+            **{name: np.concatenate([c[name] for c in columns]) for name in columns[0]})
+
+    def groups(self, matches):
+        return set(frozenset(zip(matches.group(i, 'visit'), matches.group(i, 'id')))
+                   for i in range(len(matches)))
+
+    def testSameAsFullMatch(self):
+        previousVisits = list(range(self.numVisits - 1))
+        newVisit = self.numVisits - 1
+        dataIds = [{'visit': newVisit, 'ccd': 0}]
+        extended, statistics = self.extend(self.match(previousVisits),
+                                           [(0, self.visitColumns(newVisit))], dataIds)
+
+        self.assertEqual(self.groups(extended),
+                         self.groups(self.match(previousVisits + [newVisit])))
+
+        # The statistics are updated with the new sources, in group order.
+        assert_array_equal(statistics.count, extended.counts)
+        assert_allclose(statistics.snr.value, extended.median('base_PsfFlux_snr'))
+        meanRa, meanDec = averageRaDecByGroup(extended['coord_ra'], extended['coord_dec'],
+                                              extended.offsets)
+        ra, dec = statistics.positions.meanRaDec()
+        assert_allclose(ra, meanRa, rtol=0, atol=1e-14)
+        assert_allclose(dec, meanDec, rtol=0, atol=1e-14)
+
+    def testUpdatedPositions(self):
+        # Each visit drifts by 0.6 radius, so the sources of the last visit
+        # are only within the radius of the mean of the visits before.
+        raList = [self.raList[0] + 0.6*visit*self.matchRadius for visit in range(3)]
+        self.raList[:3] = raList
+        self.decList[:3] = [self.decList[0]]*3
+        extended, statistics = self.extend(
+            self.match([0]), [(0, self.visitColumns(1)), (1, self.visitColumns(2))],
+            [{'visit': 1, 'ccd': 0}, {'visit': 2, 'ccd': 0}])
+
+        self.assertEqual(len(extended), len(raList[0]))
+        assert_array_equal(statistics.count, extended.counts)
+
+    def testOneSourcePerVisit(self):
+        previous = self.match([0])
+        columns = self.visitColumns(1)
+        # Duplicate the sources of visit 1 with a small offset.
+        doubled = {name: np.concatenate([values, values]) for name, values in columns.items()}
+        doubled['coord_ra'][len(columns['id']):] += 0.1*self.matchRadius
+        doubled['id'][len(columns['id']):] += len(columns['id'])
+        extended = self.extend(previous, [(0, doubled)], [{'visit': 1, 'ccd': 0}])[0]
+
+        self.assertEqual(extended.offsets[-1], previous.offsets[-1] + len(doubled['id']))
+        for i in range(len(extended)):
+            visits = extended.group(i, 'visit')
+            self.assertEqual(len(visits), len(set(visits)))
+
+
+class TileMatcherTestCase(unittest.TestCase):
+    """Test that tiled matching is restricted to MultiMatch."""
+
+    def testFofRejected(self):
+        with self.assertRaises(ValueError):
+            MatchedMultiVisitDataset('repo', [{'filter': 'r', 'visit': 1, 'ccd': 1}],
+                                     matchRadius=Radians(np.radians(1./3600)),
+                                     tileSize=Radians(np.radians(1.)), matcher='fof')
+
+
+class IterCatalogsTestCase(unittest.TestCase):
+    """Test that catalogs are loaded in order, with bounded read-ahead."""
+
+    def testBoundedPrefetch(self):
+        dataIds = [{'visit': visit, 'ccd': 1} for visit in range(20)]
+        lock = threading.Lock()
+        loaded = []
+        consumed = []
+        maxAhead = [0]
+
+        def loadCatalog(dataId):
+            with lock:
+                loaded.append(dataId['visit'])
+                maxAhead[0] = max(maxAhead[0], len(loaded) - len(consumed))
+            return {'id': np.arange(3)}
+
+        for loadThreads in (1, 3):
+            del loaded[:], consumed[:]
+            maxAhead[0] = 0
+            for index, catalog in MatchedMultiVisitDataset._iterCatalogs(
+                    loadCatalog, dataIds, 'ccd', loadThreads=loadThreads):
+                time.sleep(0.005)
+                with lock:
+                    consumed.append(index)
+            self.assertEqual(consumed, list(range(len(dataIds))))
+            self.assertLessEqual(maxAhead[0], loadThreads + 1)
+
+
+class MatcherCrossCheckTestCase(unittest.TestCase):
+    """Cross-check the friends-of-friends matcher against afw MultiMatch
+    on the processed CFHT validation data.
+
+    Run ``examples/runCfhtQuickTest.sh`` to create the repository, or set
+    ``VALIDATE_DRP_CFHT_REPO`` to its path.
+    """
+
+    def setUp(self):
+        validateDrpDir = lsst.utils.getPackageDir('validate_drp')
+        self.repo = os.environ.get('VALIDATE_DRP_CFHT_REPO',
+                                   os.path.join(validateDrpDir, 'CfhtQuick', 'output'))
+        if not os.path.isdir(self.repo):
+            raise unittest.SkipTest('No processed CFHT repository at %s' % self.repo)
+        self.dataIds = [{'visit': visit, 'ccd': 12, 'filter': 'r'}
+                        for visit in (849375, 850587)]
+
+    def testSameGroups(self):
+        groups = {}
+        for matcher in ('afw', 'fof'):
+            dataset = MatchedMultiVisitDataset(self.repo, self.dataIds, matcher=matcher)
+            matches = dataset._matchedCatalog
+            groups[matcher] = set(
+                frozenset(zip(matches.group(i, 'visit'), matches.group(i, 'id')))
+                for i in range(len(matches)))
+
+        self.assertEqual(sum(len(g) for g in groups['afw']),
+                         sum(len(g) for g in groups['fof']))
+        # MultiMatch links each source to the first source of an object,
+        # friends-of-friends links are transitive, so only objects closer
+        # than the match radius to each other may be grouped differently.
+        different = groups['afw'] ^ groups['fof']
+        self.assertLess(len(different), 0.01*len(groups['afw']))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
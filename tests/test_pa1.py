@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+from __future__ import print_function
+
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import astropy.units as u
+
+import lsst.utils
+from lsst.validate.base import Datum
+
+from lsst.validate.drp.calcsrd import pa1
+from lsst.validate.drp.calcsrd.pa1 import (PA1Measurement, calcPa1, calcPa1Sample, computeWidths,
+                                           getRandomDiff, getRandomDiffsByGroup)
+from lsst.validate.drp.calcsrd.pa2 import PA2Measurement
+from lsst.validate.drp.calcsrd.pf1 import PF1Measurement
+from lsst.validate.drp.groupedarrays import GroupedArrays
+
+
+class Pa1TestCase(unittest.TestCase):
+    """Testing the batched sampling of pairs of visits for PA1."""
+
+    def setUp(self):
+        np.random.seed(1234)
+        counts = np.random.randint(2, 6, 200)
+        counts[:3] = 2
+        self.mags = np.random.normal(20, 0.01, counts.sum())
+        self.matches = GroupedArrays(np.concatenate(([0], np.cumsum(counts))),
+                                     base_PsfFlux_mag=self.mags)
+
+    def testDiffsArePairsOfDistinctVisits(self):
+        magDiffs = getRandomDiffsByGroup(self.matches, 'base_PsfFlux_mag', 20)
+        self.assertEqual(magDiffs.shape, (20, len(self.matches)))
+        for i in range(len(self.matches)):
+            mags = self.matches.group(i, 'base_PsfFlux_mag')
+            possible = (mags[:, np.newaxis] - mags)[~np.eye(len(mags), dtype=bool)]
+            for diff in magDiffs[:, i]:
+                self.assertTrue(np.any(np.isclose(diff, possible, rtol=0, atol=1e-12)))
+
+    def testDistributionMatchesShuffle(self):
+        """Each ordered pair of distinct visits is equally likely, as with
+        getRandomDiff."""
+        mags = np.array([0., 1., 3.])
+        matches = GroupedArrays([0, 3], base_PsfFlux_mag=mags)
+        nSamples = 6000
+        batched = getRandomDiffsByGroup(matches, 'base_PsfFlux_mag', nSamples)[:, 0]
+        shuffled = np.array([getRandomDiff(mags) for _ in range(nSamples)])
+        for diff in (-3, -2, -1, 1, 2, 3):
+            self.assertAlmostEqual(np.mean(batched == diff), 1/6., delta=0.025)
+            self.assertAlmostEqual(np.mean(shuffled == diff), 1/6., delta=0.025)
+
+    def testSingleObservation(self):
+        matches = GroupedArrays([0, 1, 3], base_PsfFlux_mag=[20., 21., 22.])
+        magDiffs = getRandomDiffsByGroup(matches, 'base_PsfFlux_mag', 4)
+        self.assertTrue(np.all(np.isnan(magDiffs[:, 0])))
+        self.assertTrue(np.all(np.abs(magDiffs[:, 1]) == 1))
+
+    def testComputeWidthsAxis(self):
+        array = np.random.normal(0, 5, (7, 100))
+        rms, iqr = computeWidths(array, axis=1)
+        for row, r, q in zip(array, rms, iqr):
+            assert_allclose(computeWidths(row), (r, q))
+
+    def testCalcPa1(self):
+        results = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=10)
+        self.assertEqual(results['magDiff'].shape, (10, len(self.matches)))
+        self.assertEqual(results['magMean'].shape, (10, len(self.matches)))
+        self.assertEqual(results['rms'].shape, (10,))
+        # Gaussian scatter of 10 mmag.
+        self.assertAlmostEqual(results['PA1'].to('mmag').value, 10, delta=1.5)
+        assert_allclose(results['magMean'][0].to('mag').value,
+                        self.matches.mean('base_PsfFlux_mag'))
+
+    def testKeptShuffles(self):
+        whole = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=23, seed=5)
+        kept = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=23, seed=5,
+                       numKeptShuffles=12)
+        self.assertEqual(kept['magDiff'].shape, (12, len(self.matches)))
+        self.assertEqual(kept['magMean'].shape, (12, len(self.matches)))
+        assert_array_equal(kept['keptShuffles'], np.arange(12))
+        assert_array_equal(kept['magDiff'], whole['magDiff'][:12])
+        assert_array_equal(kept['rms'], whole['rms'])
+        self.assertEqual(kept['PA1'], whole['PA1'])
+
+    def testTolerance(self):
+        whole = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=200, seed=3)
+        self.assertEqual(len(whole['iqr']), 200)
+        tolerance = 3 * whole['PA1Err']
+        adaptive = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=200, seed=3,
+                           tolerance=tolerance)
+        numShuffles = len(adaptive['iqr'])
+        self.assertLess(numShuffles, 200)
+        self.assertLess(adaptive['PA1Err'], tolerance)
+        assert_array_equal(adaptive['iqr'], whole['iqr'][:numShuffles])
+
+        threaded = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=200, seed=3,
+                           tolerance=tolerance, numThreads=4)
+        assert_array_equal(threaded['iqr'], adaptive['iqr'])
+        self.assertEqual(threaded['PA1'], adaptive['PA1'])
+
+        capped = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=15, seed=3,
+                         tolerance=1e-6)
+        self.assertEqual(len(capped['iqr']), 15)
+
+    def testToleranceStopsDrawing(self):
+        """Once the tolerance is reached, no more batches are drawn than
+        those already in flight."""
+        numThreads = 4
+        with mock.patch.object(pa1, 'getRandomDiffsByGroup',
+                               wraps=pa1.getRandomDiffsByGroup) as draw:
+            result = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=1000, seed=3,
+                             tolerance=1e6, numThreads=numThreads)
+        self.assertEqual(len(result['iqr']), 10)
+        self.assertLessEqual(draw.call_count, numThreads + 1)
+
+    def testSeedIsReproducible(self):
+        first = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=8, seed=42)
+        np.random.seed(999)
+        second = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=8, seed=42)
+        assert_array_equal(first['magDiff'], second['magDiff'])
+        self.assertEqual(first['PA1'], second['PA1'])
+        other = calcPa1(self.matches, 'base_PsfFlux_mag', numRandomShuffles=8, seed=43)
+        self.assertFalse(np.array_equal(first['magDiff'], other['magDiff']))
+
+    def testSplitShuffles(self):
+        """Realizations computed in separate calls, as by separate
+        processes, are identical to those computed in one call."""
+        whole = getRandomDiffsByGroup(self.matches, 'base_PsfFlux_mag', 10, seed=7)
+        parts = [getRandomDiffsByGroup(self.matches, 'base_PsfFlux_mag', n, seed=7, firstShuffle=k)
+                 for k, n in ((0, 3), (3, 6), (9, 1))]
+        assert_array_equal(whole, np.concatenate(parts))
+        # Across batches of realizations.
+        across = getRandomDiffsByGroup(self.matches, 'base_PsfFlux_mag', 30, seed=7)
+        parts = [getRandomDiffsByGroup(self.matches, 'base_PsfFlux_mag', n, seed=7, firstShuffle=k)
+                 for k, n in ((0, 7), (7, 16), (23, 7))]
+        assert_array_equal(across, np.concatenate(parts))
+        assert_array_equal(across[:10], whole)
+        sample = calcPa1Sample(self.matches, 'base_PsfFlux_mag', seed=7, shuffle=4)
+        assert_allclose(sample.magDiffs, whole[4] * 1000 / np.sqrt(2))
+
+
+class FakeSpec(object):
+    """Stand-in for a metric or a specification, which is its own
+    specification at every level.
+    """
+
+    def __init__(self, datum=None, **dependencies):
+        self.datum = datum
+        self.__dict__.update(dependencies)
+
+    def get_spec(self, name, filter_name=None):
+        return self
+
+
+class FakeMatchedDataset(object):
+
+    def __init__(self, safeMatches, magKey):
+        self.safeMatches = safeMatches
+        self.magKey = magKey
+
+
+class PA1MeasurementTestCase(unittest.TestCase):
+    """Testing the measurements that use the magnitude differences kept by
+    PA1Measurement."""
+
+    def setUp(self):
+        np.random.seed(4321)
+        counts = np.random.randint(2, 6, 200)
+        matches = GroupedArrays(np.concatenate(([0], np.cumsum(counts))),
+                                base_PsfFlux_mag=np.random.normal(20, 0.01, counts.sum()))
+        self.matchedDataset = FakeMatchedDataset(matches, 'base_PsfFlux_mag')
+
+    def testDefaultKeptShuffle(self):
+        pa1 = PA1Measurement(FakeSpec(), self.matchedDataset, 'r', numRandomShuffles=20, seed=2)
+        self.assertEqual(pa1.magDiff.shape, (1, len(self.matchedDataset.safeMatches)))
+
+        pa2Metric = FakeSpec(PF1=FakeSpec(Datum(20 * u.Unit(''))))
+        pa2 = PA2Measurement(pa2Metric, self.matchedDataset, pa1, 'r', 'design')
+        self.assertEqual(pa2.quantity.unit, u.mmag)
+        self.assertGreater(pa2.quantity.value, 0)
+
+        pf1Metric = FakeSpec(PA2=FakeSpec(Datum(15 * u.mmag)))
+        pf1 = PF1Measurement(pf1Metric, self.matchedDataset, pa1, 'r', 'design')
+        self.assertTrue(0 <= pf1.quantity.value <= 100)
+
+    def testNoKeptShuffle(self):
+        with self.assertRaises(ValueError):
+            PA1Measurement(FakeSpec(), self.matchedDataset, 'r', numRandomShuffles=20,
+                           numKeptShuffles=0)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
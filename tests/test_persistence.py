@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import astropy.units as u
+
+import lsst.utils
+import lsst.utils.tests
+from lsst.validate.base import Datum
+
+from lsst.validate.drp import persistence
+from lsst.validate.drp.persistence import (LazyJob, readJson, sidecarFilename, writeJson,
+                                           writeJsonStream)
+
+
+def asLists(jsonData):
+    """Convert the arrays read from a sidecar file to lists, as read from
+    plain JSON."""
+    return json.loads(json.dumps(jsonData, default=lambda array: array.tolist()))
+
+
+class JsonItem(object):
+    """Blob or measurement with the given JSON."""
+
+    def __init__(self, jsonData):
+        self.json = jsonData
+
+
+class FakeMeasurement(object):
+    def __init__(self, jsonData):
+        self.quantity = jsonData['value']
+        self.metric_name = jsonData['metric']['name']
+        self.spec_name = jsonData['spec_name']
+        self.extras = {name: datum['value'] for name, datum in jsonData['extras'].items()}
+        for name, value in self.extras.items():
+            setattr(self, name, value)
+        self.blobs = jsonData['blobs']
+
+
+class FakeJob(object):
+    """Record the jobs deserialized from JSON."""
+
+    deserialized = []
+
+    def __init__(self, jsonData):
+        self.blobs = jsonData['blobs']
+        self._measurements = [FakeMeasurement(m) for m in jsonData['measurements']]
+        self.spec_levels = ['design']
+
+    @classmethod
+    def from_json(cls, jsonData):
+        cls.deserialized.append(jsonData)
+        return cls(jsonData)
+
+    @property
+    def measurements(self):
+        return iter(self._measurements)
+
+    def get_measurement(self, metric_name, spec_name=None, filter_name=None):
+        for measurement in self._measurements:
+            isSpec = spec_name in (None, measurement.spec_name)
+            if measurement.metric_name == metric_name and isSpec:
+                return measurement
+        raise RuntimeError(metric_name)
+
+
+class SidecarTestCase(unittest.TestCase):
+    """Testing JSON persistence with a sidecar file of arrays."""
+
+    def setUp(self):
+        testDataDir = os.path.dirname(os.path.abspath(__file__))
+        self.jsonFile = os.path.join(testDataDir, 'CfhtQuick_output_r.json')
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testRoundTrip(self):
+        jsonData = readJson(self.jsonFile)
+        with open(self.jsonFile) as infile:
+            self.assertEqual(jsonData, json.load(infile))
+
+        filepath = os.path.join(self.tmpDir, 'job.json')
+        writeJson(jsonData, filepath)
+        self.assertTrue(os.path.exists(sidecarFilename(filepath)))
+        # The metric definitions of this small job remain in the JSON.
+        self.assertLess(os.path.getsize(filepath), os.path.getsize(self.jsonFile) / 2)
+        self.assertEqual(asLists(readJson(filepath)), jsonData)
+
+        # Arrays that were read from a sidecar are written back to one.
+        resolved = readJson(filepath)
+        writeJson(resolved, filepath)
+        self.assertEqual(asLists(readJson(filepath)), jsonData)
+
+    def testArraysForDatum(self):
+        jsonData = readJson(self.jsonFile)
+        filepath = os.path.join(self.tmpDir, 'job.json')
+        writeJson(jsonData, filepath)
+
+        blob = readJson(filepath)['blobs'][0]
+        self.assertIsInstance(blob['data']['dist']['value'], np.ndarray)
+        datum = Datum.from_json(blob['data']['dist'])
+        assert_array_equal(datum.quantity.value, jsonData['blobs'][0]['data']['dist']['value'])
+        self.assertEqual(datum.quantity.unit, u.marcsec)
+
+    def testSmallArraysStayInJson(self):
+        jsonData = {'a': {'value': [1., 2., 3.]}, 'b': ['x'] * 200, 'c': [[1, 2], [3]]}
+        filepath = os.path.join(self.tmpDir, 'small.json')
+        open(sidecarFilename(filepath), 'w').close()
+
+        writeJson(jsonData, filepath)
+        self.assertFalse(os.path.exists(sidecarFilename(filepath)))
+        with open(filepath) as infile:
+            self.assertEqual(json.load(infile), jsonData)
+
+        writeJson(jsonData, filepath, minSize=3)
+        with open(filepath) as infile:
+            manifest = json.load(infile)
+        self.assertNotEqual(manifest['a']['value'], jsonData['a']['value'])
+        self.assertEqual(manifest['b'], jsonData['b'])
+        self.assertEqual(asLists(readJson(filepath)), jsonData)
+
+    def testStream(self):
+        jsonData = readJson(self.jsonFile)
+        blobs = [JsonItem(blob) for blob in jsonData['blobs']]
+        measurements = [JsonItem(m) for m in jsonData['measurements']]
+
+        filepath = os.path.join(self.tmpDir, 'stream.json')
+        writeJsonStream(filepath, blobs, measurements)
+        self.assertFalse(os.path.exists(sidecarFilename(filepath)))
+        self.assertLess(os.path.getsize(filepath), os.path.getsize(self.jsonFile))
+        self.assertEqual(readJson(filepath), jsonData)
+
+        writeJsonStream(filepath, iter(blobs), iter(measurements), sidecar=True)
+        self.assertTrue(os.path.exists(sidecarFilename(filepath)))
+        self.assertEqual(asLists(readJson(filepath)), jsonData)
+
+        writeJsonStream(filepath, [], [], sidecar=True)
+        self.assertFalse(os.path.exists(sidecarFilename(filepath)))
+        self.assertEqual(readJson(filepath), {'blobs': [], 'measurements': []})
+
+
+class LazyJobTestCase(unittest.TestCase):
+    """Testing the deferred deserialization of blobs and extras."""
+
+    def setUp(self):
+        testDataDir = os.path.dirname(os.path.abspath(__file__))
+        self.jsonData = readJson(os.path.join(testDataDir, 'CfhtQuick_output_r.json'))
+        self.tmpDir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpDir, 'job.json')
+        writeJson(self.jsonData, self.filepath)
+        patcher = mock.patch.object(persistence, 'Job', FakeJob)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeJob.deserialized = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testDeferred(self):
+        job = LazyJob(self.filepath)
+        self.assertEqual(len(FakeJob.deserialized), 1)
+        self.assertEqual(FakeJob.deserialized[0]['blobs'], [])
+
+        pa1 = job.get_measurement('PA1')
+        self.assertEqual([m.quantity for m in job.measurements],
+                         [m['value'] for m in self.jsonData['measurements']])
+        self.assertEqual(len(FakeJob.deserialized), 1)
+
+        expected = [m for m in self.jsonData['measurements'] if m['metric']['name'] == 'PA1'][0]
+        assert_array_equal(pa1.magDiff, expected['extras']['magDiff']['value'])
+        self.assertEqual(pa1.blobs, expected['blobs'])
+        # Only PA1 and its blobs are deserialized.
+        self.assertEqual(len(FakeJob.deserialized), 2)
+        self.assertEqual(len(FakeJob.deserialized[1]['measurements']), 1)
+        self.assertEqual(set(blob['identifier'] for blob in FakeJob.deserialized[1]['blobs']),
+                         set(expected['blobs'].values()))
+
+        self.assertEqual(len(job.blobs), len(self.jsonData['blobs']))
+        self.assertEqual(len(FakeJob.deserialized), 3)
+
+    def testStreamParsedPerItem(self):
+        blobs = [JsonItem(blob) for blob in self.jsonData['blobs']]
+        measurements = [JsonItem(m) for m in self.jsonData['measurements']]
+        writeJsonStream(self.filepath, blobs, measurements, sidecar=True)
+
+        with mock.patch.object(persistence, '_readItems', wraps=persistence._readItems) as readItems:
+            job = LazyJob(self.filepath)
+            # Only the measurements are parsed, without their extras.
+            self.assertEqual(readItems.call_count, 1)
+            self.assertEqual(len(readItems.call_args[0][1]), len(measurements))
+            self.assertIsNotNone(readItems.call_args[1]['skipSpans'])
+            self.assertEqual([m.quantity for m in job.measurements],
+                             [m['value'] for m in self.jsonData['measurements']])
+
+            # The extras of PA1 and its blobs are parsed when accessed.
+            pa1 = job.get_measurement('PA1')
+            expected = [m for m in self.jsonData['measurements']
+                        if m['metric']['name'] == 'PA1'][0]
+            assert_array_equal(pa1.magDiff, expected['extras']['magDiff']['value'])
+            self.assertEqual(readItems.call_count, 3)
+            self.assertEqual(sum(len(call[0][1]) for call in readItems.call_args_list[1:]),
+                             1 + len(expected['blobs']))
+            self.assertEqual(len(FakeJob.deserialized[-1]['measurements']), 1)
+
+            self.assertEqual(asLists(job.blobs), self.jsonData['blobs'])
+            self.assertEqual(asLists(FakeJob.deserialized[-1]['measurements']),
+                             self.jsonData['measurements'])
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
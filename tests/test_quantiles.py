@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+
+from __future__ import print_function
+from builtins import range
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+import lsst.utils
+import lsst.utils.tests
+
+from lsst.validate.drp.quantiles import QuantileSketch, interQuartileRange, percentiles
+
+
+class PercentilesTestCase(unittest.TestCase):
+    """Testing exact percentiles by selection against numpy.percentile."""
+
+    def setUp(self):
+        self.random = np.random.RandomState(12345)
+
+    def testMatchesNumpy(self):
+        array = self.random.normal(0, 1, (7, 101))
+        for axis in (None, 0, 1):
+            for p in (50, [75, 25], [0, 10.5, 100]):
+                assert_allclose(percentiles(array, p, axis=axis),
+                                np.percentile(array, p, axis=axis), rtol=1e-14, atol=1e-14)
+        self.assertIsInstance(percentiles(array, 30), float)
+
+        original = array.copy()
+        percentiles(array, [75, 25], axis=1)
+        assert_allclose(array, original, rtol=0, atol=0)
+        assert_allclose(percentiles(array, [75, 25], axis=1, overwriteInput=True),
+                        np.percentile(original, [75, 25], axis=1), rtol=1e-14)
+
+    def testNanAndEmpty(self):
+        array = self.random.normal(0, 1, (3, 10))
+        array[1, 4] = np.nan
+        result = percentiles(array, 50, axis=1)
+        self.assertTrue(np.isnan(result[1]))
+        self.assertFalse(np.isnan(result[[0, 2]]).any())
+        self.assertTrue(np.isnan(percentiles([], 50)))
+        with self.assertRaises(ValueError):
+            percentiles(array, 101)
+
+    def testInterQuartileRange(self):
+        array = self.random.normal(0, 3, (4, 20000))
+        assert_allclose(interQuartileRange(array, axis=1, scaled=True), 3, rtol=0.05)
+        self.assertAlmostEqual(interQuartileRange(np.arange(5.)), 2.)
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """Testing the streaming quantile sketch."""
+
+    def testRankError(self):
+        random = np.random.RandomState(54321)
+        values = random.standard_cauchy(200000)
+        sketch = QuantileSketch(bufferSize=256)
+        for chunk in np.array_split(values, 37):
+            sketch.update(chunk)
+        self.assertEqual(sketch.count, len(values))
+        self.assertGreater(sketch.rankErrorBound, 0)
+        self.assertLess(sketch.rankError, 0.2)
+
+        p = np.array([1, 25, 50, 75, 99])
+        ranks = np.searchsorted(np.sort(values), sketch.percentile(p))
+        rankErrors = np.abs(ranks - p/100*(len(values) - 1))
+        self.assertTrue(np.all(rankErrors <= sketch.rankErrorBound + 1))
+
+    def testExactWhenSmall(self):
+        values = np.arange(100.)
+        sketch = QuantileSketch(bufferSize=128)
+        sketch.update(values[::-1])
+        sketch.update([np.nan])
+        self.assertEqual(sketch.rankErrorBound, 0)
+        self.assertEqual(sketch.numNan, 1)
+        self.assertEqual(sketch.percentile(50), 49.)
+        self.assertTrue(np.isnan(QuantileSketch().percentile(50)))
+
+    def testMerge(self):
+        random = np.random.RandomState(1)
+        values = random.uniform(0, 1, 50000)
+        sketches = [QuantileSketch(bufferSize=512) for i in range(4)]
+        for sketch, chunk in zip(sketches, np.array_split(values, 4)):
+            sketch.update(chunk)
+        merged = sketches[0]
+        for sketch in sketches[1:]:
+            merged.merge(sketch)
+        self.assertEqual(merged.count, len(values))
+        ranks = np.searchsorted(np.sort(values), merged.percentile([10, 50, 90]))
+        rankErrors = np.abs(ranks - np.array([10, 50, 90])/100.*(len(values) - 1))
+        self.assertTrue(np.all(rankErrors <= merged.rankErrorBound + 1))
+        with self.assertRaises(ValueError):
+            merged.merge(QuantileSketch(bufferSize=8))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+
+from __future__ import print_function
+from builtins import range
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import lsst.utils
+import lsst.utils.tests
+
+from lsst.validate.drp.groupedarrays import GroupedArrays
+from lsst.validate.drp.reducers import (RunningMoments, RunningPositionMoments, RunningQuantile,
+                                        RunningMatchStatistics)
+from lsst.validate.drp.util import averageRaDecByGroup, positionRmsByGroup
+
+
+class ReducersTestCase(unittest.TestCase):
+    """Testing per-object reducers fed visit by visit against the
+    reductions over all the sources."""
+
+    def setUp(self):
+        random = np.random.RandomState(12345)
+        self.numObjects, self.numVisits = 50, 12
+        self.visits = []
+        for visit in range(self.numVisits):
+            objectIndex = np.flatnonzero(random.uniform(size=self.numObjects) < 0.8)
+            mag = 18 + objectIndex*0.05 + random.normal(0, 0.02, len(objectIndex))
+            ra = 1.0 + objectIndex*1e-4 + random.normal(0, 1e-9, len(objectIndex))
+            dec = -0.5 + objectIndex*1e-4 + random.normal(0, 1e-9, len(objectIndex))
+            self.visits.append((objectIndex, mag, ra, dec))
+
+        self.groups = GroupedArrays.fromGroupIds(
+            np.concatenate([v[0] for v in self.visits]),
+            mag=np.concatenate([v[1] for v in self.visits]),
+            ra=np.concatenate([v[2] for v in self.visits]),
+            dec=np.concatenate([v[3] for v in self.visits]))
+        self.assertEqual(len(self.groups), self.numObjects)
+
+    def testMoments(self):
+        moments = RunningMoments(self.numObjects)
+        for objectIndex, mag, ra, dec in self.visits:
+            moments.update(objectIndex, mag)
+        assert_array_equal(moments.count, self.groups.counts)
+        assert_allclose(moments.mean, self.groups.mean('mag'), rtol=1e-12)
+        assert_allclose(moments.std(), self.groups.std('mag'), rtol=1e-9)
+
+        batched = RunningMoments(self.numObjects)
+        batched.update(self.groups.groupIndex, self.groups['mag'])
+        assert_allclose(batched.std(), self.groups.std('mag'), rtol=1e-9)
+
+    def testMomentsNan(self):
+        moments = RunningMoments(3)
+        moments.update([0, 1], [1., np.nan])
+        moments.update([0, 1], [2., 1.])
+        self.assertEqual(moments.mean[0], 1.5)
+        self.assertTrue(np.isnan(moments.mean[1]))
+        self.assertTrue(np.isnan(moments.mean[2]))
+
+    def testPositionMoments(self):
+        moments = RunningPositionMoments(self.numObjects)
+        for objectIndex, mag, ra, dec in self.visits:
+            moments.update(objectIndex, ra, dec)
+        meanRa, meanDec = averageRaDecByGroup(self.groups['ra'], self.groups['dec'],
+                                              self.groups.offsets)
+        ra, dec = moments.meanRaDec()
+        assert_allclose(ra, meanRa, rtol=0, atol=1e-14)
+        assert_allclose(dec, meanDec, rtol=0, atol=1e-14)
+
+        rmsMas = positionRmsByGroup(self.groups['ra'], self.groups['dec'], self.groups.offsets)
+        assert_allclose(np.degrees(moments.rms)*3.6e6, rmsMas, rtol=1e-5)
+
+    def testExactMedian(self):
+        median = RunningQuantile(self.numObjects, exactSize=self.numVisits)
+        for objectIndex, mag, ra, dec in self.visits:
+            median.update(objectIndex, mag)
+        assert_array_equal(median.count, self.groups.counts)
+        assert_allclose(median.value, self.groups.median('mag'), rtol=1e-15)
+
+    def testApproximateMedian(self):
+        random = np.random.RandomState(54321)
+        numObjects, numValues = 20, 500
+        values = random.normal(0, 1, (numValues, numObjects))
+        median = RunningQuantile(numObjects, exactSize=10)
+        for row in values:
+            median.update(np.arange(numObjects), row)
+        self.assertEqual(median.count[0], numValues)
+        # The standard error of the median of 500 values is 0.056.
+        assert_allclose(median.value, np.median(values, axis=0), rtol=0, atol=0.1)
+
+    def testQuantileNanAndRepeats(self):
+        median = RunningQuantile(2, exactSize=5)
+        median.update([0, 1], [1., np.nan])
+        median.update([0, 1], [3., 2.])
+        self.assertEqual(median.value[0], 2.)
+        self.assertTrue(np.isnan(median.value[1]))
+        with self.assertRaises(ValueError):
+            median.update([0, 0], [1., 2.])
+        with self.assertRaises(ValueError):
+            RunningQuantile(2, exactSize=4)
+
+    def testExtendTakeAndState(self):
+        # Objects are added as they are first seen, as when matching.
+        reducers = [RunningMoments(0), RunningPositionMoments(0), RunningQuantile(0, exactSize=5)]
+        for objectIndex, mag, ra, dec in self.visits:
+            numNew = objectIndex.max() + 1 - len(reducers[0].count)
+            for reducer in reducers:
+                reducer.extend(max(numNew, 0))
+            reducers[0].update(objectIndex, mag)
+            reducers[1].update(objectIndex, ra, dec)
+            reducers[2].update(objectIndex, mag)
+        moments, positions, median = reducers
+        assert_allclose(moments.std(), self.groups.std('mag'), rtol=1e-9)
+        meanRa = averageRaDecByGroup(self.groups['ra'], self.groups['dec'], self.groups.offsets)[0]
+        assert_allclose(positions.meanRaDec()[0], meanRa, rtol=0, atol=1e-14)
+
+        index = np.arange(0, self.numObjects, 3)
+        assert_array_equal(moments.take(index).std(), moments.std()[index])
+        assert_array_equal(positions.take(index).rms, positions.rms[index])
+        assert_array_equal(median.take(index).value, median.value[index])
+
+        # Restored state is updated as the original.
+        restored = [type(reducer).fromState(reducer.getState(prefix='x_'), prefix='x_')
+                    for reducer in reducers]
+        objectIndex, mag, ra, dec = self.visits[0]
+        for reducer in (reducers, restored):
+            reducer[0].update(objectIndex, mag)
+            reducer[1].update(objectIndex, ra, dec)
+            reducer[2].update(objectIndex, mag)
+        assert_array_equal(restored[0].std(), moments.std())
+        assert_array_equal(restored[1].rms, positions.rms)
+        assert_array_equal(restored[2].value, median.value)
+
+    def testMatchStatistics(self):
+        flagNames = ['flag_a', 'flag_b']
+        random = np.random.RandomState(2468)
+        n = self.groups.offsets[-1]
+        columns = {'coord_ra': self.groups['ra'], 'coord_dec': self.groups['dec'],
+                   'base_PsfFlux_mag': self.groups['mag'],
+                   'base_PsfFlux_magerr': random.uniform(0.01, 0.1, n),
+                   'base_PsfFlux_snr': random.uniform(5, 100, n),
+                   'base_ClassificationExtendedness_value': random.uniform(0, 1, n),
+                   'flag_a': random.uniform(size=n) < 0.01, 'flag_b': np.zeros(n, dtype=bool)}
+        columns['base_PsfFlux_mag'][3] = np.nan
+        groups = GroupedArrays(self.groups.offsets, **columns)
+
+        # All sources at once, in several rounds per object.
+        statistics = RunningMatchStatistics.fromGroups(groups, flagNames)
+        assert_array_equal(statistics.count, groups.counts)
+        assert_array_equal(statistics.flagged, groups.any(columns['flag_a']))
+        assert_array_equal(statistics.allFiniteMag,
+                           groups.all(np.isfinite(columns['base_PsfFlux_mag'])))
+        assert_array_equal(statistics.maxExtendedness,
+                           groups.max('base_ClassificationExtendedness_value'))
+        assert_allclose(statistics.mag.std(), groups.std('base_PsfFlux_mag'), rtol=1e-9)
+        assert_allclose(statistics.magErr.value, groups.median('base_PsfFlux_magerr'), rtol=1e-15)
+        assert_allclose(statistics.snr.value, groups.median('base_PsfFlux_snr'), rtol=1e-15)
+
+        # Source by source, one round-trip through the state half-way.
+        incremental = RunningMatchStatistics(len(groups), flagNames)
+        order = np.argsort(np.arange(n) % 7, kind='mergesort')
+        for i, chunk in enumerate(np.array_split(order, 4)):
+            if i == 2:
+                incremental = RunningMatchStatistics.fromState(incremental.getState(), flagNames)
+            incremental.update(groups.groupIndex[chunk],
+                               {name: values[chunk] for name, values in columns.items()})
+        assert_array_equal(incremental.count, statistics.count)
+        assert_array_equal(incremental.flagged, statistics.flagged)
+        assert_allclose(incremental.positions.rms, statistics.positions.rms, rtol=1e-6)
+        assert_allclose(incremental.snr.value, statistics.snr.value, rtol=1e-15)
+
+        selected = incremental.take(incremental.count >= 10)
+        assert_array_equal(selected.snr.value, incremental.snr.value[incremental.count >= 10])
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
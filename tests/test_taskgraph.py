@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import lsst.utils
+
+from lsst.validate.drp.taskgraph import TaskGraph
+
+
+class TaskGraphTestCase(unittest.TestCase):
+    """Testing that tasks run after their dependencies."""
+
+    def makeGraph(self, log):
+        lock = threading.Lock()
+
+        def task(name, delay):
+            def run(*inputs):
+                time.sleep(delay)
+                with lock:
+                    log.append(name)
+                return name + '(' + ','.join(inputs) + ')'
+            return run
+
+        graph = TaskGraph()
+        graph.add('a', task('a', 0.05))
+        graph.add('b', task('b', 0.))
+        graph.add('c', task('c', 0.), ['a'])
+        graph.add('d', task('d', 0.01), ['b', 'c'])
+        graph.add('e', task('e', 0.), ['b'])
+        return graph
+
+    def testSerialAndConcurrentResults(self):
+        serialLog, concurrentLog = [], []
+        serial = self.makeGraph(serialLog).run()
+        concurrent = self.makeGraph(concurrentLog).run(numThreads=3)
+        self.assertEqual(list(serial.items()), list(concurrent.items()))
+        self.assertEqual(list(concurrent.keys()), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(concurrent['d'], 'd(b(),c(a()))')
+        self.assertEqual(serialLog, ['a', 'b', 'c', 'd', 'e'])
+        # b and e do not wait for the slow a.
+        self.assertLess(concurrentLog.index('e'), concurrentLog.index('a'))
+        for before, after in (('a', 'c'), ('b', 'd'), ('c', 'd'), ('b', 'e')):
+            self.assertLess(concurrentLog.index(before), concurrentLog.index(after))
+
+    def testError(self):
+        def fail():
+            raise ValueError("failed")
+
+        for numThreads in (1, 2):
+            graph = TaskGraph()
+            graph.add('a', lambda: 1)
+            graph.add('b', fail)
+            graph.add('c', lambda a, b: a + b, ['a', 'b'])
+            with self.assertRaises(ValueError):
+                graph.run(numThreads=numThreads)
+
+    def testErrorSkipsQueuedTasks(self):
+        started = []
+        graph = TaskGraph()
+
+        def fail():
+            raise ValueError("failed")
+
+        def slow(name):
+            started.append(name)
+            time.sleep(0.05)
+
+        graph.add('fail', fail)
+        for i in range(10):
+            graph.add('slow%d' % i, lambda i=i: slow(i))
+        with self.assertRaises(ValueError):
+            graph.run(numThreads=2)
+        # The tasks queued behind the failure are not run.
+        self.assertLess(len(started), 10)
+
+    def testUnknownDependency(self):
+        graph = TaskGraph()
+        with self.assertRaises(AssertionError):
+            graph.add('a', lambda b: b, ['b'])
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import lsst.utils
+
+from lsst.validate.drp.tiling import SkyTiling
+from lsst.validate.drp.util import sphDist
+
+
+class SkyTilingTestCase(unittest.TestCase):
+    """Testing the assignment of positions to overlapping sky tiles."""
+
+    def setUp(self):
+        np.random.seed(31415)
+        N = 3000
+        # Uniform on the sphere, plus positions near RA=0 and the poles.
+        ra = np.random.uniform(0, 2*np.pi, N)
+        dec = np.arcsin(np.random.uniform(-1, 1, N))
+        dec[:300] = np.deg2rad(np.random.uniform(88, 90, 300))
+        dec[300:600] = np.deg2rad(np.random.uniform(-90, -88, 300))
+        ra[600:900] = np.deg2rad(np.random.uniform(-1, 1, 300)) % (2*np.pi)
+        self.ra, self.dec = ra, dec
+
+    def testTileIndex(self):
+        tiling = SkyTiling(np.deg2rad(5))
+        tiles = tiling.tileIndex(self.ra, self.dec)
+        self.assertTrue(np.all((0 <= tiles) & (tiles < len(tiling))))
+        # Tiles are at least tileSize high and wide.
+        self.assertGreaterEqual(tiling.bandHeight, np.deg2rad(5))
+
+    def testMarginCoversNeighbours(self):
+        """Every position within the margin of another one is assigned to
+        the tile of that other one."""
+        for tileSize, margin in ((5, 1), (2, 0.5), (40, 10)):
+            tiling = SkyTiling(np.deg2rad(tileSize), np.deg2rad(margin))
+            tiles, indices = tiling.tilesWithMargin(self.ra, self.dec)
+            assigned = set(zip(tiles, indices))
+            ownTile = tiling.tileIndex(self.ra, self.dec)
+            for i in range(len(self.ra)):
+                self.assertIn((ownTile[i], i), assigned)
+                dist = sphDist(self.ra[i], self.dec[i], self.ra, self.dec)
+                near, = np.where(dist < np.deg2rad(margin))
+                for j in near:
+                    self.assertIn((ownTile[i], j), assigned)
+
+    def testSorted(self):
+        tiling = SkyTiling(np.deg2rad(10), np.deg2rad(1))
+        tiles, indices = tiling.tilesWithMargin(self.ra, self.dec)
+        order = np.lexsort((indices, tiles))
+        assert_array_equal(order, np.arange(len(tiles)))
+
+    def testEmpty(self):
+        tiling = SkyTiling(np.deg2rad(10), np.deg2rad(1))
+        tiles, indices = tiling.tilesWithMargin([], [])
+        self.assertEqual(len(tiles), 0)
+        self.assertEqual(len(indices), 0)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()